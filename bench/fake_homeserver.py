@@ -0,0 +1,420 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Set, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+API_PREFIX = '/_matrix/client/r0'
+
+# (method, path template, handler name); the {placeholders} are passed to the handler
+ROUTES = [
+    ('POST', '/login', 'login'),
+    ('GET', '/account/whoami', 'whoami'),
+    ('POST', '/user/{user_id}/filter', 'create_filter'),
+    ('GET', '/sync', 'sync'),
+    ('POST', '/createRoom', 'create_room'),
+    ('PUT', '/rooms/{room_id}/send/{event_type}/{txn_id}', 'send'),
+    ('PUT', '/rooms/{room_id}/state/{event_type}', 'put_state'),
+    ('PUT', '/rooms/{room_id}/state/{event_type}/{state_key}', 'put_state'),
+    ('GET', '/rooms/{room_id}/state/{event_type}', 'get_state'),
+    ('GET', '/rooms/{room_id}/state/{event_type}/{state_key}', 'get_state'),
+    ('GET', '/rooms/{room_id}/members', 'members'),
+    ('GET', '/rooms/{room_id}/joined_members', 'joined_members'),
+    ('POST', '/rooms/{room_id}/invite', 'invite'),
+    ('POST', '/rooms/{room_id}/leave', 'leave'),
+    ('POST', '/rooms/{room_id}/join', 'join'),
+    ('POST', '/join/{room_id}', 'join'),
+    ('GET', '/joined_rooms', 'joined_rooms'),
+    ('POST', '/register', 'register'),
+    ('PUT', '/profile/{user_id}/displayname', 'set_displayname'),
+    ]
+ROUTE_PATTERNS = [(method, template, re.compile(re.sub(r'{\w+}', '([^/]+)', template)), name)
+                  for method, template, name in ROUTES]
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, errcode: str, error: str='', **extra):
+        super().__init__(error)
+        self.status = status
+        self.content = dict(errcode=errcode, error=error, **extra)
+
+
+class FakeHomeserver:
+    """
+    Minimal in-memory Matrix client-server API, good enough for the bridge's calls:
+     login, whoami, filters, /sync (with long polling), createRoom, send, room state,
+     members, invite and leave.
+
+    With an appservice registration, the as_token may act as any user (?user_id=), and new events
+     are pushed to the appservice as transactions instead of being fetched with /sync.
+
+    Every request is counted per endpoint (see `calls`) and per room it is about (see `room_calls`),
+     and every sent message is recorded with its arrival time (see `sent`), so benchmarks can
+     count HTTP calls and measure latency.
+    """
+    server_name = 'bench.local'
+
+    def __init__(self, host: str='127.0.0.1', port: int=0,
+                 auto_join: Set[str]=(), rate_limit: float=0, appservice: Dict[str, str]=None):
+        """
+        :param auto_join: Users who immediately join every room they are invited to
+        :param rate_limit: If set, answer M_LIMIT_EXCEEDED (429) to more than this many
+                           requests per second (except /sync)
+        :param appservice: (Optional) Registration with url, as_token, hs_token and sender (user id)
+        """
+        self.auto_join = set(auto_join)
+        self.rate_limit = rate_limit
+        self.appservice = appservice
+
+        self.calls = Counter()          # type: Counter
+        self.room_calls = Counter()     # type: Counter
+        self.sent = []                  # type: List[Tuple[float, str, Dict]]
+        self.rooms = {}                 # type: Dict[str, Dict]
+        self.tokens = {}                # type: Dict[str, str]
+        self.users = set()              # type: Set[str]
+
+        self._events = []               # type: List[Tuple[str, Dict]]
+        self._txn_ids = {}              # type: Dict[Tuple[str, str], str]
+        self._next_id = 0
+        self._window = (0, 0)           # (second, requests) for the rate limit
+        self._cond = threading.Condition()
+        if appservice is not None:
+            self.tokens[appservice['as_token']] = appservice['sender']
+
+        handler = type('Handler', (_Handler,), {'homeserver': self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.base_url = 'http://{}:{}'.format(*self.httpd.server_address[:2])
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        if self.appservice is not None:
+            threading.Thread(target=self._push_transactions, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # Helpers for benchmark scripts
+
+    def add_room(self, creator: str, topic: str=None, name: str=None, members: List[str]=()) -> str:
+        """
+        Create a room directly, e.g. to set up the rooms a bridge already had before a restart.
+        :return: room id
+        """
+        with self._cond:
+            room_id = self._new_room(creator, name, topic)
+            for user_id in members:
+                self._add_event(room_id, 'm.room.member', user_id, {'membership': 'join'}, user_id)
+            return room_id
+
+    def inject_message(self, room_id: str, sender: str, body: str, msgtype: str='m.text'):
+        """
+        Send a message as some other Matrix user, which the bridge will see in its sync.
+        """
+        if room_id not in self.rooms:
+            raise ValueError('Unknown room {}'.format(room_id))
+        with self._cond:
+            self._add_event(room_id, 'm.room.message', sender, {'msgtype': msgtype, 'body': body})
+
+    def room_with_topic(self, topic: str) -> str or None:
+        with self._cond:
+            for room_id, room in self.rooms.items():
+                if room['state'].get(('m.room.topic', ''), {}).get('topic') == topic:
+                    return room_id
+        return None
+
+    def joined(self, room_id: str) -> List[str]:
+        with self._cond:
+            return [user_id for (etype, user_id), content in self.rooms[room_id]['state'].items()
+                    if etype == 'm.room.member' and content.get('membership') == 'join']
+
+    def wait_for(self, predicate, timeout: float=60) -> bool:
+        """
+        Wait until predicate() is true; it is checked after every change to the server state.
+        """
+        with self._cond:
+            return self._cond.wait_for(predicate, timeout)
+
+    # Internals; called with self._cond held
+
+    def _new_id(self, sigil: str) -> str:
+        self._next_id += 1
+        return '{}{}:{}'.format(sigil, self._next_id, self.server_name)
+
+    def _new_room(self, creator: str, name: str=None, topic: str=None) -> str:
+        room_id = self._new_id('!')
+        self.rooms[room_id] = {'state': {}}
+        self._add_event(room_id, 'm.room.create', creator, {'creator': creator}, '')
+        self._add_event(room_id, 'm.room.member', creator, {'membership': 'join'}, creator)
+        if name:
+            self._add_event(room_id, 'm.room.name', creator, {'name': name}, '')
+        if topic:
+            self._add_event(room_id, 'm.room.topic', creator, {'topic': topic}, '')
+        return room_id
+
+    def _add_event(self, room_id: str, event_type: str, sender: str, content: Dict,
+                   state_key: str=None) -> str:
+        event = {
+            'event_id': self._new_id('$'),
+            'type': event_type,
+            'sender': sender,
+            'content': content,
+            'origin_server_ts': int(time.time() * 1000),
+            }
+        if state_key is not None:
+            event['state_key'] = state_key
+            self.rooms[room_id]['state'][(event_type, state_key)] = content
+        self._events.append((room_id, event))
+        self._cond.notify_all()
+
+        if (event_type == 'm.room.member' and content.get('membership') == 'invite'
+                and state_key in self.auto_join):
+            self._add_event(room_id, 'm.room.member', state_key, {'membership': 'join'}, state_key)
+        return event['event_id']
+
+    def _membership(self, room_id: str, user_id: str) -> str or None:
+        if room_id not in self.rooms:
+            raise ApiError(404, 'M_NOT_FOUND', 'Unknown room {}'.format(room_id))
+        return self.rooms[room_id]['state'].get(('m.room.member', user_id), {}).get('membership')
+
+    def _check_rate_limit(self, path: str):
+        if not self.rate_limit or path == '/sync':
+            return
+        second = int(time.monotonic())
+        start, count = self._window
+        if start != second:
+            start, count = second, 0
+        self._window = (start, count + 1)
+        if count >= self.rate_limit:
+            raise ApiError(429, 'M_LIMIT_EXCEEDED', 'Too many requests',
+                           retry_after_ms=int((start + 1 - time.monotonic()) * 1000) + 1)
+
+    def handle(self, method: str, path: str, query: Dict, token: str, body: Dict) -> Dict:
+        for route_method, template, pattern, name in ROUTE_PATTERNS:
+            match = pattern.fullmatch(path)
+            if route_method == method and match:
+                self.calls['{} {}'.format(method, template)] += 1
+                args = [unquote(arg) for arg in match.groups()]
+                self.room_calls.update(arg for arg in args if arg.startswith('!'))
+                if name == 'sync':
+                    return self.sync(token, query)
+                with self._cond:
+                    self._check_rate_limit(path)
+                    if name == 'login':
+                        return self.login(body)
+                    user_id = self.tokens.get(token)
+                    if user_id is None:
+                        raise ApiError(401, 'M_UNKNOWN_TOKEN', 'Unknown access token')
+                    if self.appservice is not None and token == self.appservice['as_token']:
+                        user_id = query.get('user_id', user_id)
+                    return getattr(self, name)(user_id, body, *args)
+        self.calls['{} {}'.format(method, path)] += 1
+        raise ApiError(404, 'M_UNRECOGNIZED', 'Unrecognized request')
+
+    # Endpoints
+
+    def login(self, body: Dict) -> Dict:
+        user = body.get('user') or body.get('identifier', {}).get('user')
+        user_id = user if user.startswith('@') else '@{}:{}'.format(user, self.server_name)
+        token = 'token{}'.format(len(self.tokens))
+        self.tokens[token] = user_id
+        return {'user_id': user_id, 'access_token': token, 'home_server': self.server_name,
+                'device_id': 'BENCH'}
+
+    def whoami(self, user_id: str, _body: Dict) -> Dict:
+        return {'user_id': user_id}
+
+    def create_filter(self, _user_id: str, _body: Dict, _filter_user: str) -> Dict:
+        return {'filter_id': '1'}
+
+    def create_room(self, user_id: str, body: Dict) -> Dict:
+        topic = None
+        for event in body.get('initial_state', []):
+            if event['type'] == 'm.room.topic':
+                topic = event['content']['topic']
+        room_id = self._new_room(user_id, body.get('name'), body.get('topic', topic))
+        for invitee in body.get('invite', []):
+            self._add_event(room_id, 'm.room.member', user_id, {'membership': 'invite'}, invitee)
+        return {'room_id': room_id}
+
+    def send(self, user_id: str, body: Dict, room_id: str, event_type: str, txn_id: str) -> Dict:
+        if (user_id, txn_id) in self._txn_ids:
+            return {'event_id': self._txn_ids[(user_id, txn_id)]}
+        if self._membership(room_id, user_id) != 'join':
+            raise ApiError(403, 'M_FORBIDDEN', 'Not in room')
+        event_id = self._add_event(room_id, event_type, user_id, body)
+        self._txn_ids[(user_id, txn_id)] = event_id
+        self.sent.append((time.monotonic(), room_id, body))
+        return {'event_id': event_id}
+
+    def put_state(self, user_id: str, body: Dict, room_id: str, event_type: str, state_key: str='') -> Dict:
+        return {'event_id': self._add_event(room_id, event_type, user_id, body, state_key)}
+
+    def get_state(self, _user_id: str, _body: Dict, room_id: str, event_type: str, state_key: str='') -> Dict:
+        content = self.rooms[room_id]['state'].get((event_type, state_key))
+        if content is None:
+            raise ApiError(404, 'M_NOT_FOUND', 'Event not found')
+        return content
+
+    def members(self, _user_id: str, _body: Dict, room_id: str) -> Dict:
+        chunk = [{'type': etype, 'state_key': key, 'content': content}
+                 for (etype, key), content in self.rooms[room_id]['state'].items() if etype == 'm.room.member']
+        return {'chunk': chunk}
+
+    def joined_members(self, _user_id: str, _body: Dict, room_id: str) -> Dict:
+        return {'joined': {user_id: {} for (etype, user_id), content in self.rooms[room_id]['state'].items()
+                           if etype == 'm.room.member' and content.get('membership') == 'join'}}
+
+    def invite(self, user_id: str, body: Dict, room_id: str) -> Dict:
+        if self._membership(room_id, body['user_id']) in ('join', 'invite'):
+            raise ApiError(403, 'M_FORBIDDEN', 'Already in room')
+        self._add_event(room_id, 'm.room.member', user_id, {'membership': 'invite'}, body['user_id'])
+        return {}
+
+    def leave(self, user_id: str, _body: Dict, room_id: str) -> Dict:
+        self._add_event(room_id, 'm.room.member', user_id, {'membership': 'leave'}, user_id)
+        return {}
+
+    def join(self, user_id: str, _body: Dict, room_id: str) -> Dict:
+        if self._membership(room_id, user_id) not in ('join', 'invite'):
+            raise ApiError(403, 'M_FORBIDDEN', 'Not invited')
+        if self._membership(room_id, user_id) != 'join':
+            self._add_event(room_id, 'm.room.member', user_id, {'membership': 'join'}, user_id)
+        return {'room_id': room_id}
+
+    def joined_rooms(self, user_id: str, _body: Dict) -> Dict:
+        return {'joined_rooms': [room_id for room_id in self.rooms if self._membership(room_id, user_id) == 'join']}
+
+    def register(self, _user_id: str, body: Dict) -> Dict:
+        user_id = '@{}:{}'.format(body['username'], self.server_name)
+        if user_id in self.users:
+            raise ApiError(400, 'M_USER_IN_USE', 'User ID already taken')
+        self.users.add(user_id)
+        return {'user_id': user_id}
+
+    def set_displayname(self, _user_id: str, _body: Dict, _target: str) -> Dict:
+        return {}
+
+    def sync(self, token: str, query: Dict) -> Dict:
+        with self._cond:
+            user_id = self.tokens.get(token)
+            if user_id is None:
+                raise ApiError(401, 'M_UNKNOWN_TOKEN', 'Unknown access token')
+
+            since = query.get('since')
+            if since is not None:
+                timeout = int(query.get('timeout', 0)) / 1000
+                self._cond.wait_for(lambda: len(self._events) > int(since), timeout)
+            return self._sync_response(user_id, since)
+
+    def _summary(self, room_id: str) -> Dict:
+        memberships = [content.get('membership') for (etype, _key), content in self.rooms[room_id]['state'].items()
+                       if etype == 'm.room.member']
+        return {'m.joined_member_count': memberships.count('join'),
+                'm.invited_member_count': memberships.count('invite')}
+
+    def _sync_response(self, user_id: str, since: str or None) -> Dict:
+        join, leave = {}, {}
+        if since is None:
+            for room_id, room in self.rooms.items():
+                if self._membership(room_id, user_id) == 'join':
+                    state = [{'type': etype, 'state_key': key, 'content': content, 'sender': user_id,
+                              'event_id': '$state'}
+                             for (etype, key), content in room['state'].items()]
+                    join[room_id] = {'state': {'events': state},
+                                     'timeline': {'events': [], 'prev_batch': '0'},
+                                     'summary': self._summary(room_id)}
+        else:
+            for room_id, event in self._events[int(since):]:
+                membership = self._membership(room_id, user_id)
+                if membership == 'join':
+                    room = join.setdefault(room_id, {'state': {'events': []},
+                                                     'timeline': {'events': [], 'prev_batch': since}})
+                    room['timeline']['events'].append(dict(event))
+                    # Like with lazy-loaded members, the summary is only sent when it changed
+                    if event['type'] == 'm.room.member':
+                        room['summary'] = self._summary(room_id)
+                elif event.get('state_key') == user_id and event['content'].get('membership') == 'leave':
+                    leave[room_id] = {'timeline': {'events': [dict(event)]}}
+
+        return {
+            'next_batch': str(len(self._events)),
+            'rooms': {'join': join, 'leave': leave, 'invite': {}},
+            'presence': {'events': []},
+            }
+
+
+    def _push_transactions(self):
+        """
+        Send every new event to the appservice, as one transaction per batch of events.
+        """
+        session = requests.Session()
+        pushed = len(self._events)
+        txn_id = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._events) > pushed)
+                events = [dict(event, room_id=room_id) for room_id, event in self._events[pushed:]]
+                pushed = len(self._events)
+            txn_id += 1
+            url = '{}/_matrix/app/v1/transactions/{}'.format(self.appservice['url'], txn_id)
+            while True:
+                try:
+                    response = session.put(url, json={'events': events},
+                                           params={'access_token': self.appservice['hs_token']})
+                    if response.status_code == 200:
+                        break
+                except requests.RequestException:
+                    pass
+                time.sleep(0.5)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    homeserver = None           # type: FakeHomeserver
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; with Nagle's algorithm, the body would wait for the
+    #  client's delayed ACK (~40ms) on every keep-alive request
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self, method: str):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        body = json.loads(raw) if raw else {}
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        token = self.headers.get('Authorization', '')[len('Bearer '):] or query.get('access_token')
+
+        status, content = 200, {}
+        if not url.path.startswith(API_PREFIX):
+            status, content = 404, {'errcode': 'M_UNRECOGNIZED'}
+        else:
+            try:
+                content = self.homeserver.handle(method, url.path[len(API_PREFIX):], query, token, body)
+            except ApiError as e:
+                status, content = e.status, e.content
+
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
@@ -0,0 +1,264 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import os
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Tuple
+from xml.sax.saxutils import escape, quoteattr
+
+NS_CLIENT = 'jabber:client'
+NS_STREAM = 'http://etherx.jabber.org/streams'
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+NS_ROSTER = 'jabber:iq:roster'
+NS_MUC = 'http://jabber.org/protocol/muc'
+NS_PING = 'urn:xmpp:ping'
+NS_MAM = 'urn:xmpp:mam:2'
+NS_RSM = 'http://jabber.org/protocol/rsm'
+NS_DATA = 'jabber:x:data'
+NS_FORWARD = 'urn:xmpp:forward:0'
+NS_DELAY = 'urn:xmpp:delay'
+NS_SID = 'urn:xmpp:sid:0'
+
+
+def _hmac(key: bytes, msg: bytes) -> bytes:
+    return hmac.new(key, msg, hashlib.sha1).digest()
+
+
+def _stamp(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _parse_stamp(text: str) -> float:
+    return datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class FakeXMPPServer:
+    """
+    Scripted XMPP server for one client connection. Speaks just enough of the protocol for
+     ClientXMPP: SASL SCRAM-SHA-1 (which sleekxmpp accepts without TLS), resource binding,
+     the roster, presence, MUC joins, pings and message archive queries (XEP-0313, with paging).
+
+    Benchmark scripts push stanzas to the client with send_chat, send_groupchat and
+     send_presence; stanzas the client sends are recorded in `received` with their arrival time.
+    Messages pushed to the client are archived, and archive() adds messages to an archive only.
+    """
+    domain = 'bench.local'
+
+    def __init__(self, password: str, roster: Dict[str, str], host: str='127.0.0.1', port: int=0):
+        """
+        :param password: Password the client has to authenticate with
+        :param roster: Map of JID -> name returned as the client's roster
+        """
+        self.password = password
+        self.roster = roster
+
+        self.received = []              # type: List[Tuple[float, ET.Element]]
+        # Archive owner (our bare JID or a group chat) -> [(id, time, from, type, body)]
+        self.archives = {}              # type: Dict[str, List[Tuple[str, float, str, str, str]]]
+        self.bare_jid = 'bridge@' + self.domain
+        self.jid = None                 # type: str
+        self.ready = threading.Event()  # set after the client sent its initial presence
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(1)
+        self.address = self._listener.getsockname()[:2]
+
+        self._conn = None               # type: socket.socket
+        self._write_lock = threading.Lock()
+        self._scram = {}                # type: Dict[str, bytes]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    # Scripted stanzas
+
+    def send_chat(self, from_jid: str, body: str, resource: str='phone'):
+        sender = '{}/{}'.format(from_jid, resource)
+        archive_id = self.archive(self.bare_jid, sender, body)
+        self.write('<message from={} to={} type="chat" id={}><body>{}</body>'
+                   '<stanza-id xmlns="{}" id={} by={}/></message>'.format(
+                       quoteattr(sender), quoteattr(self.jid), quoteattr(self._new_id()), escape(body),
+                       NS_SID, quoteattr(archive_id), quoteattr(self.bare_jid)))
+
+    def send_groupchat(self, room_jid: str, nick: str, body: str):
+        sender = '{}/{}'.format(room_jid, nick)
+        archive_id = self.archive(room_jid, sender, body, mtype='groupchat')
+        self.write('<message from={} to={} type="groupchat" id={}><body>{}</body>'
+                   '<stanza-id xmlns="{}" id={} by={}/></message>'.format(
+                       quoteattr(sender), quoteattr(self.jid), quoteattr(self._new_id()), escape(body),
+                       NS_SID, quoteattr(archive_id), quoteattr(room_jid)))
+
+    def archive(self, owner: str, from_jid: str, body: str, timestamp: float=None, mtype: str='chat') -> str:
+        """
+        Add a message to an archive without sending it.
+        :param owner: Our bare JID for chats, the group chat's JID for its messages
+        :param from_jid: Full JID of the sender
+        :return: Archive id of the message
+        """
+        archive_id = self._new_id()
+        self.archives.setdefault(owner, []).append(
+            (archive_id, time.time() if timestamp is None else timestamp, from_jid, mtype, body))
+        return archive_id
+
+    def send_presence(self, from_jid: str, available: bool=True, resource: str='phone'):
+        self.write('<presence from={} to={}{}/>'.format(
+            quoteattr('{}/{}'.format(from_jid, resource)), quoteattr(self.jid),
+            '' if available else ' type="unavailable"'))
+
+    def write(self, data: str):
+        with self._write_lock:
+            self._conn.sendall(data.encode())
+
+    # Protocol
+
+    @staticmethod
+    def _new_id() -> str:
+        return base64.b32encode(os.urandom(5)).decode().lower()
+
+    def _serve(self):
+        self._conn, _address = self._listener.accept()
+        self._conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        authenticated = False
+
+        while True:
+            parser = ET.XMLPullParser(events=('start', 'end'))
+            depth = 0
+            restart = False
+            while not restart:
+                data = self._conn.recv(65536)
+                if not data:
+                    return
+                parser.feed(data)
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        depth += 1
+                        if depth == 1:
+                            self._stream_header(authenticated)
+                    else:
+                        depth -= 1
+                        if depth == 1:
+                            self.received.append((time.monotonic(), element))
+                            if self._handle(element):
+                                # SASL success: the client opens a new stream
+                                authenticated = True
+                                restart = True
+                                break
+                        elif depth == 0:
+                            return
+
+    def _stream_header(self, authenticated: bool):
+        header = ('<?xml version="1.0"?><stream:stream xmlns="{}" xmlns:stream="{}" from="{}" '
+                  'id="{}" version="1.0">').format(NS_CLIENT, NS_STREAM, self.domain, self._new_id())
+        if authenticated:
+            features = ('<bind xmlns="{}"/><session xmlns="{}"><optional/></session>'
+                        .format(NS_BIND, NS_SESSION))
+        else:
+            features = ('<mechanisms xmlns="{}"><mechanism>SCRAM-SHA-1</mechanism></mechanisms>'
+                        .format(NS_SASL))
+        self.write(header + '<stream:features>' + features + '</stream:features>')
+
+    def _handle(self, element: ET.Element) -> bool:
+        """
+        :return: True if the stream has to be restarted
+        """
+        tag = element.tag
+        if tag == '{%s}auth' % NS_SASL:
+            self._scram_first(base64.b64decode(element.text or ''))
+        elif tag == '{%s}response' % NS_SASL:
+            self._scram_final(base64.b64decode(element.text or ''))
+            return True
+        elif tag == '{%s}iq' % NS_CLIENT:
+            self._handle_iq(element)
+        elif tag == '{%s}presence' % NS_CLIENT:
+            self._handle_presence(element)
+        return False
+
+    def _scram_first(self, client_first: bytes):
+        client_first_bare = client_first.split(b',', 2)[2]
+        attributes = dict(part.split(b'=', 1) for part in client_first_bare.split(b','))
+        salt = os.urandom(16)
+        nonce = attributes[b'r'] + base64.b64encode(os.urandom(12))
+        server_first = b'r=' + nonce + b',s=' + base64.b64encode(salt) + b',i=4096'
+        self._scram = {'client_first_bare': client_first_bare, 'server_first': server_first, 'salt': salt}
+        self.write('<challenge xmlns="{}">{}</challenge>'.format(
+            NS_SASL, base64.b64encode(server_first).decode()))
+
+    def _scram_final(self, client_final: bytes):
+        without_proof = client_final.rsplit(b',p=', 1)[0]
+        auth_message = b','.join((self._scram['client_first_bare'], self._scram['server_first'], without_proof))
+        salted = hashlib.pbkdf2_hmac('sha1', self.password.encode(), self._scram['salt'], 4096)
+        signature = _hmac(_hmac(salted, b'Server Key'), auth_message)
+        self.write('<success xmlns="{}">{}</success>'.format(
+            NS_SASL, base64.b64encode(b'v=' + base64.b64encode(signature)).decode()))
+
+    def _handle_iq(self, iq: ET.Element):
+        iq_id = quoteattr(iq.get('id', ''))
+        if iq.find('{%s}bind' % NS_BIND) is not None:
+            resource = iq.findtext('{%s}bind/{%s}resource' % (NS_BIND, NS_BIND)) or 'mxpp'
+            self.jid = 'bridge@{}/{}'.format(self.domain, resource)
+            self.write('<iq type="result" id={}><bind xmlns="{}"><jid>{}</jid></bind></iq>'.format(
+                iq_id, NS_BIND, escape(self.jid)))
+        elif iq.find('{%s}query' % NS_ROSTER) is not None and iq.get('type') == 'get':
+            items = ''.join('<item jid={} name={} subscription="both"/>'.format(quoteattr(jid), quoteattr(name))
+                            for jid, name in self.roster.items())
+            self.write('<iq type="result" id={} to={}><query xmlns="{}">{}</query></iq>'.format(
+                iq_id, quoteattr(self.jid), NS_ROSTER, items))
+        elif iq.find('{%s}query' % NS_MAM) is not None and iq.get('type') == 'set':
+            self._handle_mam(iq)
+        elif iq.get('type') in ('get', 'set') and iq.find('{%s}session' % NS_SESSION) is None \
+                and iq.find('{%s}ping' % NS_PING) is None:
+            self.write('<iq type="error" id={}><error type="cancel"><service-unavailable '
+                       'xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></error></iq>'.format(iq_id))
+        elif iq.get('type') in ('get', 'set'):
+            self.write('<iq type="result" id={}/>'.format(iq_id))
+
+    def _handle_presence(self, presence: ET.Element):
+        to = presence.get('to')
+        if to is None:
+            self.ready.set()
+        elif presence.find('{%s}x' % NS_MUC) is not None and presence.get('type') is None:
+            # MUC join: confirm with our own occupant presence
+            self.write('<presence from={} to={}><x xmlns="{}#user"><item affiliation="member" role="participant"/>'
+                       '<status code="110"/></x></presence>'.format(quoteattr(to), quoteattr(self.jid), NS_MUC))
+
+    def _handle_mam(self, iq: ET.Element):
+        query = iq.find('{%s}query' % NS_MAM)
+        fields = {field.get('var'): field.findtext('{%s}value' % NS_DATA)
+                  for field in query.iterfind('{%s}x/{%s}field' % (NS_DATA, NS_DATA))}
+        page_size = int(query.findtext('{%s}set/{%s}max' % (NS_RSM, NS_RSM)) or 50)
+        after = query.findtext('{%s}set/{%s}after' % (NS_RSM, NS_RSM))
+
+        items = self.archives.get((iq.get('to') or self.bare_jid).split('/')[0], [])
+        if 'with' in fields:
+            items = [item for item in items if item[2].split('/')[0] == fields['with']]
+        if 'start' in fields:
+            items = [item for item in items if item[1] >= _parse_stamp(fields['start'])]
+        if 'end' in fields:
+            items = [item for item in items if item[1] <= _parse_stamp(fields['end']) + 1]
+        position = 0
+        if after is not None:
+            position = next((i + 1 for i, item in enumerate(items) if item[0] == after), len(items))
+        page = items[position:position + page_size]
+
+        for archive_id, timestamp, from_jid, mtype, body in page:
+            self.write('<message to={}><result xmlns="{}" queryid={} id={}><forwarded xmlns="{}">'
+                       '<delay xmlns="{}" stamp="{}"/><message xmlns="{}" from={} type="{}"><body>{}</body>'
+                       '</message></forwarded></result></message>'.format(
+                           quoteattr(self.jid), NS_MAM, quoteattr(query.get('queryid', '')),
+                           quoteattr(archive_id), NS_FORWARD, NS_DELAY, _stamp(timestamp), NS_CLIENT,
+                           quoteattr(from_jid), mtype, escape(body)))
+        rsm = ''
+        if page:
+            rsm = '<first>{}</first><last>{}</last>'.format(escape(page[0][0]), escape(page[-1][0]))
+        self.write('<iq type="result" id={}><fin xmlns="{}" complete="{}"><set xmlns="{}">{}</set></fin></iq>'.format(
+            quoteattr(iq.get('id', '')), NS_MAM, 'true' if position + page_size >= len(items) else 'false',
+            NS_RSM, rsm))
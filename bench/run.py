@@ -0,0 +1,377 @@
+"""
+Load benchmarks for the bridge, against the local stand-ins in this package.
+
+    python -m bench.run cold_start --contacts 200
+    python -m bench.run warm_restart --contacts 200
+    python -m bench.run muc_burst --messages 500 --rate 50
+    python -m bench.run presence_storm --contacts 100 --flaps 5
+    python -m bench.run purge --rooms 200
+    python -m bench.run backfill --messages 2000 --page-size 50
+
+Each run starts a FakeHomeserver and a FakeXMPPServer, points a BridgeBot at them with a
+ temporary config and store, runs one scenario and prints the throughput, the end-to-end latency
+ (where it applies) and the number of HTTP calls per endpoint.
+"""
+import argparse
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+import yaml
+
+from bench.fake_homeserver import FakeHomeserver
+from bench.fake_xmpp import FakeXMPPServer
+from mxpp.main import BridgeBot
+
+BOT_USER = '@bridge:bench.local'
+OWNER = '@owner:bench.local'
+GROUPCHAT_FLAG = '<groupchat>'
+CONTROL_TOPIC = 'control'    # topic of the bot's control room
+MUC_JID = 'room@muc.bench.local'
+NICK = 'bridge'
+
+
+class Bench:
+    """
+    A bridge between a fake homeserver and a fake XMPP server.
+    """
+    bot = None                  # type: BridgeBot
+
+    def __init__(self, args: argparse.Namespace, roster: Dict[str, str]):
+        self.args = args
+        self.appservice = None
+        if args.appservice:
+            self.appservice = {'url': 'http://127.0.0.1:{}'.format(free_port()), 'as_token': 'bench-as',
+                               'hs_token': 'bench-hs', 'sender': BOT_USER}
+        self.homeserver = FakeHomeserver(auto_join={OWNER}, rate_limit=args.server_rate_limit,
+                                         appservice=self.appservice)
+        self.xmpp_server = FakeXMPPServer(password='bench', roster=roster)
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='mxpp-bench-')
+
+    def start(self):
+        """
+        Start both servers and the bridge, and wait until the bridge is logged in to XMPP.
+        """
+        self.homeserver.start()
+        self.xmpp_server.start()
+        self.bot = BridgeBot(self.write_config())
+        if self.bot.appservice is not None:
+            threading.Thread(target=self.bot.appservice.serve_forever, daemon=True).start()
+        else:
+            threading.Thread(target=self.bot.matrix.listen_forever, daemon=True).start()
+        if not self.xmpp_server.ready.wait(30):
+            raise RuntimeError('Bridge did not log in to the XMPP server')
+
+    def restart(self):
+        """
+        Stop the bridge and start it again on the same store, with a new XMPP connection, and wait
+         until it handled the roster.
+        """
+        self.bot.stop()
+        self.bot.xmpp.abort()
+        # The fake XMPP server takes a single connection
+        self.xmpp_server = FakeXMPPServer(password='bench', roster=self.xmpp_server.roster)
+        self.xmpp_server.start()
+        self.bot = BridgeBot(self.write_config())
+        if self.bot.appservice is not None:
+            threading.Thread(target=self.bot.appservice.serve_forever, daemon=True).start()
+        else:
+            threading.Thread(target=self.bot.matrix.listen_forever, daemon=True).start()
+        if not self.xmpp_server.ready.wait(30):
+            raise RuntimeError('Bridge did not log in to the XMPP server')
+        self.idle()
+
+    def idle(self):
+        """
+        Wait until the bridge handled what it received, as far as its queues tell.
+        """
+        time.sleep(1)
+        for queue in (self.bot.tasks, self.bot.dispatcher, self.bot.send_queue):
+            if not queue.join(self.args.timeout):
+                raise RuntimeError('Timed out waiting for the queue ' + queue.name)
+
+    def stop(self):
+        if self.bot is not None:
+            self.bot.stop()
+            self.bot.xmpp.abort()
+        self.homeserver.stop()
+        self.tmpdir.cleanup()
+
+    def write_config(self) -> str:
+        matrix = {
+            'server': {'base_url': self.homeserver.base_url, 'valid_cert_check': False},
+            'login': {'username': BOT_USER, 'password': 'bench'},
+            'users_to_invite': [OWNER],
+            'room_topics': {'control': CONTROL_TOPIC, 'all_chat': 'xmpp-bot-all_chat'},
+            'groupchat_flag': GROUPCHAT_FLAG,
+            'restore_room_topic': True,
+            'sync_filter': True,
+            }
+        if self.args.rate_limit:
+            matrix['rate_limit'] = {'rate': self.args.rate_limit, 'burst': self.args.rate_limit}
+        config = {
+            'matrix': matrix,
+            'xmpp': {
+                'server': {'host': self.xmpp_server.address[0], 'port': self.xmpp_server.address[1]},
+                'login': {'jid': 'bridge@bench.local', 'password': 'bench'},
+                'roster_options': {'auto_authorize': True, 'auto_subscribe': True},
+                'groupchat_nick': NICK,
+                },
+            'store_file': os.path.join(self.tmpdir.name, 'mxpp.sqlite'),
+            'outbox_file': os.path.join(self.tmpdir.name, 'mxpp.outbox'),
+            'send_presences_to_control': True,
+            'presence_digest': {'window': self.args.presence_window, 'live_table': False},
+            'send_messages_to_all_chat': self.args.all_chat,
+            'disable_all_chat_room': not self.args.all_chat,
+            'groupchat_mute_own_nick': True,
+            'send_queue': {'num_workers': self.args.workers, 'maxsize': 1000},
+            }
+        if self.args.scenario == 'backfill':
+            config['backfill'] = {'page_size': self.args.page_size, 'max_age_days': 1, 'max_queue_depth': 20}
+        if self.appservice is not None:
+            config['appservice'] = {
+                'enabled': True,
+                'as_token': self.appservice['as_token'],
+                'hs_token': self.appservice['hs_token'],
+                'host': '127.0.0.1',
+                'port': int(self.appservice['url'].rsplit(':', 1)[1]),
+                }
+        path = os.path.join(self.tmpdir.name, 'config.yaml')
+        with open(path, 'w') as conf_file:
+            yaml.safe_dump(config, conf_file)
+        return path
+
+    def has_rooms_for(self, topics: List[str]) -> bool:
+        existing = {room['state'].get(('m.room.topic', ''), {}).get('topic')
+                    for room in self.homeserver.rooms.values()}
+        return existing.issuperset(topics)
+
+    def wait(self, predicate: Callable[[], bool], what: str):
+        if not self.homeserver.wait_for(predicate, self.args.timeout):
+            raise RuntimeError('Timed out waiting for ' + what)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def report(name: str, count: int, unit: str, elapsed: float, calls: Dict[str, int], latencies: List[float]=()):
+    print('== {} =='.format(name))
+    print('{} {} in {:.2f}s: {:.1f} {}/s'.format(count, unit, elapsed, count / elapsed, unit))
+    if latencies:
+        print('latency: p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms'.format(
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, max(latencies) * 1000))
+    print('HTTP calls: {}'.format(sum(calls.values())))
+    for endpoint, count in sorted(calls.items(), key=lambda item: -item[1]):
+        print('  {:6d}  {}'.format(count, endpoint))
+
+
+def contacts(count: int) -> Dict[str, str]:
+    return {'contact{}@bench.local'.format(i): 'Contact {}'.format(i) for i in range(count)}
+
+
+def cold_start(args: argparse.Namespace):
+    """
+    First start with an empty homeserver and N roster entries: one room per contact is created.
+    """
+    roster = contacts(args.contacts)
+    bench = Bench(args, roster)
+    try:
+        start = time.monotonic()
+        bench.start()
+        bench.wait(lambda: bench.has_rooms_for(roster), 'all contact rooms')
+        report('cold_start', len(roster), 'rooms', time.monotonic() - start, bench.homeserver.calls)
+    finally:
+        bench.stop()
+
+
+def warm_restart(args: argparse.Namespace):
+    """
+    Restart with N contacts which already have their rooms: no request may be about any of them.
+    """
+    roster = contacts(args.contacts)
+    bench = Bench(args, roster)
+    try:
+        bench.start()
+        bench.wait(lambda: bench.has_rooms_for(roster), 'all contact rooms')
+        bench.idle()
+        room_ids = [bench.homeserver.room_with_topic(jid) for jid in roster]
+        bench.homeserver.calls.clear()
+        bench.homeserver.room_calls.clear()
+
+        start = time.monotonic()
+        bench.restart()
+        report('warm_restart', len(roster), 'rooms', time.monotonic() - start, bench.homeserver.calls)
+        touched = [room_id for room_id in room_ids if bench.homeserver.room_calls[room_id]]
+        if touched:
+            raise RuntimeError('Restart made requests about {} of {} contact rooms'.format(len(touched), len(roster)))
+    finally:
+        bench.stop()
+
+
+def muc_burst(args: argparse.Namespace):
+    """
+    M groupchat messages at R messages per second into one MUC the bridge already has a room for.
+    """
+    bench = Bench(args, {})
+    try:
+        bench.homeserver.add_room(BOT_USER, topic=GROUPCHAT_FLAG + MUC_JID, name=MUC_JID, members=[BOT_USER, OWNER])
+        bench.start()
+        bench.homeserver.calls.clear()
+
+        sent_at = {}
+        interval = 1 / args.rate
+        start = time.monotonic()
+        for i in range(args.messages):
+            token = 'bench-{}'.format(i)
+            sent_at[token] = time.monotonic()
+            bench.xmpp_server.send_groupchat(MUC_JID, 'alice', token)
+            time.sleep(max(0.0, start + (i + 1) * interval - time.monotonic()))
+
+        received_at = {}
+        seen = [0]
+
+        def all_received():
+            for arrival, _room_id, body in bench.homeserver.sent[seen[0]:]:
+                # Messages of a burst may arrive merged into one, a line per message
+                for line in body.get('body', '').split('\n'):
+                    received_at.setdefault(line.rsplit(' ', 1)[-1], arrival)
+            seen[0] = len(bench.homeserver.sent)
+            return all(token in received_at for token in sent_at)
+
+        bench.wait(all_received, 'all groupchat messages')
+        elapsed = max(received_at[token] for token in sent_at) - start
+        latencies = [received_at[token] - sent_at[token] for token in sent_at]
+        report('muc_burst', args.messages, 'messages', elapsed, bench.homeserver.calls, latencies)
+    finally:
+        bench.stop()
+
+
+def presence_storm(args: argparse.Namespace):
+    """
+    N contacts each going offline and online K times, as fast as the connection takes them.
+    """
+    roster = contacts(args.contacts)
+    bench = Bench(args, roster)
+    try:
+        bench.start()
+        bench.wait(lambda: bench.has_rooms_for(roster), 'all contact rooms')
+        bench.homeserver.calls.clear()
+        sent_before = len(bench.homeserver.sent)
+
+        start = time.monotonic()
+        for _ in range(args.flaps):
+            for jid in roster:
+                bench.xmpp_server.send_presence(jid, available=False)
+            for jid in roster:
+                bench.xmpp_server.send_presence(jid, available=True)
+        # Every contact ends up available, which the digest reports once
+        bench.wait(lambda: len(bench.homeserver.sent) > sent_before, 'the presence notice')
+        time.sleep(args.presence_window + 1)  # let any further notices arrive
+        elapsed = bench.homeserver.sent[-1][0] - start
+        report('presence_storm', 2 * args.flaps * len(roster), 'presences', elapsed, bench.homeserver.calls)
+        print('notices sent: {}'.format(len(bench.homeserver.sent) - sent_before))
+    finally:
+        bench.stop()
+
+
+def purge(args: argparse.Namespace):
+    """
+    `purge` in the control room with N unmapped rooms to leave.
+    """
+    bench = Bench(args, {})
+    try:
+        room_ids = [bench.homeserver.add_room(OWNER, name='Stale {}'.format(i), members=[OWNER, BOT_USER])
+                    for i in range(args.rooms)]
+        bench.start()
+        control = bench.homeserver.room_with_topic(CONTROL_TOPIC)
+        bench.homeserver.calls.clear()
+
+        start = time.monotonic()
+        bench.homeserver.inject_message(control, OWNER, 'purge')
+        bench.wait(lambda: not any(BOT_USER in bench.homeserver.joined(room_id) for room_id in room_ids),
+                   'the bridge to leave all rooms')
+        report('purge', len(room_ids), 'rooms', time.monotonic() - start, bench.homeserver.calls)
+    finally:
+        bench.stop()
+
+
+def backfill(args: argparse.Namespace):
+    """
+    A new contact with M messages in the archive, sent over the last hour: they are copied to its new room.
+    """
+    roster = contacts(1)
+    jid = next(iter(roster))
+    bench = Bench(args, roster)
+    try:
+        now = time.time()
+        tokens = ['bench-{}'.format(i) for i in range(args.messages)]
+        for i, token in enumerate(tokens):
+            bench.xmpp_server.archive(bench.xmpp_server.bare_jid, jid + '/phone', token,
+                                      timestamp=now - 3600 + i * 3600 / len(tokens))
+
+        start = time.monotonic()
+        bench.start()
+        copied = set()
+        seen = [0]
+
+        def all_copied():
+            for _arrival, _room_id, body in bench.homeserver.sent[seen[0]:]:
+                copied.update(line.rsplit(' ', 1)[-1] for line in body.get('body', '').split('\n'))
+            seen[0] = len(bench.homeserver.sent)
+            return copied.issuperset(tokens)
+
+        bench.wait(all_copied, 'all archived messages')
+        report('backfill', len(tokens), 'messages', time.monotonic() - start, bench.homeserver.calls)
+    finally:
+        bench.stop()
+
+
+SCENARIOS = {
+    'cold_start': cold_start,
+    'warm_restart': warm_restart,
+    'muc_burst': muc_burst,
+    'presence_storm': presence_storm,
+    'purge': purge,
+    'backfill': backfill,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a load benchmark against local fake servers.')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--contacts', type=int, default=100, help='roster entries (cold_start, warm_restart, presence_storm)')
+    parser.add_argument('--messages', type=int, default=500, help='groupchat messages (muc_burst), archived messages (backfill)')
+    parser.add_argument('--rate', type=float, default=50, help='groupchat messages per second (muc_burst)')
+    parser.add_argument('--flaps', type=int, default=5, help='offline/online cycles per contact (presence_storm)')
+    parser.add_argument('--rooms', type=int, default=100, help='rooms to leave (purge)')
+    parser.add_argument('--page-size', type=int, default=50, help='archive page size (backfill)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help="bridge's own request rate limit per second (0: unlimited)")
+    parser.add_argument('--server-rate-limit', type=float, default=0,
+                        help='answer 429 above this many requests per second (0: never)')
+    parser.add_argument('--workers', type=int, default=4, help='send queue workers')
+    parser.add_argument('--presence-window', type=float, default=1, help='presence digest window in seconds')
+    parser.add_argument('--all-chat', action='store_true', help='also copy messages to the all-chat room')
+    parser.add_argument('--appservice', action='store_true',
+                        help='run the bridge as an appservice; the fake homeserver pushes transactions')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for a scenario to finish')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    SCENARIOS[args.scenario](args)
+
+
+if __name__ == '__main__':
+    main()
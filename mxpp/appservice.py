@@ -0,0 +1,224 @@
+import copy
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, List, Set
+from urllib.parse import parse_qs, urlsplit
+
+from matrix_client.api import MatrixHttpApi
+from matrix_client.errors import MatrixRequestError
+from matrix_client.room import Room as MatrixRoom
+
+from mxpp.client_matrix import ClientMatrix
+from mxpp.metrics import ThreadingHTTPServer
+
+TRANSACTION_PATH = re.compile(r'(?:/_matrix/app/v1)?/transactions/([^/]+)')
+SEEN_TRANSACTIONS = 1000    # number of transaction ids remembered to ignore retries
+
+
+def escape_localpart(jid: str) -> str:
+    """
+    Turn a JID into a valid Matrix user id localpart: characters outside [a-z0-9._-] are written
+     as =xx (e.g. alice@example.com -> alice=40example.com).
+    """
+    return ''.join(c if re.match(r'[a-z0-9._\-]', c) else '={:02x}'.format(ord(c))
+                   for c in jid.lower())
+
+
+class AppService:
+    """
+    Application service side of the bridge: the homeserver pushes the events of the bridge's
+     rooms as transactions to a small HTTP listener, so there is no /sync loop.
+
+    Events sent by the bridge itself (the bot or one of its virtual users) are dropped when a
+     transaction arrives; all other events are handed to the Matrix client's rooms and listeners.
+    XMPP contacts are represented by virtual users (@<user_prefix><escaped JID>:<server>), which
+     are registered and joined to a room the first time they send a message there.
+    """
+    user_prefix = 'xmpp_'       # type: str
+
+    def __init__(self,
+                 matrix: ClientMatrix,
+                 hs_token: str,
+                 host: str='127.0.0.1',
+                 port: int=8090,
+                 user_prefix: str='xmpp_'):
+        """
+        :param matrix: Client which is logged in with the appservice's as_token (see ClientMatrix.login_appservice)
+        :param hs_token: Token the homeserver authenticates itself with
+        :param host: Address to listen on for transactions
+        :param port: Port to listen on for transactions
+        :param user_prefix: Localpart prefix of the virtual users, as in the registration's user namespace
+        """
+        self.matrix = matrix
+        self.hs_token = hs_token
+        self.user_prefix = user_prefix
+        self.server_name = matrix.user_id.split(':', 1)[1]
+
+        self._seen = OrderedDict()          # type: Dict[str, None]
+        self._registered = set()            # type: Set[str]
+        self._apis = {}                     # type: Dict[str, MatrixHttpApi]
+        self._lock = threading.Lock()       # transactions are processed one at a time, in order
+        self._serving = False
+
+        handler = type('AppServiceHandler', (_AppServiceHandler,), {'appservice': self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+
+    def serve_forever(self):
+        """
+        Process transactions until stop() is called.
+        """
+        logging.info('Listening for appservice transactions on %s:%d', *self.httpd.server_address[:2])
+        self._serving = True
+        self.httpd.serve_forever()
+
+    def stop(self):
+        if self._serving:
+            # shutdown() waits for serve_forever, forever if it never ran
+            self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def is_bridge_user(self, user_id: str) -> bool:
+        """
+        :return: True for the bot and the virtual users
+        """
+        return user_id == self.matrix.user_id or user_id.startswith('@' + self.user_prefix)
+
+    def process_transaction(self, txn_id: str, events: List[Dict]):
+        """
+        Dispatch the events of a transaction, unless it was already processed (the homeserver
+         retries transactions until it receives an answer).
+        """
+        with self._lock:
+            if txn_id in self._seen:
+                logging.debug('Ignoring repeated appservice transaction %s', txn_id)
+                return
+            for event in events:
+                if self.is_bridge_user(event.get('sender', '')) and event['type'] != 'm.room.member':
+                    continue
+                try:
+                    self.matrix.process_event(event)
+                except Exception:
+                    logging.exception('Processing event %s failed', event.get('event_id'))
+            # The transaction is acknowledged when this returns
+            if self.matrix.before_checkpoint is not None:
+                self.matrix.before_checkpoint()
+            self._seen[txn_id] = None
+            if len(self._seen) > SEEN_TRANSACTIONS:
+                self._seen.popitem(last=False)
+
+    # Virtual users
+
+    def user_id_for(self, jid: str) -> str:
+        return '@{}{}:{}'.format(self.user_prefix, escape_localpart(jid), self.server_name)
+
+    def api_for(self, user_id: str) -> MatrixHttpApi:
+        """
+        :return: API which sends requests as the given virtual user, sharing the bot's HTTP session
+        """
+        api = self._apis.get(user_id)
+        if api is None:
+            api = copy.copy(self.matrix.api)
+            api.identity = user_id
+            self._apis[user_id] = api
+        return api
+
+    def send_text_as(self, jid: str, name: str, room: MatrixRoom, text: str, txn_id: str=None) -> Dict:
+        """
+        Send a text message to a room as the virtual user of a JID. See send_message_as.
+        """
+        return self.send_message_as(jid, name, room, {'msgtype': 'm.text', 'body': text}, txn_id)
+
+    def send_message_as(self, jid: str, name: str, room: MatrixRoom, content: Dict, txn_id: str=None) -> Dict:
+        """
+        Send a message to a room as the virtual user of a JID. Registers the user and joins
+         it to the room first if necessary.
+        :param jid: Bare JID of the XMPP contact
+        :param name: Display name for the virtual user
+        :param room: Room to send to
+        :param content: Content of the m.room.message event
+        :param txn_id: (Optional) Transaction id, for messages which may be sent more than once
+        """
+        user_id = self.user_id_for(jid)
+        api = self.api_for(user_id)
+        if user_id not in self._registered:
+            self.register(user_id, name)
+        if user_id not in self.matrix.joined_members(room.room_id):
+            self.join(api, room, user_id)
+        return api.send_message_event(room.room_id, 'm.room.message', content, txn_id=txn_id)
+
+    def register(self, user_id: str, name: str):
+        localpart = user_id[1:].split(':', 1)[0]
+        try:
+            self.matrix.api._send('POST', '/register', {'type': 'm.login.application_service',
+                                                        'username': localpart})
+            logging.info('Registered virtual user %s', user_id)
+        except MatrixRequestError as e:
+            if 'M_USER_IN_USE' not in str(e.content):
+                raise
+        self.api_for(user_id).set_display_name(user_id, name)
+        self._registered.add(user_id)
+
+    def join(self, api: MatrixHttpApi, room: MatrixRoom, user_id: str):
+        if not self.matrix.is_member(room.room_id, user_id):
+            room.invite_user(user_id)
+        api.join_room(room.room_id)
+        # The join event arrives later with a transaction; don't join twice until then
+        self.matrix.members.process_event({'room_id': room.room_id, 'state_key': user_id,
+                                           'content': {'membership': 'join'}})
+
+
+class _AppServiceHandler(BaseHTTPRequestHandler):
+    appservice = None           # type: AppService
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status: int, content: Dict):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self, query: Dict) -> bool:
+        token = query.get('access_token', [None])[0]
+        header = self.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            token = header[len('Bearer '):]
+        if token is None:
+            self._respond(401, {'errcode': 'M_UNAUTHORIZED', 'error': 'Missing token'})
+            return False
+        if token != self.appservice.hs_token:
+            self._respond(403, {'errcode': 'M_FORBIDDEN', 'error': 'Invalid token'})
+            return False
+        return True
+
+    def do_PUT(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b'{}'
+        if not self._authorized(parse_qs(url.query)):
+            return
+
+        match = TRANSACTION_PATH.fullmatch(url.path)
+        if match is None:
+            self._respond(404, {'errcode': 'M_UNRECOGNIZED', 'error': 'Unrecognized request'})
+            return
+        try:
+            events = json.loads(body.decode())['events']
+        except (ValueError, KeyError):
+            self._respond(400, {'errcode': 'M_BAD_JSON', 'error': 'Invalid transaction'})
+            return
+
+        self.appservice.process_transaction(match.group(1), events)
+        self._respond(200, {})
+
+    def do_GET(self):
+        # User and room alias queries: the bridge does not create users or rooms on demand
+        if self._authorized(parse_qs(urlsplit(self.path).query)):
+            self._respond(404, {'errcode': 'M_NOT_FOUND', 'error': 'Not provided by this bridge'})
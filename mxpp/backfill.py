@@ -0,0 +1,292 @@
+import datetime
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Callable, Dict, List, Set, Tuple
+
+from sleekxmpp.exceptions import IqError, IqTimeout
+from sleekxmpp.plugins import xep_0082
+from sleekxmpp.xmlstream import ET
+from sleekxmpp.xmlstream.handler import Collector
+from sleekxmpp.xmlstream.matcher import MatchXPath
+
+from mxpp.client_xmpp import ClientXMPP
+from mxpp.send_queue import SendQueue
+from mxpp.store import RoomStore
+
+MAM_NS = 'urn:xmpp:mam:2'
+RSM_NS = 'http://jabber.org/protocol/rsm'
+FORM_NS = 'jabber:x:data'
+FORWARD_NS = 'urn:xmpp:forward:0'
+DELAY_NS = 'urn:xmpp:delay'
+STANZA_ID_NS = 'urn:xmpp:sid:0'
+CHECKPOINT_KEY = 'backfill_checkpoint:'     # room store key prefix for the last archive id in Matrix
+REMEMBER_LIVE = 1000                        # number of archive ids of live messages remembered
+
+ArchivedMessage = namedtuple('ArchivedMessage', ('id', 'stamp', 'sender', 'body'))
+
+
+def is_archive_result(message) -> bool:
+    """
+    :return: True for a message which only carries a result of an archive query
+    """
+    return message.xml.find('{%s}result' % MAM_NS) is not None
+
+
+def stanza_id(message, by: str) -> str or None:
+    """
+    :param by: Owner of the archive: our bare JID, or a group chat
+    :return: Id of the message in that archive (XEP-0359), or None if it has none
+    """
+    archive_id = None
+    for element in message.xml.iterfind('{%s}stanza-id' % STANZA_ID_NS):
+        if element.get('by') == by:
+            archive_id = element.get('id')
+    return archive_id
+
+
+def format_stamp(stamp: float) -> str:
+    return datetime.datetime.fromtimestamp(stamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Backfill:
+    """
+    Copies messages from the XMPP message archive (XEP-0313) to Matrix, to fill the gaps which
+     live bridging cannot: the history of a newly mapped contact or group chat, and what was
+     sent while the bridge was offline.
+
+    The archive is read one page (at most page_size messages) at a time, and each page is handed
+     to `write` before the next one is requested. Before every page, the backfill waits until the
+     Matrix send queue has at most max_queue_depth calls, so live messages go first.
+
+    Per JID, a checkpoint (the archive id of the last message which reached Matrix) is kept in
+     the room store. `write` may send a page later, but has to call page_written once it did; a
+     backfill which was interrupted continues after the last written page. Live messages move the
+     checkpoint too, through live(), unless pages of that JID are still being backfilled.
+    """
+    page_size = 50              # type: int
+    max_age = 7 * 24 * 3600     # type: float
+    max_queue_depth = 20        # type: int
+    timeout = 30.0              # type: float
+
+    def __init__(self,
+                 xmpp: ClientXMPP,
+                 store: RoomStore,
+                 send_queue: SendQueue,
+                 write: Callable[[str, List[ArchivedMessage], str], None],
+                 page_size: int=50,
+                 max_age_days: float=7,
+                 max_queue_depth: int=20,
+                 timeout: float=30.0):
+        """
+        :param xmpp: XMPP client
+        :param store: Room store for the checkpoints
+        :param send_queue: Matrix send queue, whose depth throttles the backfill
+        :param write: Called with (jid, messages, archive id of the last message) for every page
+        :param page_size: Maximum number of messages per page
+        :param max_age_days: How far back the history of a new contact or group chat is copied
+        :param max_queue_depth: Send queue depth above which no further page is requested
+        :param timeout: Seconds to wait for a page
+        """
+        self.xmpp = xmpp
+        self.store = store
+        self.send_queue = send_queue
+        self.write = write
+        self.page_size = page_size
+        self.max_age = max_age_days * 24 * 3600
+        self.max_queue_depth = max_queue_depth
+        self.timeout = timeout
+
+        # JID -> 1 while its backfill runs, plus 1 for each page which was not written yet
+        self._running = {}                  # type: Dict[str, int]
+        self._live_ids = OrderedDict()      # type: Dict[str, None]
+        # JIDs with a page which could not be written; the checkpoint stays before it until the next backfill
+        self._failed = set()                # type: Set[str]
+        self._lock = threading.Lock()
+        self._stopped = False
+        # One backfill at a time; the pages of one JID are requested in order
+        self._jobs = SendQueue(num_workers=1, name='backfill')
+        self._jobs.start()
+
+    @property
+    def depth(self) -> int:
+        """
+        :return: Number of JIDs which are being or waiting to be backfilled
+        """
+        return self._jobs.depth
+
+    def queue(self, jid: str, groupchat: bool=False, new: bool=False):
+        """
+        Queue a backfill of a JID: from its checkpoint, or for a new contact or group chat, of
+         the last max_age seconds. Does nothing for a JID without checkpoint which is not new.
+        :param jid: Bare JID of a contact or group chat
+        :param groupchat: True for a group chat, whose own archive is read
+        :param new: True if the JID was just mapped to a room
+        """
+        if new or self.checkpoint(jid) is not None:
+            self._jobs.put(jid, self._backfill, jid, groupchat)
+
+    def stop(self):
+        """
+        Stop after the backfill which is running; the others continue from their checkpoints next time.
+        """
+        self._stopped = True
+        self._jobs.stop()
+
+    def checkpoint(self, jid: str) -> str or None:
+        return self.store.get_value(CHECKPOINT_KEY + jid)
+
+    def page_written(self, jid: str, archive_id: str or None):
+        """
+        Move the checkpoint after a page which was handed to `write` reached Matrix.
+        :param archive_id: Archive id of the page's last message, None if the page could not be sent
+        """
+        with self._lock:
+            if archive_id is None:
+                self._failed.add(jid)
+            # Pages after a failed one were written, but the checkpoint must not skip the failed page
+            move = archive_id is not None and jid not in self._failed
+        if move:
+            self.store.set_value(CHECKPOINT_KEY + jid, archive_id)
+        self._release(jid)
+
+    def forget(self, jid: str):
+        self.store.set_value(CHECKPOINT_KEY + jid, None)
+
+    def live(self, jid: str, message, archive_jid: str):
+        """
+        Note a live message which was bridged, so the backfill skips it and continues after it.
+        :param jid: Bare JID of the contact or group chat
+        :param message: The message
+        :param archive_jid: Owner of the archive which holds it: our bare JID, or the group chat
+        """
+        archive_id = stanza_id(message, archive_jid)
+        if archive_id is None:
+            return
+        with self._lock:
+            self._live_ids[archive_id] = None
+            if len(self._live_ids) > REMEMBER_LIVE:
+                self._live_ids.popitem(last=False)
+            if jid in self._running or jid in self._failed:
+                # The backfill ends at its start time and moves the checkpoint itself
+                return
+        self.store.set_value(CHECKPOINT_KEY + jid, archive_id)
+
+    # Internals
+
+    def _acquire(self, jid: str):
+        with self._lock:
+            self._running[jid] = self._running.get(jid, 0) + 1
+
+    def _release(self, jid: str):
+        with self._lock:
+            self._running[jid] -= 1
+            if not self._running[jid]:
+                del self._running[jid]
+
+    def _backfill(self, jid: str, groupchat: bool):
+        with self._lock:
+            self._failed.discard(jid)
+        after = self.checkpoint(jid)
+        start = time.time() - self.max_age if after is None else None
+        end = time.time()
+        self._acquire(jid)
+        logging.info('Backfilling %s from %s', jid, after or format_stamp(start))
+        copied = 0
+        try:
+            while True:
+                self.send_queue.wait_for_depth(self.max_queue_depth)
+                with self._lock:
+                    if jid in self._failed:
+                        logging.warning('Backfill of %s stopped after %d messages: a page could not be sent',
+                                        jid, copied)
+                        return
+                messages, last, complete = self._fetch_page(jid, groupchat, after, start, end)
+                if last is not None:
+                    with self._lock:
+                        messages = [message for message in messages if message.id not in self._live_ids]
+                    self._acquire(jid)
+                    try:
+                        self.write(jid, messages, last)
+                    except Exception:
+                        # The page never reaches page_written, which would release it
+                        self._release(jid)
+                        raise
+                    copied += len(messages)
+                    after = last
+                if complete or last is None or self._stopped:
+                    break
+        except (IqError, IqTimeout) as e:
+            # The checkpoint stays at the last page which was written; the next session continues there
+            logging.warning('Backfill of %s stopped after %d messages: %s', jid, copied, e)
+            return
+        finally:
+            self._release(jid)
+        logging.info('Backfilled %d messages from %s', copied, jid)
+
+    def _fetch_page(self, jid: str, groupchat: bool, after: str or None, start: float or None,
+                    end: float) -> Tuple[List[ArchivedMessage], str or None, bool]:
+        """
+        Request one page of the archive.
+        :return: (messages, archive id of the last message or None if the page is empty, True if it was the last page)
+        """
+        iq = self.xmpp.Iq()
+        iq['type'] = 'set'
+        if groupchat:
+            iq['to'] = jid
+        query_id = iq['id']
+
+        query = ET.Element('{%s}query' % MAM_NS, {'queryid': query_id})
+        form = ET.SubElement(query, '{%s}x' % FORM_NS, {'type': 'submit'})
+        fields = [('FORM_TYPE', MAM_NS), ('end', format_stamp(end))]
+        if not groupchat:
+            fields.append(('with', jid))
+        if start is not None:
+            fields.append(('start', format_stamp(start)))
+        for var, value in fields:
+            field = ET.SubElement(form, '{%s}field' % FORM_NS, {'var': var})
+            if var == 'FORM_TYPE':
+                field.attrib['type'] = 'hidden'
+            ET.SubElement(field, '{%s}value' % FORM_NS).text = value
+        rsm = ET.SubElement(query, '{%s}set' % RSM_NS)
+        ET.SubElement(rsm, '{%s}max' % RSM_NS).text = str(self.page_size)
+        if after is not None:
+            ET.SubElement(rsm, '{%s}after' % RSM_NS).text = after
+        iq.append(query)
+
+        # Collected as they are read, so all results are there when the answer to the query arrives
+        collector = Collector('Backfill ' + query_id,
+                              MatchXPath('{%s}message/{%s}result' % (self.xmpp.default_ns, MAM_NS)))
+        self.xmpp.register_handler(collector)
+        try:
+            response = iq.send(timeout=self.timeout)
+        finally:
+            results = collector.stop()
+
+        messages = []   # type: List[ArchivedMessage]
+        for message in results:
+            result = message.xml.find('{%s}result' % MAM_NS)
+            if result.get('queryid') == query_id:
+                archived = self._parse_result(result)
+                if archived is not None:
+                    messages.append(archived)
+
+        fin = response.xml.find('{%s}fin' % MAM_NS)
+        if fin is None:
+            return messages, None, True
+        last = fin.findtext('{%s}set/{%s}last' % (RSM_NS, RSM_NS))
+        return messages, last, fin.get('complete') in ('true', '1')
+
+    def _parse_result(self, result: ET.Element) -> ArchivedMessage or None:
+        forwarded = result.find('{%s}forwarded' % FORWARD_NS)
+        if forwarded is None:
+            return None
+        message = forwarded.find('{%s}message' % self.xmpp.default_ns)
+        body = None if message is None else message.findtext('{%s}body' % self.xmpp.default_ns)
+        if not body:
+            # e.g. chat states, receipts
+            return None
+        delay = forwarded.find('{%s}delay' % DELAY_NS)
+        stamp = time.time() if delay is None else xep_0082.parse(delay.get('stamp')).timestamp()
+        return ArchivedMessage(result.get('id'), stamp, message.get('from', ''), body)
@@ -0,0 +1,273 @@
+import time
+from typing import Callable, Dict, Iterable, List, Set
+
+from matrix_client.client import MatrixClient
+from matrix_client.errors import MatrixRequestError
+from matrix_client.room import Room as MatrixRoom
+from requests.adapters import HTTPAdapter
+
+from mxpp.membership import MembershipIndex
+from mxpp.metrics import Metrics
+from mxpp.ratelimit import TokenBucket, RateLimitedSession
+from mxpp.store import RoomStore
+
+# Event types the bridge reacts to; everything else is left out of /sync when a sync filter is used
+TIMELINE_EVENT_TYPES = ['m.room.message', 'm.room.topic', 'm.room.name', 'm.room.member']
+STATE_EVENT_TYPES = ['m.room.topic', 'm.room.name', 'm.room.member']
+
+
+class ClientMatrix(MatrixClient):
+    bucket = None               # type: TokenBucket
+    store = None                # type: RoomStore
+    members = None              # type: MembershipIndex
+    synced_at = None            # type: float
+    before_checkpoint = None    # type: Callable[[], None]
+    lazy_members = False        # type: bool
+
+    def __init__(self,
+                 base_url: str,
+                 valid_cert_check: bool=True,
+                 rate_limit: Dict[str, float]=None,
+                 store: RoomStore=None,
+                 metrics: Metrics=None,
+                 pool_size: int=10,
+                 adapter: HTTPAdapter=None,
+                 before_checkpoint: Callable[[], None]=None,
+                 **kwargs):
+        """
+        :param base_url: Homeserver base url, without trailing /
+        :param valid_cert_check: Verify the homeserver's TLS certificate
+        :param rate_limit: (Optional) Arguments for TokenBucket (rate, burst); unlimited if not given
+        :param store: (Optional) Store in which the sync position is saved after every sync
+        :param metrics: (Optional) Metrics in which every request to the homeserver is counted and timed
+        :param pool_size: Number of connections kept open to the homeserver; at least the number of
+                          threads which send requests at the same time
+        :param adapter: (Optional) HTTP adapter shared with other clients of the same homeserver,
+                        instead of a connection pool of pool_size connections for this client
+        :param before_checkpoint: (Optional) Called after the events of a sync (or appservice transaction)
+                                  were handed to the listeners, before the homeserver is told they need
+                                  not be sent again; e.g. to wait until they are journaled
+        """
+        self.members = MembershipIndex()
+        MatrixClient.__init__(self, base_url, valid_cert_check=valid_cert_check, **kwargs)
+        self.store = store
+        self.before_checkpoint = before_checkpoint
+        self.add_leave_listener(lambda room_id, _room: self.members.forget(room_id))
+        # Room summaries are not handled by MatrixClient._sync; they are taken from the response here
+        self._summaries = {}    # type: Dict[str, Dict]
+        self._api_sync = self.api.sync
+        self.api.sync = self._sync_request
+
+        # Every request made through self.api (including those made by Room objects) is paced here
+        self.bucket = TokenBucket(**(rate_limit or {}))
+        self.api.session = RateLimitedSession(self.bucket, metrics, pool_size, adapter)
+
+    def create_room(self,
+                    alias: str=None,
+                    is_public: bool=False,
+                    invitees: List[str]=None,
+                    name: str=None,
+                    topic: str=None) -> MatrixRoom:
+        """
+        Create a room with its name, topic and invitations in a single /createRoom request.
+
+        :param alias: (Optional) Local part of the room alias
+        :param is_public: Make the room public
+        :param invitees: (Optional) Matrix users to invite
+        :param name: (Optional) Room name
+        :param topic: (Optional) Room topic
+        :return: Room which was created
+        """
+        content = {
+            'visibility': 'public' if is_public else 'private',
+            }
+        if alias:
+            content['room_alias_name'] = alias
+        if invitees:
+            content['invite'] = list(invitees)
+        if name:
+            content['name'] = name
+        if topic:
+            content['initial_state'] = [{
+                'type': 'm.room.topic',
+                'state_key': '',
+                'content': {'topic': topic},
+                }]
+
+        response = self.api._send('POST', '/createRoom', content)
+        room = self._mkroom(response['room_id'])
+        room.name = name
+        room.topic = topic
+        self.members.set_members(room.room_id, [self.user_id], invitees or [])
+        return room
+
+    def refresh_members(self, room_id: str):
+        """
+        Load the full member list of a room into the membership index.
+        """
+        response = self.api.get_room_members(room_id)
+        joined = [event['state_key'] for event in response['chunk'] if event['content']['membership'] == 'join']
+        invited = [event['state_key'] for event in response['chunk'] if event['content']['membership'] == 'invite']
+        self.members.set_members(room_id, joined, invited)
+
+    def joined_members(self, room_id: str) -> Set[str]:
+        """
+        :return: Ids of the users which joined the room. The full member list is only loaded the
+                 first time a room is asked for; after that, it is kept up to date by the sync.
+                 For the number of members, use members.joined_count, which never loads the list.
+        """
+        if not self.members.is_complete(room_id):
+            self.refresh_members(room_id)
+        return self.members.joined(room_id)
+
+    def is_member(self, room_id: str, user_id: str) -> bool:
+        """
+        :return: True if the user joined or was invited to the room. The full member list is only
+                 loaded if the sync did not show that already. See joined_members.
+        """
+        if self.members.is_member(room_id, user_id):
+            return True
+        if not self.members.is_complete(room_id):
+            self.refresh_members(room_id)
+        return self.members.is_member(room_id, user_id)
+
+    def resume(self, token: str, sync_token: str, room_ids: Iterable[str]) -> bool:
+        """
+        Continue a previous session instead of logging in and doing a full initial sync.
+
+        The next sync only returns what changed since sync_token. Room objects are created for
+         room_ids, since an incremental sync does not mention rooms without news.
+        :param token: Access token of the previous session
+        :param sync_token: next_batch token of the last completed sync
+        :param room_ids: Ids of the rooms which were joined in the previous session
+        :return: False if the homeserver no longer accepts the access token
+        """
+        self.api.token = token
+        try:
+            response = self.api.whoami()
+        except MatrixRequestError as e:
+            if e.code not in (401, 403):
+                raise
+            self.api.token = None
+            return False
+
+        self.token = token
+        self.user_id = response['user_id']
+        self.sync_token = sync_token
+        for room_id in room_ids:
+            if room_id not in self.rooms:
+                self._mkroom(room_id)
+        return True
+
+    def login_appservice(self, as_token: str, user_id: str):
+        """
+        Act as the bot user of an application service instead of logging in. There is no sync;
+         Room objects are created for the rooms the bot is in, and events arrive through process_event.
+        :param as_token: The appservice's as_token
+        :param user_id: The appservice's bot user (sender_localpart)
+        """
+        self.api.token = as_token
+        self.token = as_token
+        self.user_id = user_id
+        response = self.api._send('GET', '/joined_rooms')
+        for room_id in response['joined_rooms']:
+            if room_id not in self.rooms:
+                self._mkroom(room_id)
+
+    def process_event(self, event: Dict):
+        """
+        Dispatch an event pushed by the homeserver (appservice mode) the way a sync would:
+         to the leave and invite listeners for the bot's own membership, otherwise to the room
+         and global listeners.
+        :param event: Room event, with room_id
+        """
+        room_id = event['room_id']
+        if event['type'] == 'm.room.member' and event.get('state_key') == self.user_id:
+            membership = event['content'].get('membership')
+            if membership in ('leave', 'ban'):
+                for listener in self.left_listeners:
+                    listener(room_id, {'timeline': {'events': [event]}})
+                if event['sender'] != self.user_id:
+                    # Room.leave() removes the room itself, possibly after this event arrived
+                    self.rooms.pop(room_id, None)
+                return
+            if membership == 'invite':
+                for listener in self.invite_listeners:
+                    listener(room_id, {'events': [event]})
+                return
+
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self._mkroom(room_id)
+        room._put_event(event)
+        for listener in self.listeners:
+            if listener['event_type'] is None or listener['event_type'] == event['type']:
+                listener['callback'](event)
+
+    def set_sync_filter(self, timeline_limit: int=20):
+        """
+        Register a sync filter which only asks for what the bridge uses: messages, topics, names and
+         (lazy-loaded) memberships, without presence, typing notifications, receipts or account data.
+        With lazy-loaded members, the number of joined members of each room comes from the room
+         summaries of the sync instead; it is saved in the store, since a sync only sends the
+         summary of a room when it changed.
+
+        Must be called after logging in; applies to all following syncs.
+        :param timeline_limit: Maximum number of timeline events per room and sync; older events of a
+                               room which got more in one sync are not bridged, so this should not be
+                               lower than matrix_client's default of 20
+        """
+        nothing = {'not_types': ['*']}
+        sync_filter = {
+            'presence': nothing,
+            'account_data': nothing,
+            'room': {
+                'ephemeral': nothing,
+                'account_data': nothing,
+                'state': {
+                    'types': STATE_EVENT_TYPES,
+                    'lazy_load_members': True,
+                    },
+                'timeline': {
+                    'types': TIMELINE_EVENT_TYPES,
+                    'limit': timeline_limit,
+                    'lazy_load_members': True,
+                    },
+                },
+            }
+        response = self.api.create_filter(self.user_id, sync_filter)
+        self.sync_filter = response['filter_id']
+        self.lazy_members = True
+        if self.store is not None:
+            for room_id, count in self.store.member_counts().items():
+                self.members.set_joined_count(room_id, count)
+
+    def _mkroom(self, room_id):
+        room = MatrixClient._mkroom(self, room_id)
+        room.add_state_listener(self.members.process_event, 'm.room.member')
+        return room
+
+    def _sync_request(self, since: str=None, *args, **kwargs) -> Dict:
+        response = self._api_sync(since, *args, **kwargs)
+        self._summaries = {room_id: sync_room.get('summary', {})
+                           for room_id, sync_room in response.get('rooms', {}).get('join', {}).items()}
+        return response
+
+    def _sync(self, timeout_ms=30000):
+        initial = self.sync_token is None
+        MatrixClient._sync(self, timeout_ms)
+        self.synced_at = time.time()
+        # After the member events of the sync, which the summaries already count
+        for room_id, summary in self._summaries.items():
+            if 'm.joined_member_count' in summary:
+                self.members.set_joined_count(room_id, summary['m.joined_member_count'])
+            elif initial and not self.lazy_members:
+                # Without lazy loading, the initial sync holds every member event
+                self.members.set_members(room_id, self.members.joined(room_id), self.members.invited(room_id))
+        if self.lazy_members and self.store is not None and self._summaries:
+            counts = [(room_id, self.members.joined_count(room_id)) for room_id in self._summaries]
+            self.store.set_member_counts((room_id, count) for room_id, count in counts if count is not None)
+        if self.before_checkpoint is not None:
+            self.before_checkpoint()
+        if self.store is not None:
+            self.store.set_value('next_batch', self.sync_token)
@@ -1,21 +1,53 @@
 import logging
+import threading
+from collections import deque
+from typing import Dict, Set
 
 import sleekxmpp
 from sleekxmpp.exceptions import IqError, IqTimeout
+from sleekxmpp.plugins.xep_0198 import Enabled, Resumed
+from sleekxmpp.plugins.xep_0198.stream_management import MAX_SEQ
+from sleekxmpp.stanza import Iq, Message, Presence
 
 
 class ClientXMPP(sleekxmpp.ClientXMPP):
-    roster_dict = {}
-    jid_nick_map = {}
+    """
+    With stream management, a received message only counts as handled (in the acknowledgements
+     sent to the server) once message_handled was called for it, so messages which were not
+     saved yet are sent again by the server when the stream is resumed. Stanzas received after a
+     message which is not handled yet are held back with it, since the server counts them in order.
+    The 'message' handler has to call message_handled once for every message, in the order they
+     arrived (sleekxmpp runs event handlers in order, in one thread).
+    """
+    roster_dict = None          # type: Dict[str, Dict]
+    jid_nick_map = None         # type: Dict[str, str]
+    keepalive_interval = 30     # type: float
+    keepalive_timeout = 10      # type: float
 
     def __init__(self,
                  jid: str,
                  password: str,
                  auto_authorize: bool=True,
-                 auto_subscribe: bool=True):
+                 auto_subscribe: bool=True,
+                 keepalive_interval: float=30,
+                 keepalive_timeout: float=10,
+                 stream_management: bool=True):
+        """
+        :param keepalive_interval: Seconds between pings to the server; 0 disables them
+        :param keepalive_timeout: Seconds without an answer to a ping after which the connection
+                                  is considered dead and reconnected
+        :param stream_management: Use XEP-0198, so a dropped stream is resumed with its session
+                                  (roster, presence, MUCs) and unacknowledged stanzas are sent again
+        """
         sleekxmpp.ClientXMPP.__init__(self, jid, password)
+        self.roster_dict = {}
+        self.jid_nick_map = {}
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_timeout = keepalive_timeout
 
         self.add_event_handler('session_start', self.session_start)
+        self.add_event_handler('session_resumed', self.session_resumed)
+        self.add_event_handler('sm_failed', self.sm_failed)
         self.add_event_handler('disconnected', self.disconnected)
 
         self.register_plugin('xep_0030')  # Service Discovery
@@ -23,10 +55,75 @@ class ClientXMPP(sleekxmpp.ClientXMPP):
         self.register_plugin('xep_0060')  # PubSub
         self.register_plugin('xep_0199')  # XMPP Ping
         self.register_plugin('xep_0045')  # Multi-User Chats (MUC)
+        self.register_plugin('xep_0203')  # Delayed Delivery (timestamps of MUC history)
+        self.register_plugin('xep_0066')  # Out of Band Data (attachment URLs)
+        # Messages with a body (which sleekxmpp raises 'message' events for) which were not handled yet:
+        #  [stream, stanzas counted with it]; see message_handled
+        self._unhandled = deque()   # type: deque
+        self._stream = 0            # new streams (enabled or resumed) since the start
+        self._resumed = set()       # type: Set[int]
+        self._handled_lock = threading.Lock()
+        if stream_management:
+            self.register_plugin('xep_0198', {'allow_resume': True})  # Stream Management
+            # Count handled stanzas here instead of when they arrive
+            self.del_filter('in', self.plugin['xep_0198']._handle_incoming)
+            self.add_filter('in', self._count_incoming)
 
         self.auto_authorize = auto_authorize
         self.auto_subscribe = auto_subscribe
 
+    def stream_managed(self) -> bool:
+        """
+        :return: True if the server acknowledges the stanzas of the current stream (XEP-0198)
+        """
+        return 'xep_0198' in self.plugin and self.plugin['xep_0198'].enabled.is_set()
+
+    def message_handled(self):
+        """
+        Count the oldest message which was not handled yet as handled, with the stanzas received
+         after it up to the next message. Must be called once for each 'message' event, in order.
+        """
+        with self._handled_lock:
+            if not self._unhandled:
+                return
+            stream, count = self._unhandled.popleft()
+            if stream == self._stream:
+                self._add_handled(count)
+
+    def message_resent(self) -> bool:
+        """
+        :return: True if the oldest message which was not handled yet arrived on a stream which has
+                 been resumed since; the server sent it again, so this copy can be dropped
+        """
+        with self._handled_lock:
+            if not self._unhandled or self._unhandled[0][0] is None:
+                return False
+            return self._unhandled[0][0] + 1 in self._resumed
+
+    def _count_incoming(self, stanza):
+        with self._handled_lock:
+            if isinstance(stanza, (Enabled, Resumed)):
+                # The counter starts again (at 0 for a new stream); messages still waiting for
+                #  their handler are left out of it, and resent by the server after a resume
+                self._stream += 1
+                if isinstance(stanza, Resumed):
+                    self._resumed.add(self._stream)
+            elif isinstance(stanza, Message) and stanza.xml.find('{%s}body' % self.default_ns) is not None:
+                # Tracked even without stream management, to keep the order of message_handled
+                stream = self._stream if self.plugin['xep_0198'].enabled.is_set() else None
+                self._unhandled.append([stream, 1])
+            elif isinstance(stanza, (Message, Presence, Iq)) and self.plugin['xep_0198'].enabled.is_set():
+                if self._unhandled and self._unhandled[-1][0] == self._stream:
+                    self._unhandled[-1][1] += 1
+                else:
+                    self._add_handled(1)
+        return stanza
+
+    def _add_handled(self, count: int):
+        sm = self.plugin['xep_0198']
+        with sm.handled_lock:
+            sm.handled = (sm.handled + count) % MAX_SEQ
+
     def session_start(self, _event):
         try:
             try:
@@ -47,7 +144,32 @@ class ClientXMPP(sleekxmpp.ClientXMPP):
             logging.error('Server is taking too long to respond')
             self.disconnect()
 
+        self.start_liveness_check()
         logging.info('XMPP Logged in!')
 
-    def disconnected(self):
+    def session_resumed(self, _event):
+        self.start_liveness_check()
+        logging.info('XMPP stream resumed')
+
+    def sm_failed(self, _event):
+        logging.info('XMPP stream could not be resumed, starting a new session')
+
+    def disconnected(self, _event):
+        self.scheduler.remove('Liveness ping')
         logging.info('XMPP Disconnected!')
+
+    def start_liveness_check(self):
+        """
+        Ping the server every keepalive_interval seconds (sleekxmpp's own keepalive ends the session
+         when a ping times out, which would make resuming the stream impossible).
+        """
+        if self.keepalive_interval:
+            self.schedule('Liveness ping', self.keepalive_interval, self.check_liveness, repeat=True)
+
+    def check_liveness(self):
+        try:
+            self.plugin['xep_0199'].ping(self.boundjid.host, timeout=self.keepalive_timeout)
+        except IqTimeout:
+            logging.warning('XMPP server did not answer a ping within %ss, reconnecting', self.keepalive_timeout)
+            # The connection is dead: don't send a stream close, so the session can be resumed
+            self.reconnect(send_close=False)
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Set
+
+
+class BurstCoalescer:
+    """
+    Merges messages to the same room which arrive in a burst.
+
+    While a room receives at most `threshold` messages per second, every message is sent on its
+     own. Above that, messages are collected for `window` seconds and handed to `flush` together,
+     until the rate drops again.
+    """
+    threshold = 2.0             # type: float
+    window = 1.0                # type: float
+
+    def __init__(self, flush: Callable[[str, List[Any]], None], threshold: float=2.0, window: float=1.0):
+        """
+        :param flush: Called with (key, items) for every collected burst
+        :param threshold: Messages per second above which messages are merged
+        :param window: Seconds to collect messages for one merged message; also the time over
+                       which the rate is measured
+        """
+        self.flush_callback = flush
+        self.threshold = threshold
+        self.window = window
+
+        self._arrivals = {}         # type: Dict[str, Deque[float]]
+        self._buffers = {}          # type: Dict[str, List[Any]]
+        self._flushing = set()      # type: Set[str]
+        self._cond = threading.Condition()
+
+    def add(self, key: str, item: Any) -> bool:
+        """
+        Count a message, and take it into a burst if the rate is above the threshold.
+
+        :param key: Room the message is sent to
+        :param item: Message, passed to flush
+        :return: True if the message will be sent by flush, False if it should be sent on its own
+        """
+        now = time.monotonic()
+        with self._cond:
+            arrivals = self._arrivals.setdefault(key, deque())
+            arrivals.append(now)
+            while arrivals[0] < now - self.window:
+                arrivals.popleft()
+
+            if key in self._buffers:
+                # Keep the order: nothing overtakes a burst which is being collected
+                self._buffers[key].append(item)
+                return True
+            if len(arrivals) <= self.threshold * self.window:
+                return False
+
+            self._buffers[key] = [item]
+            timer = threading.Timer(self.window, self.flush, (key,))
+            timer.daemon = True
+            timer.start()
+            return True
+
+    def is_collecting(self, key: str) -> bool:
+        """
+        :return: True while messages are collected for a room, or handed to flush; a message which
+                 is sent on its own has to call flush first, so it does not overtake them
+        """
+        with self._cond:
+            return key in self._buffers or key in self._flushing
+
+    def flush(self, key: str):
+        """
+        Hand the messages collected for a room to flush now, after a flush of the room which is
+         still running. Does nothing if there are none.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: key not in self._flushing)
+            items = self._buffers.pop(key, None)
+            if not items:
+                return
+            self._flushing.add(key)
+        try:
+            self.flush_callback(key, items)
+        finally:
+            with self._cond:
+                self._flushing.discard(key)
+                self._cond.notify_all()
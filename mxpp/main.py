@@ -1,16 +1,33 @@
+import hashlib
 import logging
-from typing import Dict, Tuple, List
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Tuple, List, Set
 
 import sleekxmpp
 import requests
 import yaml
 
-from matrix_client.client import MatrixClient
-from matrix_client.errors import MatrixError
+from matrix_client.errors import MatrixError, MatrixRequestError
+from sleekxmpp.exceptions import IqError, IqTimeout
 from matrix_client.room import Room as MatrixRoom
+from requests.adapters import HTTPAdapter
+from mxpp.appservice import AppService
+from mxpp.backfill import ArchivedMessage, Backfill, is_archive_result, stanza_id
+from mxpp.client_matrix import ClientMatrix
 from mxpp.client_xmpp import ClientXMPP
+from mxpp.coalesce import BurstCoalescer
+from mxpp.media import MEDIA_MSGTYPES, MediaBridge, MediaCache, MediaTooLarge, oob_url
+from mxpp.metrics import Metrics, MetricsServer
+from mxpp.muc import MucJoiner, MucJoinError
+from mxpp.outbox import Outbox, TO_MATRIX, TO_XMPP
+from mxpp.presence import PresenceDigest
+from mxpp.registry import RoomRegistry
+from mxpp.send_queue import SendQueue
+from mxpp.store import RoomStore
 
 CONFIG_FILE = 'config.yaml'
+MATRIX_RETRY_DELAY = 10  # seconds between attempts to reconnect to Matrix
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(levelname)-8s %(message)s')
@@ -18,29 +35,65 @@ logging.getLogger(sleekxmpp.__name__).setLevel(logging.ERROR)
 logging.getLogger(requests.__name__).setLevel(logging.ERROR)
 
 
+def read_config(path: str) -> Dict:
+    with open(path, 'r') as conf_file:
+        return yaml.safe_load(conf_file)
+
+
 class BridgeBot:
     xmpp = None                        # type: ClientXMPP
-    matrix = None                      # type: MatrixClient
-    topic_room_id_map = None           # type: Dict[str, str]
-    special_rooms = None               # type: Dict[str, MatrixRoom]
+    matrix = None                      # type: ClientMatrix
+    appservice = None                  # type: AppService
+    send_queue = None                  # type: SendQueue
+    tasks = None                       # type: SendQueue
+    dispatcher = None                  # type: SendQueue
+    metrics = None                     # type: Metrics
+    metrics_server = None              # type: MetricsServer
+    store = None                       # type: RoomStore
+    outbox = None                      # type: Outbox
+    coalescer = None                   # type: BurstCoalescer
+    muc_joiner = None                  # type: MucJoiner
+    backfill = None                    # type: Backfill
+    media = None                       # type: MediaBridge
+    registry = None                    # type: RoomRegistry
+    presence_digest = None             # type: PresenceDigest
+    presence_table_event_id = None     # type: str
+    roster_snapshot = None             # type: Dict[str, str]
     special_room_names = None          # type: Dict[str, str]
     groupchat_flag = None              # type: str
-    groupchat_jids = None              # type: List[str]
     restore_room_topic = True          # type: bool
+    stopped = False                    # type: bool
 
     users_to_invite = None             # type: List[str]
     matrix_room_topics = None          # type: Dict[str, str]
     matrix_server = None               # type: Dict[str, str]
+    matrix_rate_limit = None           # type: Dict[str, float]
+    http_adapter = None                # type: HTTPAdapter
+    provision_workers = 8              # type: int
+    dispatch_workers = 4               # type: int
+    use_sync_filter = True             # type: bool
+    sync_timeline_limit = 20           # type: int
     matrix_login = None                # type: Dict[str, str]
     xmpp_server = None                 # type: Tuple[str, int]
     xmpp_login = None                  # type: Dict[str, str]
     xmpp_roster_options = None         # type: Dict[str, bool]
+    xmpp_connection_options = None     # type: Dict[str, float]
     xmpp_groupchat_nick = None         # type: str
 
     send_messages_to_all_chat = True   # type: bool
     disable_all_chat_room = False      # type: bool
     send_presences_to_control = True   # type: bool
+    presence_digest_options = None     # type: Dict[str, float]
     groupchat_mute_own_nick = True     # type: bool
+    groupchat_coalesce = None          # type: Dict[str, float]
+    muc_join_options = None            # type: Dict[str, float]
+    backfill_options = None            # type: Dict[str, float]
+    media_options = None               # type: Dict[str, str]
+    send_queue_options = None          # type: Dict[str, int]
+    store_file = 'mxpp.sqlite'         # type: str
+    outbox_file = 'mxpp.outbox'        # type: str
+    metrics_options = None             # type: Dict[str, str]
+    appservice_options = None          # type: Dict[str, str]
 
     disabled_jids = set()             # type: Set[str]
 
@@ -48,82 +101,148 @@ class BridgeBot:
     def bot_id(self) -> str:
         return self.matrix_login['username']
 
-    def __init__(self, config_file: str=CONFIG_FILE):
-        self.groupchat_jids = []
-        self.topic_room_id_map = {}
-        self.special_rooms = {
-                'control': None,
-                'all_chat': None,
-                }
+    def __init__(self, config_file: str=CONFIG_FILE, config: Dict=None, http_adapter: HTTPAdapter=None):
+        """
+        :param config_file: Path of the config file
+        :param config: (Optional) Parsed config, used instead of reading config_file
+        :param http_adapter: (Optional) HTTP adapter whose connections to the homeserver are shared
+                             with other bots in the same process (see mxpp.runner)
+        """
+        self.roster_snapshot = {}
         self.special_room_names = {
                 'control': 'XMPP Control Room',
                 'all_chat': 'XMPP All Chat',
                 }
         self.xmpp_roster_options = {}
+        self.xmpp_connection_options = {}
+        self.send_queue_options = {}
+        self.presence_digest_options = {}
+        self.muc_join_options = {}
+        self.metrics_options = {}
+        self.appservice_options = {}
+
+        if config is None:
+            config = read_config(config_file)
+        self.load_config(config)
+        self.http_adapter = http_adapter
+        try:
+            self.setup()
+        except Exception:
+            # e.g. the homeserver is down: release the ports, threads and files, so the bot can be created again
+            self.stop()
+            raise
 
-        self.load_config(config_file)
-
-        self.matrix = MatrixClient(**self.matrix_server)
-        self.xmpp = ClientXMPP(**self.xmpp_login, **self.xmpp_roster_options)
-
-        self.matrix.login_with_password(**self.matrix_login)
+    def setup(self):
+        """
+        Start the queues, log in to Matrix, restore the rooms and connect to XMPP.
+        """
+        self.metrics = Metrics()
+        if self.metrics_options.pop('enabled', False):
+            self.metrics_server = MetricsServer(self.metrics, **self.metrics_options)
+            self.metrics_server.start()
+
+        self.store = RoomStore(self.store_file)
+        self.outbox = Outbox(self.outbox_file)
+        self.send_queue = SendQueue(**self.send_queue_options)
+        self.send_queue.start()
+        # Slow work (room provisioning, control commands) runs here instead of in the XMPP and
+        #  Matrix event threads, so those keep handling messages in the meantime
+        self.tasks = SendQueue(num_workers=3, name='bridge-tasks')
+        self.tasks.start()
+        # Messages from Matrix are handled here, in order per room, so the sync thread goes back to
+        #  long-polling as soon as it handed them over
+        self.dispatcher = SendQueue(num_workers=self.dispatch_workers, name='matrix-dispatch')
+        self.dispatcher.start()
+        self.presence_digest = PresenceDigest(self.publish_presences, **self.presence_digest_options)
+        if self.groupchat_coalesce is not None:
+            self.coalescer = BurstCoalescer(self.queue_burst, **self.groupchat_coalesce)
+
+        # One pooled connection for each thread which may talk to the homeserver at the same time
+        pool_size = self.send_queue.num_workers + self.tasks.num_workers + self.provision_workers + 1
+        if self.media_options is not None:
+            # Files are downloaded from the homeserver in the dispatcher
+            pool_size += self.dispatcher.num_workers
+        self.matrix = ClientMatrix(**self.matrix_server, rate_limit=self.matrix_rate_limit, store=self.store,
+                                   metrics=self.metrics, pool_size=pool_size, adapter=self.http_adapter,
+                                   before_checkpoint=self.outbox.flush)
+        self.xmpp = ClientXMPP(**self.xmpp_login, **self.xmpp_roster_options, **self.xmpp_connection_options)
+        self.muc_joiner = MucJoiner(self.xmpp, self.store, self.xmpp_groupchat_nick, **self.muc_join_options)
+        if self.backfill_options is not None:
+            self.backfill = Backfill(self.xmpp, self.store, self.send_queue, self.write_backfill,
+                                     **self.backfill_options)
+        if self.media_options is not None:
+            cache = MediaCache(int(self.media_options.get('cache_mb', 500) * 1024 * 1024))
+            self.media = MediaBridge(self.matrix, self.xmpp, cache, self.media_options.get('upload_service'),
+                                     int(self.media_options.get('max_file_size_mb', 50) * 1024 * 1024))
+
+        self.login_matrix()
+        if self.appservice_options.get('enabled', False):
+            self.appservice = AppService(self.matrix, self.appservice_options['hs_token'],
+                                         **{key: value for key, value in self.appservice_options.items()
+                                            if key in ('host', 'port', 'user_prefix')})
 
         if self.disable_all_chat_room:
             self.send_messages_to_all_chat = False #should not be necessary (see load_config)
-            if 'all_chat' in self.special_rooms:
-                del self.special_rooms['all_chat']
             if 'all_chat' in self.special_room_names:
                 del self.special_room_names['all_chat']
 
-        # Prepare matrix special channels and their listeners
-        for room in self.matrix.get_rooms().values():
-            room.update_room_topic()
-            topic = room.topic
+        self.registry = RoomRegistry(self.groupchat_flag, list(self.special_room_names.keys()))
 
-            if topic in self.special_rooms.keys():
-                logging.debug('Recovering special room: ' + topic)
-                self.special_rooms[topic] = room
+        self.restore_room_state()
 
-            elif topic.startswith(self.groupchat_flag):
-                room_jid = topic[len(self.groupchat_flag):]
-                self.groupchat_jids.append(room_jid)
+        # Prepare matrix special channels and their listeners
+        for room in self.matrix.get_rooms().values():
+            if room.topic in self.special_room_names:
+                logging.debug('Recovering special room: %s', room.topic)
+                self.registry.set_special_room(room.topic, room)
 
-        for topic, room in self.special_rooms.items():
+        for topic in self.registry.special_topics():
+            room = self.registry.special_room(topic)
             if room is None:
-                room = self.matrix.create_room()
-            self.setup_special_room(room, topic)
+                room = self.matrix.create_room(name=self.special_room_names[topic],
+                                               topic=topic,
+                                               invitees=self.users_to_invite)
+                self.registry.set_special_room(topic, room)
+                self.store_room(room)
+            else:
+                self.setup_special_room(room, topic)
+                # Invite users to recovered special rooms (new ones were created with their invitations)
+                self.invite_missing_users(room)
 
-        self.special_rooms['control'].add_listener(self.matrix_control_message, 'm.room.message')
+        self.registry.special_room('control').add_listener(self.matrix_control_message, 'm.room.message')
         if not self.disable_all_chat_room:
-            self.special_rooms['all_chat'].add_listener(self.matrix_all_chat_message, 'm.room.message')
+            self.registry.special_room('all_chat').add_listener(self.matrix_all_chat_message, 'm.room.message')
 
-        # Invite users to special rooms
-        for room in self.special_rooms.values():
-            for user_id in self.users_to_invite:
-                room.invite_user(user_id)
+        # Map the other rooms, including groupchats
+        self.map_rooms_by_topic()
+        # The contacts which already have a room count as known, so after a restart only what
+        #  changed in the roster since then touches rooms
+        self.roster_snapshot = {topic: self.registry.get(topic).name for topic in self.registry.topics()
+                                if not topic.startswith(self.groupchat_flag)}
 
         # Prepare xmpp listeners
         self.xmpp.add_event_handler('roster_update', self.xmpp_roster_update)
         self.xmpp.add_event_handler('message', self.xmpp_message)
         self.xmpp.add_event_handler('presence_available', self.xmpp_presence_available)
         self.xmpp.add_event_handler('presence_unavailable', self.xmpp_presence_unavailable)
-        self.xmpp.add_event_handler('groupchat_message', self.xmpp_groupchat_message)
+        self.xmpp.add_event_handler('disconnected', self.xmpp_disconnected)
+        # Registered after ClientXMPP's own handler, so presence and roster come first
+        self.xmpp.add_event_handler('session_start', self.xmpp_session_start)
+        self.xmpp.add_event_handler('session_resumed', self.xmpp_session_resumed)
+        self.xmpp.add_event_handler('stanza_acked', self.xmpp_stanza_acked)
+
+        self.register_gauges()
 
         # Connect to XMPP and start processing XMPP events
         self.xmpp.connect(self.xmpp_server)
         self.xmpp.process(block=False)
 
-        # Rejoin group chats
-        logging.debug('Rejoining group chats')
-        for room_jid in self.groupchat_jids:
-            self.xmpp.plugin['xep_0045'].joinMUC(room_jid, self.xmpp_groupchat_nick)
+        # Messages to XMPP are resent once the XMPP session started (see xmpp_session_start)
+        self.replay_outbox()
 
         logging.debug('Done with bot init')
 
-    def load_config(self, path: str):
-        with open(path, 'r') as conf_file:
-            config = yaml.load(conf_file)
-
+    def load_config(self, config: Dict):
         self.users_to_invite = config['matrix']['users_to_invite']
         self.matrix_room_topics = config['matrix']['room_topics']
         self.groupchat_flag = config['matrix']['groupchat_flag']
@@ -131,6 +250,20 @@ class BridgeBot:
             self.restore_room_topic = config['matrix']['restore_room_topic']
 
         self.matrix_server = config['matrix']['server']
+        if 'rate_limit' in config['matrix']:
+            self.matrix_rate_limit = config['matrix']['rate_limit']
+        if 'store_file' in config:
+            self.store_file = config['store_file']
+        if 'outbox_file' in config:
+            self.outbox_file = config['outbox_file']
+        if 'sync_filter' in config['matrix']:
+            self.use_sync_filter = config['matrix']['sync_filter']
+        if 'sync_timeline_limit' in config['matrix']:
+            self.sync_timeline_limit = config['matrix']['sync_timeline_limit']
+        if 'provision_workers' in config['matrix']:
+            self.provision_workers = config['matrix']['provision_workers']
+        if 'dispatch_workers' in config['matrix']:
+            self.dispatch_workers = config['matrix']['dispatch_workers']
         self.matrix_login = config['matrix']['login']
         self.xmpp_server = (config['xmpp']['server']['host'],
                             config['xmpp']['server']['port'])
@@ -138,6 +271,8 @@ class BridgeBot:
         self.xmpp_groupchat_nick = config['xmpp']['groupchat_nick']
 
         self.send_presences_to_control = config['send_presences_to_control']
+        if 'presence_digest' in config:
+            self.presence_digest_options = config['presence_digest']
         self.send_messages_to_all_chat = config['send_messages_to_all_chat']
         if not self.send_messages_to_all_chat and 'disable_all_chat_room' in config:
             self.disable_all_chat_room = config['disable_all_chat_room']
@@ -145,8 +280,31 @@ class BridgeBot:
             self.disable_all_chat_room = False
 
         self.groupchat_mute_own_nick = config['groupchat_mute_own_nick']
+        if 'groupchat_coalesce' in config:
+            self.groupchat_coalesce = config['groupchat_coalesce']
+        if 'muc_join' in config:
+            self.muc_join_options = config['muc_join']
+        if 'backfill' in config:
+            self.backfill_options = config['backfill']
+        if 'media' in config:
+            self.media_options = config['media']
 
         self.xmpp_roster_options = config['xmpp']['roster_options']
+        if 'keepalive' in config['xmpp']:
+            self.xmpp_connection_options['keepalive_interval'] = config['xmpp']['keepalive']['interval']
+            self.xmpp_connection_options['keepalive_timeout'] = config['xmpp']['keepalive']['timeout']
+        if 'stream_management' in config['xmpp']:
+            self.xmpp_connection_options['stream_management'] = config['xmpp']['stream_management']
+
+        if 'send_queue' in config:
+            self.send_queue_options = config['send_queue']
+
+        if 'metrics' in config:
+            # A copy, since 'enabled' is taken out of it, and the runner creates bots from the same config again
+            self.metrics_options = dict(config['metrics'])
+
+        if 'appservice' in config:
+            self.appservice_options = config['appservice']
 
         if 'disabled_jids' in config:
             self.disabled_jids = set(config['disabled_jids'])
@@ -154,57 +312,231 @@ class BridgeBot:
                 self.disabled_jids.add(self.xmpp_login['jid'])
                 self.disabled_jids.remove('xmpp_login_jid')
 
-    def get_room_for_jid(self, jid: str) -> MatrixRoom:
+    def login_matrix(self):
+        """
+        Log in to Matrix.
+
+        If the room store holds an access token and sync position for the configured user, that
+         session is resumed, and only what changed since the last sync is fetched. Otherwise logs in
+         with the configured password; a full initial sync is only done if there is no sync position.
+        If enabled, the sync filter is registered before the first sync.
+        In appservice mode, the appservice's bot user is used without logging in or syncing.
+        """
+        if self.appservice_options.get('enabled', False):
+            self.matrix.login_appservice(self.appservice_options['as_token'], self.matrix_login['username'])
+            return
+
+        token = self.store.get_value('access_token')
+        next_batch = self.store.get_value('next_batch')
+        if (token is not None and next_batch is not None
+                and self.store.get_value('username') == self.matrix_login['username']):
+            if self.matrix.resume(token, next_batch, self.store.rooms().keys()):
+                logging.info('Resumed Matrix session from sync position %s', next_batch)
+                if self.use_sync_filter:
+                    self.matrix.set_sync_filter(self.sync_timeline_limit)
+                return
+            logging.info('Saved Matrix access token was rejected, logging in again')
+
+        self.matrix.login(**self.matrix_login, sync=False)
+        self.store.set_value('username', self.matrix_login['username'])
+        self.store.set_value('access_token', self.matrix.token)
+
+        if self.use_sync_filter:
+            self.matrix.set_sync_filter(self.sync_timeline_limit)
+        if self.matrix.sync_token is None:
+            self.matrix.listen_for_events(timeout_ms=0)  # initial sync
+
+    def run(self):
+        """
+        Process Matrix events until stop() is called: as the homeserver pushes them to the
+         appservice listener, or by syncing. Only the Matrix side is reconnected here;
+         listen_forever continues from the last sync position, and sleekxmpp reconnects by itself.
+        """
+        if self.appservice is not None:
+            self.appservice.serve_forever()
+            return
+
+        while not self.stopped:
+            try:
+                self.check_matrix_login()
+                self.matrix.listen_forever()
+            except MatrixError as e:
+                if self.stopped:
+                    break
+                logging.error('MatrixError: %s', e)
+                self.metrics.inc('reconnects', side='matrix')
+                time.sleep(MATRIX_RETRY_DELAY)
+
+    def stop(self):
+        """
+        Disconnect from XMPP, stop processing Matrix events and stop the worker threads, so the
+         account can be started again in the same process. Messages which were not delivered stay
+         in the outbox. Also cleans up after a setup which failed halfway.
+        """
+        self.stopped = True
+        if self.matrix is not None:
+            self.matrix.should_listen = False
+            # A sync which is still running must not save into the closed store and outbox
+            self.matrix.before_checkpoint = None
+            self.matrix.store = None
+        if self.appservice is not None:
+            self.appservice.stop()
+        if self.xmpp is not None:
+            self.xmpp.disconnect(wait=False)
+        if self.muc_joiner is not None:
+            self.muc_joiner.stop()
+        if self.backfill is not None:
+            self.backfill.stop()
+        for queue in (self.dispatcher, self.send_queue, self.tasks):
+            if queue is not None:
+                queue.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.store is not None:
+            self.store.close()
+
+    def health(self) -> Dict:
+        """
+        :return: State of the connections and queues
+        """
+        return {
+            'xmpp_session': self.xmpp.session_started_event.is_set(),
+            'matrix_synced_at': self.matrix.synced_at,
+            'send_queue_depth': self.send_queue.depth,
+            'dispatch_lag_events': self.dispatcher.depth,
+            'dispatch_lag_seconds': self.dispatcher.oldest_age(),
+            'send_queue_failed': self.send_queue.failed_count,
+            'outbox_pending': len(self.outbox.pending()),
+            }
+
+    def check_matrix_login(self):
+        """
+        Log in to Matrix again if the homeserver no longer accepts our access token.
+
+        The sync position, rooms and the XMPP session are kept.
+        """
+        try:
+            self.matrix.api.whoami()
+        except MatrixRequestError as e:
+            if e.code not in (401, 403):
+                raise
+            logging.info('Matrix access token was rejected, logging in again')
+            self.store.set_value('access_token', None)
+            self.login_matrix()
+
+    def restore_room_state(self):
+        """
+        Fill in the topic and name of every joined room, and update the room store to match.
+
+        Topics and names come from the state events of the initial sync. Rooms without a topic in
+         the sync are filled in from the room store; only rooms which the store does not know yet
+         are fetched from the homeserver.
+        """
+        stored_rooms = self.store.rooms()
+        rooms = list(self.matrix.get_rooms().values())
+
+        for room in rooms:
+            if room.room_id in stored_rooms:
+                stored_topic, stored_name = stored_rooms[room.room_id]
+                if room.topic is None:
+                    room.topic = stored_topic
+                if room.name is None:
+                    room.name = stored_name
+            elif room.topic is None:
+                logging.debug('Fetching topic of unknown room %s', room.room_id)
+                room.update_room_topic()
+
+        self.store.set_rooms((room.room_id, room.topic, room.name) for room in rooms)
+        self.store.remove_rooms(set(stored_rooms) - {room.room_id for room in rooms})
+
+    def store_room(self, room: MatrixRoom):
+        """
+        Save the current topic and name of a room to the room store.
+        """
+        self.store.set_room(room.room_id, room.topic, room.name)
+
+    def leave_room(self, room: MatrixRoom):
+        """
+        Leave a Matrix room and remove it from the room registry and store.
+
+        Runs in the tasks queue, while the sync thread may already have seen the leave and dropped the
+         room from self.matrix.rooms (Room.leave would fail then).
+        """
+        self.matrix.api.leave_room(room.room_id)
+        self.matrix.rooms.pop(room.room_id, None)
+        self.registry.remove(room.room_id)
+        self.store.remove_rooms([room.room_id])
+        self.matrix.members.forget(room.room_id)
+
+    def get_room_for_jid(self, jid: str) -> MatrixRoom or None:
         """
         Return the room corresponding to the given XMPP JID
         :param jid: bare XMPP JID, should not include the resource
-        :return: Matrix room object for chatting with that JID
+        :return: Matrix room object for chatting with that JID, or None if there is no such room
         """
-        room_id = self.topic_room_id_map[jid]
-        return self.matrix.get_rooms()[room_id]
+        return self.registry.get(jid)
 
     def get_unmapped_rooms(self) -> List[MatrixRoom]:
         """
         Returns a list of all Matrix rooms which are not a special room (e.g., the control room) and
-        do not have a corresponding entry in the topic -> room map.
+        are not in the room registry.
         :return: List of unmapped, non-special Matrix room objects.
         """
-        special_room_ids = [r.room_id for r in self.special_rooms.values()]
-        valid_room_ids = [v for v in self.topic_room_id_map.values()] + special_room_ids
-        unmapped_rooms = [room for room_id, room in self.matrix.get_rooms().items()
-                          if room_id not in valid_room_ids]
+        unmapped_rooms = [room for room_id, room in list(self.matrix.get_rooms().items())
+                          if not self.registry.is_known(room_id)]
         return unmapped_rooms
 
     def get_empty_rooms(self) -> List[MatrixRoom]:
         """
-        Returns a list of all Matrix rooms which are occupied by only one user
-        (the bot itself).
+        Returns a list of all known (mapped or special) Matrix rooms which are occupied by only
+        one user (the bot itself).
+
+        The number of members is taken from the membership index, which the sync keeps up to date
+         (with lazy-loaded members, from the room summaries). Only rooms whose number of members
+         is not known at all (e.g. without a sync filter, after a restart) are asked for their members.
         :return: List of Matrix rooms occupied by only the bot.
         """
-        empty_rooms = [room for room in self.matrix.get_rooms().values()
-                       if len(room.get_joined_members()) < 2]
+        empty_rooms = []
+        for room_id, room in list(self.matrix.get_rooms().items()):
+            if not self.registry.is_known(room_id):
+                continue
+            count = self.matrix.members.joined_count(room_id)
+            if count is None:
+                count = len(self.matrix.joined_members(room_id))
+            if count < 2:
+                empty_rooms.append(room)
         return empty_rooms
 
+    def invite_missing_users(self, room: MatrixRoom):
+        """
+        Invite the users specified in the config who neither joined nor were invited to the room.
+        """
+        for user_id in self.users_to_invite:
+            if not self.matrix.is_member(room.room_id, user_id):
+                self.invite_user(room, user_id)
+
     def setup_special_room(self, room, topic: str):
         """
-        Sets up a Matrix room with the requested topic and adds it to the self.special_rooms map.
+        Sets up a Matrix room with the requested topic and adds it to the registry's special rooms.
 
-        If a special room with that topic already exists, it is replaced in the special_rooms
-         map by the new room.
+        If a special room with that topic already exists, it is replaced in the registry
+         by the new room.
         :param room: Room to set up
         :param topic: Topic for the room
         """
-        room.set_room_topic(topic)
-        room.set_room_name(self.special_room_names[topic])
-        self.special_rooms[topic] = room
+        self.set_room_topic(room, topic)
+        self.set_room_name(room, self.special_room_names[topic])
+        self.registry.set_special_room(topic, room)
 
-        logging.debug('Set up special room with topic {} and id'.format(
-            str(room.topic), room.room_id))
+        logging.debug('Set up special room with topic %s and id %s', room.topic, room.room_id)
 
     def create_mapped_room(self, topic: str, name: str=None) -> MatrixRoom or None:
         """
-        Create a new room and add it to self.topic_room_id_map.
+        Create a new room and add it to the room registry.
 
+        The room is created with its topic, name and invitations in a single request.
         :param topic: Topic for the new room
         :param name: (Optional) Name for the new room
         :return: Room which was created
@@ -212,30 +544,50 @@ class BridgeBot:
         if not name: #room without name is shown as the bot's name in clients like riot
             name = topic
 
-        if topic in self.groupchat_jids:
-            logging.debug('Topic {} is a groupchat without its flag, ignoring'.format(topic))
+        room = self.registry.get(topic)
+        if self.registry.is_groupchat(topic):
+            logging.debug('Topic %s is a groupchat without its flag, ignoring', topic)
             return None
-        elif topic in self.topic_room_id_map.keys():
-            room_id = self.topic_room_id_map[topic]
-            room = self.matrix.get_rooms()[room_id]
-            logging.debug('Room with topic {} already exists!'.format(topic))
+        elif room is not None:
+            logging.debug('Room with topic %s already exists!', topic)
         else:
-            room = self.matrix.create_room()
-            room.set_room_topic(topic)
-            self.topic_room_id_map[topic] = room
-            logging.info('Created mapped room with topic {} and id {}'.format(topic, str(room.room_id)))
-            room.set_room_name(name)
-
-        room.update_room_name() #room.name is not set automatically in all cases
+            room = self.matrix.create_room(name=name, topic=topic, invitees=self.users_to_invite)
+            self.registry.add(topic, room)
+            self.store_room(room)
+            room.add_listener(self.matrix_message, 'm.room.message')
+            logging.info('Created mapped room with topic %s and id %s', topic, room.room_id)
+            if self.backfill is not None and not topic.startswith(self.groupchat_flag):
+                # Group chats are backfilled once they were joined
+                self.backfill.queue(topic, new=True)
+            return room
+
+        if room.name is None:
+            room.update_room_name() #room.name is not set automatically in all cases
 
         if self.restore_room_topic and room.name != name:
-            room.set_room_name(name)
+            self.set_room_name(room, name)
 
         return room
 
+    def provision_mapped_rooms(self, topic_names: Dict[str, str]):
+        """
+        Call create_mapped_room for many topics, with up to self.provision_workers rooms
+         being created at the same time.
+
+        :param topic_names: Map of topic -> name for the rooms
+        """
+        with ThreadPoolExecutor(max_workers=self.provision_workers) as executor:
+            futures = {executor.submit(self.create_mapped_room, topic, name): topic
+                       for topic, name in topic_names.items()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except MatrixError as e:
+                    logging.error('Failed to set up room for %s: %s', futures[future], e)
+
     def map_rooms_by_topic(self):
         """
-        Add unmapped rooms to self.topic_room_id_map, and listen to messages from those rooms.
+        Add unmapped rooms to the room registry, and listen to messages from those rooms.
 
         Rooms whose topics are empty or do not contain an '@' symbol are assumed to be special
          rooms, and will not be mapped.
@@ -243,26 +595,20 @@ class BridgeBot:
         unmapped_rooms = self.get_unmapped_rooms()
 
         for room in unmapped_rooms:
-            room.update_room_topic()
-
-            logging.debug('Unmapped room {} ({}) [{}]'.format(room.room_id, room.name, room.topic))
+            logging.debug('Unmapped room %s (%s) [%s]', room.room_id, room.name, room.topic)
 
             if room.topic is None or '@' not in room.topic:
                 logging.debug('Leaving it as-is (special room, topic does not contain @)')
             else:
-                self.topic_room_id_map[room.topic] = room.room_id
+                self.registry.add(room.topic, room)
 
                 room.add_listener(self.matrix_message, 'm.room.message')
 
     def matrix_control_message(self, room: MatrixRoom, event: Dict):
         """
-        Handle a message sent to the control room.
-
-        Does nothing unless a valid command is received:
-          refresh  Probes the presence of all XMPP contacts, and updates the roster.
-          purge    Leaves any ((un-mapped and non-special) or empty) Matrix rooms.
-          joinmuc some@muc.com   Joins a muc
-          leavemuc some@muc.com  Leaves a muc
+        Handle a message sent to the control room: the command is run by control_command in the
+         background, in the order the commands were received.
+        See control_command for the commands.
 
         :param room: Matrix room object representing the control room
         :param event: The Matrix event that was received. Assumed to be an m.room.message .
@@ -271,46 +617,362 @@ class BridgeBot:
         if event['sender'] == self.bot_id:
             return
 
-        logging.debug('matrix_control_message: {}  {}'.format(room.room_id, str(event)))
+        logging.debug('matrix_control_message: %s  %s', room.room_id, event)
 
         if event['content']['msgtype'] == 'm.text':
-            message_body = event['content']['body']
-            logging.info('Matrix received control message: ' + message_body)
-
-            message_parts = message_body.split()
-            if len(message_parts) > 0:
-                message_parts[0] = message_parts[0].lower()
-                # what about a empty body?
-                if message_parts[0] == 'refresh':
-                    for jid in self.topic_room_id_map.keys():
-                        self.xmpp.send_presence(pto=jid, ptype='probe')
-
-                    self.xmpp.send_presence()
-                    self.xmpp.get_roster()
-
-                elif message_parts[0] == 'purge':
-                    self.special_rooms['control'].send_text('Purging unused rooms')
-
-                    # Leave from unwanted rooms
-                    for room in self.get_unmapped_rooms() + self.get_empty_rooms():
-                        logging.info('Leaving room {r.room_id} ({r.name}) [{r.topic}]'.format(r=room))
-                        if room.topic.startswith(self.groupchat_flag):
-                            room_jid = room.topic[len(self.groupchat_flag):]
-                            self.xmpp.plugin['xep_0045'].leaveMUC(room_jid)
-                        room.leave()
-
-                elif len(message_parts) > 1:
-                    if message_parts[0] == 'joinmuc':
-                        room_jid = message_parts[1]
-                        logging.info('XMPP MUC join: {}'.format(room_jid))
-                        self.create_groupchat_room(room_jid)
-                        self.xmpp.plugin['xep_0045'].joinMUC(room_jid, self.xmpp_groupchat_nick)
-                    elif message_parts[0] == 'leavemuc':
-                        room_jid = message_parts[1]
-                        logging.info('XMPP MUC leave: {}'.format(room_jid))
+            self.tasks.put('control', self.control_command, room, event['content']['body'])
+
+    def control_command(self, room: MatrixRoom, message_body: str):
+        """
+        Run a command sent to the control room.
+
+        Does nothing unless a valid command is received:
+          refresh  Probes the presence of all XMPP contacts, and updates the roster.
+          purge    Leaves any ((un-mapped and non-special) or empty) Matrix rooms.
+          stats    Shows the depth and latency of the outbound send queue.
+          joinmuc some@muc.com [other@muc.com ...]   Joins mucs, and reports the progress
+          leavemuc some@muc.com  Leaves a muc
+
+        :param room: Matrix room object representing the control room
+        :param message_body: Text of the message
+        """
+        logging.info('Matrix received control message: %s', message_body)
+
+        message_parts = message_body.split()
+        if len(message_parts) > 0:
+            message_parts[0] = message_parts[0].lower()
+            # what about a empty body?
+            if message_parts[0] == 'refresh':
+                for topic in self.registry.topics():
+                    if not topic.startswith(self.groupchat_flag):
+                        self.xmpp.send_presence(pto=topic, ptype='probe')
+
+                self.xmpp.send_presence()
+                self.xmpp.get_roster()
+
+            elif message_parts[0] == 'stats':
+                self.send_notice(room, self.stats_text())
+
+            elif message_parts[0] == 'purge':
+                self.send_text(room, 'Purging unused rooms')
+
+                # Leave from unwanted rooms; get_empty_rooms only looks at the known ones
+                for room in self.get_unmapped_rooms() + self.get_empty_rooms():
+                    logging.info('Leaving room %s (%s) [%s]', room.room_id, room.name, room.topic)
+                    if room.topic is not None and room.topic.startswith(self.groupchat_flag):
+                        room_jid = room.topic[len(self.groupchat_flag):]
                         self.xmpp.plugin['xep_0045'].leaveMUC(room_jid, self.xmpp_groupchat_nick)
-                        room = self.get_room_for_jid(self.groupchat_flag + room_jid)
-                        room.leave()
+                        self.muc_joiner.forget(room_jid)
+                        if self.backfill is not None:
+                            self.backfill.forget(room_jid)
+                    self.leave_room(room)
+
+            elif len(message_parts) > 1:
+                if message_parts[0] == 'joinmuc':
+                    room_jids = message_parts[1:]
+                    logging.info('XMPP MUC join: %s', ', '.join(room_jids))
+                    new_jids = [room_jid for room_jid in room_jids if self.create_groupchat_room(room_jid)]
+                    joined = self.join_groupchats(room_jids, room)
+                    if self.backfill is not None:
+                        for room_jid in joined:
+                            self.backfill.queue(room_jid, groupchat=True, new=room_jid in new_jids)
+                elif message_parts[0] == 'leavemuc':
+                    room_jid = message_parts[1]
+                    logging.info('XMPP MUC leave: %s', room_jid)
+                    self.xmpp.plugin['xep_0045'].leaveMUC(room_jid, self.xmpp_groupchat_nick)
+                    self.muc_joiner.forget(room_jid)
+                    if self.backfill is not None:
+                        self.backfill.forget(room_jid)
+                    room = self.get_room_for_jid(self.groupchat_flag + room_jid)
+                    if room is not None:
+                        self.leave_room(room)
+
+    def stats_text(self) -> str:
+        """
+        :return: Human-readable summary of the outbound send queue and of the Matrix messages which
+                 wait for the dispatcher
+        """
+        p50 = self.send_queue.latency(50)
+        p99 = self.send_queue.latency(99)
+        if p50 is None:
+            latency = 'n/a'
+        else:
+            latency = 'p50 {:.3f}s, p99 {:.3f}s'.format(p50, p99)
+        return ('Send queue: {} queued, {} sent, {} failed, {} merged, latency {}\n'
+                'Dispatcher: {} Matrix messages behind the sync, oldest {:.1f}s').format(
+            self.send_queue.depth, self.send_queue.sent_count, self.send_queue.failed_count,
+            self.send_queue.coalesced_count, latency, self.dispatcher.depth, self.dispatcher.oldest_age())
+
+    def register_gauges(self):
+        """
+        Describe the bridge's metrics, and register the gauges read from its queues and rooms.
+        """
+        self.metrics.describe('messages', 'Messages bridged, by direction and chat type')
+        self.metrics.describe('presences', 'XMPP presence changes received')
+        self.metrics.describe('bridge_latency_seconds',
+                              'Time from receiving a message to handing it on: until the homeserver accepted it '
+                              '(xmpp_to_matrix), or until it was queued on the XMPP stream (matrix_to_xmpp)')
+        self.metrics.describe('matrix_event_age_seconds', 'Age of Matrix messages when the bridge receives them')
+        self.metrics.describe('matrix_requests', 'Requests to the homeserver, by endpoint and HTTP status')
+        self.metrics.describe('matrix_request_seconds', 'Duration of requests to the homeserver')
+        self.metrics.describe('reconnects', 'Reconnections to Matrix or XMPP')
+        self.metrics.describe('xmpp_sessions', 'XMPP sessions, by whether they were started anew or resumed')
+        self.metrics.describe('merged_messages', 'Groupchat messages sent as part of a merged burst')
+        self.metrics.describe('muc_joins', 'Group chat joins, by result')
+        self.metrics.describe('backfilled_messages', 'Messages copied from the XMPP message archive')
+        self.metrics.describe('media_transfers', 'Attached files copied to the other side, by direction and result')
+
+        self.metrics.gauge('send_queue_depth', lambda: self.send_queue.depth)
+        self.metrics.gauge('send_queue_sent', lambda: self.send_queue.sent_count)
+        self.metrics.gauge('send_queue_failed', lambda: self.send_queue.failed_count)
+        self.metrics.describe('matrix_dispatch_lag_events', 'Matrix messages received by the sync but not handled yet')
+        self.metrics.gauge('matrix_dispatch_lag_events', lambda: self.dispatcher.depth)
+        self.metrics.describe('matrix_dispatch_lag_seconds',
+                              'Time since the oldest Matrix message which is not handled yet was received')
+        self.metrics.gauge('matrix_dispatch_lag_seconds', self.dispatcher.oldest_age)
+        self.metrics.gauge('mapped_rooms', lambda: len(self.registry.topics()))
+        if self.backfill is not None:
+            self.metrics.gauge('backfill_queue_depth', lambda: self.backfill.depth)
+
+    def send_text(self, room: MatrixRoom, text: str):
+        """
+        Queue a text message to a Matrix room.
+
+        Messages to the same room are sent in order; blocks while the send queue is full.
+        :param room: Room to send the message to
+        :param text: Message body
+        """
+        self.send_queue.put(room.room_id, room.send_text, text)
+
+    def bridge_to_matrix(self, room: MatrixRoom, text: str, received_at: float=None, msgtype: str='m.text',
+                         jid: str=None, name: str=None, coalesce: bool=False, media_url: str=None, nick: str=None,
+                         entry_id: str=None) -> bool:
+        """
+        Record a bridged message in the outbox, and queue it for a Matrix room.
+
+        The outbox record is not waited for; call self.outbox.flush() before the message counts as received.
+        :param room: Room to send the message to
+        :param text: Message body
+        :param received_at: (Optional) time.monotonic() when the message was received, to measure the latency
+        :param msgtype: m.text or m.notice
+        :param jid: (Optional) Contact who wrote the message; in appservice mode, it is sent as their virtual user
+        :param name: Name of the contact
+        :param coalesce: Merge the message with others to the same room if they arrive in a burst
+                         (see groupchat_coalesce in the config)
+        :param media_url: (Optional) URL of an attached file, which is copied to the homeserver and sent
+                          instead of the text (the text is sent if the file cannot be copied)
+        :param nick: (Optional) Groupchat nick of the sender, shown before the name of an attached file
+        :param entry_id: (Optional) Outbox id, for messages which may be received more than once
+        :return: False if a message with the same outbox id was bridged before
+        """
+        fields = {'room_id': room.room_id, 'body': text, 'msgtype': msgtype}
+        if jid is not None and self.appservice is not None:
+            fields.update(jid=jid, name=name)
+        if media_url is not None:
+            fields.update(media_url=media_url, nick=nick)
+        entry = self.outbox.add(TO_MATRIX, entry_id, wait=False, **fields)
+        if entry is None:
+            return False
+        if self.coalescer is not None:
+            if coalesce and media_url is None and self.coalescer.add(room.room_id, (entry, received_at)):
+                return True
+            if self.coalescer.is_collecting(room.room_id):
+                self.coalescer.flush(room.room_id)
+        self.send_queue.put(room.room_id, self.deliver_to_matrix, entry, received_at)
+        return True
+
+    def queue_burst(self, room_id: str, items: List[Tuple[Dict, float]]):
+        """
+        Queue messages which were collected by the coalescer.
+        :param room_id: Room the messages are sent to
+        :param items: List of (outbox entry, received_at)
+        """
+        if len(items) == 1:
+            self.send_queue.put(room_id, self.deliver_to_matrix, *items[0])
+        else:
+            self.send_queue.put(room_id, self.deliver_burst_to_matrix, items)
+
+    def deliver_to_matrix(self, entry: Dict, received_at: float=None):
+        """
+        Send a message from the outbox to Matrix, with its outbox id as transaction id, so a message
+         which is sent again (e.g. after a restart) is not shown twice. Runs in the send queue.
+        """
+        room = self.matrix.rooms.get(entry['room_id'])
+        content = {'msgtype': entry['msgtype'], 'body': entry['body']}
+        if room is not None and 'media_url' in entry and self.media is not None:
+            content = self.media_to_matrix(entry) or content
+        if room is None:
+            logging.warning('Dropping message to room %s, which the bot is no longer in', entry['room_id'])
+        elif 'jid' in entry and self.appservice is not None:
+            self.appservice.send_message_as(entry['jid'], entry['name'], room, content, txn_id=entry['id'])
+        else:
+            self.matrix.api.send_message_event(room.room_id, 'm.room.message', content, txn_id=entry['id'])
+        self.outbox.done(entry['id'])
+        if received_at is not None:
+            self.metrics.observe('bridge_latency_seconds', time.monotonic() - received_at, direction='xmpp_to_matrix')
+
+    def media_to_matrix(self, entry: Dict) -> Dict or None:
+        """
+        Copy the file attached to a message from XMPP to the homeserver.
+        :return: Content of the Matrix message for the file, or None if it could not be copied
+        """
+        try:
+            content = self.media.to_matrix(entry['media_url'])
+        except (requests.RequestException, MatrixError, MediaTooLarge, OSError) as e:
+            logging.warning('Copying %s to Matrix failed, sending the link: %s', entry['media_url'], e)
+            self.metrics.inc('media_transfers', direction='xmpp_to_matrix', result='failed')
+            return None
+        self.metrics.inc('media_transfers', direction='xmpp_to_matrix', result='copied')
+        if entry.get('nick'):
+            content = dict(content, body='{}: {}'.format(entry['nick'], content['body']))
+        return content
+
+    def deliver_burst_to_matrix(self, items: List[Tuple[Dict, float]]):
+        """
+        Send several messages from the outbox as one event, one line per message. Runs in the send queue.
+        :param items: List of (outbox entry, received_at)
+        """
+        entries = [entry for entry, _received_at in items]
+        # Recorded before it is sent, so the messages are not sent again one by one after a crash
+        fields = {key: value for key, value in entries[0].items() if key not in ('id', 'direction')}
+        fields['body'] = '\n'.join(entry['body'] for entry in entries)
+        merged = self.outbox.merge([entry['id'] for entry in entries], TO_MATRIX, **fields)
+        self.deliver_to_matrix(merged)
+        for entry, received_at in items:
+            if received_at is not None:
+                self.metrics.observe('bridge_latency_seconds', time.monotonic() - received_at,
+                                     direction='xmpp_to_matrix')
+        self.metrics.inc('merged_messages', len(items))
+
+    def deliver_to_xmpp(self, entry: Dict):
+        """
+        Send a message from the outbox to XMPP, with its outbox id as stanza id. Messages with a
+         file are sent by deliver_media_to_xmpp. Runs in the dispatcher, so a file holds up the
+         later messages of its room (and only those) until it was uploaded.
+
+        With stream management, the message stays in the outbox until the server acknowledged it
+         (see xmpp_stanza_acked). Without a session, it is left for xmpp_session_start.
+        """
+        if 'media' in entry and self.media is not None:
+            self.deliver_media_to_xmpp(entry)
+        else:
+            self.send_to_xmpp(entry, entry['body'])
+
+    def deliver_media_to_xmpp(self, entry: Dict):
+        """
+        Upload the file of a Matrix message with the XMPP server's HTTP upload service, and send its
+         URL as body and as out of band data. Links to the homeserver if the file cannot be uploaded.
+         Runs in the dispatcher.
+        """
+        try:
+            url = self.media.to_xmpp(entry['media'])
+        except (requests.RequestException, IqError, IqTimeout, MediaTooLarge, OSError) as e:
+            logging.warning('Uploading %s to XMPP failed, sending the link: %s', entry['media']['url'], e)
+            url = None
+        self.metrics.inc('media_transfers', direction='matrix_to_xmpp', result='failed' if url is None else 'copied')
+        if url is None:
+            url = self.media.download_url(entry['media'])
+        self.send_to_xmpp(entry, url, attachment_url=url)
+
+    def send_to_xmpp(self, entry: Dict, body: str, attachment_url: str=None):
+        """
+        Send a message from the outbox to XMPP. See deliver_to_xmpp.
+        :param body: Message body
+        :param attachment_url: (Optional) URL of an attached file
+        """
+        if not self.xmpp.session_started_event.is_set():
+            logging.debug('No XMPP session, message %s is sent when it starts', entry['id'])
+            return
+        message = self.xmpp.make_message(mto=entry['to'], mbody=body, mtype=entry['mtype'])
+        message['id'] = entry['id']
+        if attachment_url is not None:
+            message['oob']['url'] = attachment_url
+        message.send()
+        if not self.xmpp.stream_managed():
+            self.outbox.done(entry['id'])
+
+    def replay_outbox(self):
+        """
+        Send the messages to Matrix which were received but not delivered before the last shutdown.
+        Messages to XMPP are sent by xmpp_session_start.
+        """
+        to_matrix = self.outbox.pending(TO_MATRIX)
+        if to_matrix:
+            logging.info('Resending %d messages to Matrix', len(to_matrix))
+        for entry in to_matrix:
+            self.send_queue.put(entry['room_id'], self.deliver_to_matrix, entry)
+
+    def send_notice(self, room: MatrixRoom, text: str):
+        """
+        Queue a notice to a Matrix room. See send_text.
+        :param room: Room to send the notice to
+        :param text: Notice body
+        """
+        self.send_queue.put(room.room_id, room.send_notice, text)
+
+    def set_room_topic(self, room: MatrixRoom, topic: str):
+        """
+        Queue a topic change. Replaces a topic change for the same room which was not sent yet.
+        :param room: Room to change
+        :param topic: New topic
+        """
+        self.send_queue.put(room.room_id, room.set_room_topic, topic, coalesce='m.room.topic')
+        self.send_queue.put(room.room_id, self.store_room, room)
+
+    def set_room_name(self, room: MatrixRoom, name: str):
+        """
+        Queue a name change. Replaces a name change for the same room which was not sent yet.
+        :param room: Room to change
+        :param name: New name
+        """
+        self.send_queue.put(room.room_id, room.set_room_name, name, coalesce='m.room.name')
+        self.send_queue.put(room.room_id, self.store_room, room)
+
+    def invite_user(self, room: MatrixRoom, user_id: str):
+        """
+        Queue an invitation. Repeated invitations of the same user which were not sent yet are merged.
+        :param room: Room to invite the user to
+        :param user_id: Matrix user to invite
+        """
+        self.send_queue.put(room.room_id, room.invite_user, user_id, coalesce='invite ' + user_id)
+
+    def publish_presences(self, text: str):
+        """
+        Show a presence digest in the control room, either as a new notice or, with a live table,
+         by editing the previous table.
+        :param text: Text from the presence digest
+        """
+        room = self.registry.special_room('control')
+        if self.presence_digest.live_table:
+            self.send_queue.put(room.room_id, self.edit_presence_table, room, text, coalesce='presence table')
+        else:
+            self.send_notice(room, text)
+
+    def edit_presence_table(self, room: MatrixRoom, text: str):
+        """
+        Replace the text of the presence table in the control room (m.replace edit), or send it
+         if there is none yet.
+        :param room: The control room
+        :param text: New contents of the table
+        """
+        if self.presence_table_event_id is None:
+            response = room.send_notice(text)
+            self.presence_table_event_id = response['event_id']
+            return
+
+        content = {
+            'msgtype': 'm.notice',
+            'body': '* ' + text,
+            'm.new_content': {
+                'msgtype': 'm.notice',
+                'body': text,
+                },
+            'm.relates_to': {
+                'rel_type': 'm.replace',
+                'event_id': self.presence_table_event_id,
+                },
+            }
+        self.matrix.api.send_message_event(room.room_id, 'm.room.message', content)
 
     def matrix_all_chat_message(self, room: MatrixRoom, event: Dict):
         """
@@ -325,68 +987,133 @@ class BridgeBot:
         if event['sender'] == self.bot_id:
             return
 
-        logging.debug('matrix_all_chat_message: {}  {}'.format(room.room_id, str(event)))
+        logging.debug('matrix_all_chat_message: %s  %s', room.room_id, event)
 
-        room.send_notice('Don\'t talk in here! Nobody gets your messages.')
+        self.send_notice(room, 'Don\'t talk in here! Nobody gets your messages.')
 
     def matrix_message(self, room: MatrixRoom, event: Dict):
         """
         Handle a message sent to a mapped Matrix room.
 
-        Sends the message to the xmpp handle specified by the room's topic.
+        Records the message to the xmpp handle specified by the room's topic in the outbox, and
+         hands it to the dispatcher, which runs dispatch_matrix_message for the messages of each room
+         in order. The outbox is flushed before the sync position is saved (see ClientMatrix), so a
+         message which is still waiting in the dispatcher is sent after a restart.
 
         :param room: Matrix room object representing the room in which the message was received.
         :param event: The Matrix event that was received. Assumed to be an m.room.message .
         """
         if event['sender'] == self.bot_id:
             return
+        received_at = time.monotonic()
 
-        if room.topic in self.special_rooms.keys():
-            logging.error('matrix_message called on special channel')
-
-        logging.debug('matrix_message: {}  {}'.format(room.room_id, event))
+        topic = self.registry.topic_for(room.room_id)
+        if topic is None:
+            logging.error('matrix_message called on unmapped or special channel')
+            return
 
-        if event['content']['msgtype'] == 'm.text':
-            message_body = event['content']['body']
+        logging.debug('matrix_message: %s  %s', room.room_id, event)
 
-            if room.topic.startswith(self.groupchat_flag):
-                jid = room.topic[len(self.groupchat_flag):]
+        content = event['content']
+        media = self.media is not None and content['msgtype'] in MEDIA_MSGTYPES and 'url' in content
+        if content['msgtype'] == 'm.text' or media:
+            if topic.startswith(self.groupchat_flag):
+                jid = topic[len(self.groupchat_flag):]
                 message_type = 'groupchat'
             else:
-                jid = room.topic
+                jid = topic
                 message_type = 'chat'
 
-            name = self.xmpp.jid_nick_map[jid]
+            # The event id is the outbox id, so an event which is synced again after a restart is not sent twice
+            fields = {'media': content} if media else {}
+            entry = self.outbox.add(TO_XMPP, event['event_id'], wait=False, to=jid, body=content['body'],
+                                    mtype=message_type, room_id=room.room_id, **fields)
+            if entry is None:
+                logging.debug('Event %s was already bridged', event['event_id'])
+                return
+            self.dispatcher.put(room.room_id, self.dispatch_matrix_message, entry, event, received_at)
 
-            logging.info('Matrix received message to {} : {}'.format(jid, message_body))
-            self.xmpp.send_message(mto=jid, mbody=message_body, mtype=message_type)
+    def dispatch_matrix_message(self, entry: Dict, event: Dict, received_at: float):
+        """
+        Send a message from a mapped Matrix room to XMPP, and mirror it to the all-chat room.
+         Runs in the dispatcher.
 
-            if self.send_messages_to_all_chat:
-                self.special_rooms['all_chat'].send_notice('To {} : {}'.format(name, message_body))
+        :param entry: Outbox entry of the message
+        :param event: The m.room.message event
+        :param received_at: time.monotonic() when the sync returned the message
+        """
+        logging.info('Matrix received message to %s : %s', entry['to'], entry['body'])
+        self.deliver_to_xmpp(entry)
+        self.metrics.inc('messages', direction='matrix_to_xmpp', type=entry['mtype'])
+        self.metrics.observe('bridge_latency_seconds', time.monotonic() - received_at, direction='matrix_to_xmpp')
+        if 'origin_server_ts' in event:
+            self.metrics.observe('matrix_event_age_seconds', max(0.0, time.time() - event['origin_server_ts'] / 1000))
+
+        if self.send_messages_to_all_chat:
+            # Group chats are not in the roster
+            name = self.xmpp.jid_nick_map.get(entry['to'], entry['to'])
+            self.bridge_to_matrix(self.registry.special_room('all_chat'), 'To {} : {}'.format(name, entry['body']),
+                                  msgtype='m.notice')
 
     def xmpp_message(self, message: Dict):
         """
-        Handle a message received by the XMPP client.
+        Handle a message received by the XMPP client: groupchat messages are handled by
+         xmpp_groupchat_message, all others by xmpp_chat_message.
 
-        Sends the message to the relevant mapped Matrix room, as well as the Matrix all-chat room.
+        With stream management, the message is acknowledged to the server only after this
+         returned, i.e. after it was saved in the outbox (see ClientXMPP.message_handled). A
+         message which arrived before the stream was resumed is skipped, since the server sends
+         it again. A message which was being handled while the stream was resumed may still be
+         bridged twice; groupchat messages are then recognized by their stanza id.
+
+        :param message: The message that was received.
+        """
+        try:
+            if self.xmpp.message_resent():
+                logging.debug('Skipping message from %s, which the server sent again', message['from'])
+            elif message['type'] == 'groupchat':
+                self.xmpp_groupchat_message(message)
+            else:
+                self.xmpp_chat_message(message)
+        finally:
+            self.xmpp.message_handled()
+
+    def xmpp_chat_message(self, message: Dict):
+        """
+        Handle a (non-groupchat) message received by the XMPP client.
+
+        Sends the message to the relevant mapped Matrix room (as the contact's virtual user in
+         appservice mode), as well as the Matrix all-chat room.
 
         :param message: The message that was received.
         :return:
         """
-        logging.info('XMPP received {} : {}'.format(message['from'].full, message['body']))
+        received_at = time.monotonic()
+        if is_archive_result(message):
+            return  # collected by the backfill
+        logging.info('XMPP received %s : %s', message['from'], message['body'])
 
         if message['type'] in ('normal', 'chat'):
             from_jid = message['from'].bare
             from_name = self.xmpp.jid_nick_map[from_jid]
 
-            if from_jid in self.groupchat_jids:
+            if self.registry.is_groupchat(from_jid):
                 logging.warning('Normal chat message from a groupchat, ignoring...')
                 return
 
             room = self.get_room_for_jid(from_jid)
-            room.send_text(message['body'])
+            if room is None:
+                logging.warning('No room for %s, ignoring message', from_jid)
+                return
+            self.bridge_to_matrix(room, message['body'], received_at, jid=from_jid, name=from_name,
+                                  media_url=self.attachment_url(message))
+            self.metrics.inc('messages', direction='xmpp_to_matrix', type='chat')
+            if self.backfill is not None:
+                self.backfill.live(from_jid, message, self.xmpp.boundjid.bare)
             if self.send_messages_to_all_chat:
-                self.special_rooms['all_chat'].send_text('From {}: {}'.format(from_name, message['body']))
+                self.bridge_to_matrix(self.registry.special_room('all_chat'),
+                                      'From {}: {}'.format(from_name, message['body']))
+            self.outbox.flush()
 
     def xmpp_groupchat_message(self, message: Dict):
         """
@@ -397,7 +1124,8 @@ class BridgeBot:
         :param message: The message that was received.
         :return:
         """
-        logging.info('XMPP MUC received {} : {}'.format(message['from'].full, message['body']))
+        received_at = time.monotonic()
+        logging.info('XMPP MUC received %s : %s', message['from'], message['body'])
 
         if message['type'] == 'groupchat':
             from_jid = message['from'].bare
@@ -405,112 +1133,334 @@ class BridgeBot:
 
             if self.groupchat_mute_own_nick and from_name == self.xmpp_groupchat_nick:
                 return
+            if not self.muc_joiner.is_new(from_jid, message):
+                logging.debug('Skipping history from %s which was bridged before', from_jid)
+                return
 
             room = self.get_room_for_jid(self.groupchat_flag + from_jid)
-            room.send_text(from_name + ': ' + message['body'])
+            if room is None:
+                logging.warning('No room for groupchat %s, ignoring message', from_jid)
+                return
+            # The group chat's stanza id recognizes history which was bridged before, also if it is
+            #  newer than the last saved time (which is only written every few seconds)
+            archive_id = stanza_id(message, from_jid)
+            entry_id = 'muc {} {}'.format(from_jid, archive_id) if archive_id is not None else None
+            if not self.bridge_to_matrix(room, from_name + ': ' + message['body'], received_at, coalesce=True,
+                                         media_url=self.attachment_url(message), nick=from_name,
+                                         entry_id=entry_id):
+                logging.debug('Skipping message %s from %s which was bridged before', archive_id, from_jid)
+                return
+            self.muc_joiner.seen(from_jid, message)
+            if self.backfill is not None:
+                self.backfill.live(from_jid, message, from_jid)
+            self.metrics.inc('messages', direction='xmpp_to_matrix', type='groupchat')
             if self.send_messages_to_all_chat:
-                self.special_rooms['all_chat'].send_text(
-                    'Room {}, from {}: {}'.format(from_jid, from_name, message['body']))
+                self.bridge_to_matrix(self.registry.special_room('all_chat'),
+                                      'Room {}, from {}: {}'.format(from_jid, from_name, message['body']),
+                                      coalesce=True)
+            self.outbox.flush()
 
-    def create_groupchat_room(self, room_jid: str):
-        room = self.create_mapped_room(topic=self.groupchat_flag + room_jid)
-        if room_jid not in self.groupchat_jids:
-            self.groupchat_jids.append(room_jid)
-        for user_id in self.users_to_invite:
-            room.invite_user(user_id)
+    def attachment_url(self, message) -> str or None:
+        """
+        :return: URL of the file attached to an XMPP message, or None (always if files are not bridged)
+        """
+        if self.media is None:
+            return None
+        return oob_url(message)
+
+    def create_groupchat_room(self, room_jid: str) -> bool:
+        """
+        :return: True if a new room was created
+        """
+        topic = self.groupchat_flag + room_jid
+        existed = topic in self.registry
+        room = self.create_mapped_room(topic=topic)
+        self.registry.add_groupchat(room_jid)
+        if existed:
+            # New rooms are created with their invitations
+            self.invite_missing_users(room)
+        return not existed
 
     def xmpp_presence_available(self, presence: Dict):
         """
         Handle a presence of type "available".
 
-        Sends a notice to the control channel.
+        Adds it to the presence digest for the control channel.
 
         :param presence: The presence that was received.
         """
-        logging.debug('XMPP received {} : (available)'.format(presence['from'].full))
+        logging.debug('XMPP received %s : (available)', presence['from'])
 
         jid = presence['from'].bare
         if jid in self.disabled_jids:
             return
+        self.metrics.inc('presences', state='available')
 
         if jid not in self.xmpp.jid_nick_map.keys():
             logging.error('JID NOT IN ROSTER!?')
-            self.xmpp.get_roster()
+            self.xmpp.get_roster(block=False)
             return
 
         if self.send_presences_to_control:
-            name = self.xmpp.jid_nick_map[jid]
-            self.special_rooms['control'].send_notice('{} available ({})'.format(name, jid))
+            self.presence_digest.update(jid, self.xmpp.jid_nick_map[jid], True)
 
     def xmpp_presence_unavailable(self, presence):
         """
         Handle a presence of type "unavailable".
 
-        Sends a notice to the control channel.
+        Adds it to the presence digest for the control channel.
 
         :param presence: The presence that was received.
         """
-        logging.debug('XMPP received {} : (unavailable)'.format(presence['from'].full))
+        logging.debug('XMPP received %s : (unavailable)', presence['from'])
 
         jid = presence['from'].bare
         if jid in self.disabled_jids:
             return
+        self.metrics.inc('presences', state='unavailable')
 
         if self.send_presences_to_control:
-            name = self.xmpp.jid_nick_map[jid]
-            self.special_rooms['control'].send_notice('{} unavailable ({})'.format(name, jid))
+            self.presence_digest.update(jid, self.xmpp.jid_nick_map[jid], False)
+
+    def xmpp_disconnected(self, _event):
+        """
+        Count lost XMPP connections; sleekxmpp reconnects by itself, and resumes the stream if it can.
+        """
+        self.metrics.inc('reconnects', side='xmpp')
+
+    def xmpp_session_start(self, _event):
+        """
+        Handle a new XMPP session, at startup or after a stream could not be resumed: rejoin the
+         group chats, and send the messages to XMPP which are still in the outbox.
+        Not called when a stream is resumed; the server keeps the session then.
+        """
+        self.metrics.inc('xmpp_sessions', kind='started')
+        # In the background: the joins are confirmed by presences which this thread has to handle
+        self.tasks.put('xmpp session', self.restore_xmpp_session)
+
+    def restore_xmpp_session(self):
+        """
+        Rejoin the group chats, then send the messages to XMPP which are still in the outbox
+         (messages to a group chat are only accepted once it was joined), and backfill what was
+         missed while there was no session.
+        Group chats which are backfilled from their archive are joined without history.
+        """
+        logging.debug('Rejoining group chats')
+        room_jids = self.registry.groupchat_jids()
+        archived = set()
+        if self.backfill is not None:
+            archived = {room_jid for room_jid in room_jids if self.backfill.checkpoint(room_jid) is not None}
+        self.join_groupchats(room_jids, without_history=archived)
+        self.resend_to_xmpp()
+
+        if self.backfill is not None:
+            for topic in self.registry.topics():
+                if topic.startswith(self.groupchat_flag):
+                    self.backfill.queue(topic[len(self.groupchat_flag):], groupchat=True)
+                else:
+                    self.backfill.queue(topic)
+
+    def join_groupchats(self, room_jids: List[str], report_room: MatrixRoom=None,
+                        without_history: Set[str]=frozenset()) -> List[str]:
+        """
+        Join group chats through the MUC join pipeline (see MucJoiner), and wait until all joins
+         finished.
+        :param room_jids: Group chats to join
+        :param report_room: (Optional) Room to report the progress to, e.g. the control room
+        :param without_history: Group chats to join without requesting their history
+        :return: Group chats which were joined
+        """
+        joined_jids = []
+        if not room_jids:
+            return joined_jids
+        futures = self.muc_joiner.join(room_jids, without_history)
+        step = max(1, len(futures) // 4)
+        joined = 0
+        failed = 0
+        for future in as_completed(futures):
+            try:
+                future.result()
+                joined += 1
+                joined_jids.append(futures[future])
+                self.metrics.inc('muc_joins', result='joined')
+            except MucJoinError as e:
+                failed += 1
+                self.metrics.inc('muc_joins', result='failed')
+                logging.warning('Joining group chat %s failed: %s', futures[future], e)
+                if report_room is not None:
+                    self.send_notice(report_room, 'Joining {} failed: {}'.format(futures[future], e))
+            finished = joined + failed
+            if report_room is not None and finished < len(futures) and finished % step == 0:
+                self.send_notice(report_room, 'Joined {} of {} group chats...'.format(joined, len(futures)))
+
+        logging.info('Joined %d of %d group chats', joined, len(futures))
+        if report_room is not None:
+            self.send_notice(report_room, 'Joined {} of {} group chats'.format(joined, len(futures)))
+        return joined_jids
+
+    def write_backfill(self, jid: str, messages: List[ArchivedMessage], last_id: str):
+        """
+        Queue a page of archived messages for the room of a JID, as one notice with a line per
+         message. Our own messages are left out (in a chat, they were most likely sent from Matrix).
+        :param jid: Contact or group chat
+        :param messages: Messages of the page
+        :param last_id: Archive id of the page's last message, the checkpoint once it was sent
+        """
+        groupchat = self.registry.is_groupchat(jid)
+        room = self.get_room_for_jid(self.groupchat_flag + jid if groupchat else jid)
+        if room is None:
+            self.backfill.page_written(jid, last_id)
+            return
+
+        lines = []
+        for message in messages:
+            sender = sleekxmpp.JID(message.sender)
+            if groupchat:
+                name = sender.resource
+                if self.groupchat_mute_own_nick and name == self.xmpp_groupchat_nick:
+                    continue
+            elif sender.bare == jid:
+                name = self.xmpp.jid_nick_map.get(jid, jid)
+            else:
+                continue
+            lines.append('[{}] {}: {}'.format(time.strftime('%Y-%m-%d %H:%M', time.localtime(message.stamp)),
+                                              name, message.body))
+        self.send_queue.put(room.room_id, self.deliver_backfill, room, jid, lines, last_id)
+
+    def deliver_backfill(self, room: MatrixRoom, jid: str, lines: List[str], last_id: str):
+        """
+        Send a page of archived messages, and move the backfill checkpoint after it. Runs in the send queue.
+        The transaction id is derived from the page, so a page which is sent again is not shown twice.
+        """
+        try:
+            if lines:
+                txn_id = 'backfill-' + hashlib.sha1('{} {}'.format(jid, last_id).encode()).hexdigest()
+                self.matrix.api.send_message_event(room.room_id, 'm.room.message',
+                                                   {'msgtype': 'm.notice', 'body': '\n'.join(lines)},
+                                                   txn_id=txn_id)
+        except Exception:
+            self.backfill.page_written(jid, None)
+            raise
+        self.backfill.page_written(jid, last_id)
+        self.metrics.inc('backfilled_messages', len(lines))
+
+    def xmpp_session_resumed(self, _event):
+        """
+        Handle a resumed XMPP stream. Unacknowledged stanzas were already resent by sleekxmpp; only
+         messages which arrived from Matrix while the connection was down are sent now.
+        """
+        self.metrics.inc('xmpp_sessions', kind='resumed')
+        self.resend_to_xmpp()
+
+    def resend_to_xmpp(self):
+        """
+        Send the messages to XMPP which are still in the outbox. They are handed to the dispatcher
+         behind the messages of their room which are already queued, see resend_entry_to_xmpp.
+        """
+        to_xmpp = self.outbox.pending(TO_XMPP)
+        if to_xmpp:
+            logging.info('Resending %d messages to XMPP', len(to_xmpp))
+        for entry in to_xmpp:
+            # Entries from before the room id was recorded are kept in order per JID
+            self.dispatcher.put(entry.get('room_id', entry['to']), self.resend_entry_to_xmpp, entry)
+
+    def resend_entry_to_xmpp(self, entry: Dict):
+        """
+        Send a message from the outbox to XMPP again, unless it was delivered or sent on the
+         current stream in the meantime (e.g. by the dispatcher, once the session had started).
+         Runs in the dispatcher.
+        """
+        if not self.outbox.is_pending(entry['id']):
+            return
+        if self.xmpp.stream_managed():
+            unacked = {stanza['id'] for _seq, stanza in list(self.xmpp.plugin['xep_0198'].unacked_queue)}
+            if entry['id'] in unacked:
+                logging.debug('Message %s was already sent, waiting for its acknowledgement', entry['id'])
+                return
+        self.deliver_to_xmpp(entry)
+
+    def xmpp_stanza_acked(self, stanza):
+        """
+        Mark a message to XMPP as delivered once the server acknowledged it (stream management).
+        """
+        if stanza.name == 'message' and stanza['id']:
+            self.outbox.done(stanza['id'])
 
     def xmpp_roster_update(self, _event):
         """
         Handle an XMPP roster update.
 
-        Maps all existing Matrix rooms, creates a new mapped room for each JID in the roster
-        which doesn't have one yet, and invites the users specified in the config in to all the rooms.
+        Compares the roster with the last one that was handled (at startup, with the contacts
+         which have a room, by room name), and only touches the rooms of JIDs which were added or
+         renamed: creates a new mapped room for each JID which doesn't have one yet, updates room
+         names, and invites the users specified in the config to existing rooms of added JIDs which
+         they are not in. The rooms are set up in the background by update_roster_rooms.
 
         :param _event: The received roster update event (unused).
         """
         logging.debug('######### ROSTER UPDATE ###########')
 
-        rjids = [jid for jid in self.xmpp.roster]
-        if len(rjids) > 1:
-            raise Exception('Not sure what to do with more than one roster...')
-
-        roster0 = self.xmpp.roster[rjids[0]]
+        # Only our own roster; a process may run bots for several accounts (see mxpp.runner)
+        roster0 = self.xmpp.roster[self.xmpp.boundjid.bare]
         self.xmpp.roster_dict = {jid: roster0[jid] for jid in roster0}
         roster = self.xmpp.roster_dict
 
-        self.map_rooms_by_topic()
-
-        # Create new rooms where none exist
+        jid_names = {}
         for jid, info in roster.items():
             if '@' not in jid:
-                logging.warning('Skipping fake jid in roster: ' + jid)
+                logging.warning('Skipping fake jid in roster: %s', jid)
                 continue
             if jid in self.disabled_jids:
                 continue
-            name = info['name']
+            jid_names[jid] = info['name']
+
+        added = [jid for jid in jid_names if jid not in self.roster_snapshot]
+        # Rooms of contacts without a name are named after the JID
+        renamed = [jid for jid in jid_names
+                   if jid in self.roster_snapshot and (self.roster_snapshot[jid] or jid) != (jid_names[jid] or jid)]
+        removed = [jid for jid in self.roster_snapshot if jid not in jid_names]
+        self.roster_snapshot = jid_names
+        logging.debug('Roster: %d added, %d renamed, %d removed', len(added), len(renamed), len(removed))
+
+        for jid in removed:
+            # Keep the nick and room, so late messages from this JID can still be bridged
+            logging.info('%s was removed from the roster', jid)
+
+        # All of them, since the contacts known from the rooms are not added
+        for jid, name in jid_names.items():
             self.xmpp.jid_nick_map[jid] = name
-            self.create_mapped_room(topic=jid, name=name)
 
-        logging.debug('Sending invitations..')
-        # Invite to all rooms
-        for room in self.matrix.get_rooms().values():
-            users_in_room = room.get_joined_members()
-            for user_id in self.users_to_invite:
-                if user_id not in users_in_room:
-                    room.invite_user(user_id)
+        # Rooms are set up in the background, so the XMPP thread keeps handling stanzas
+        existing = [jid for jid in added if jid in self.registry]
+        self.tasks.put('roster', self.update_roster_rooms, {jid: jid_names[jid] for jid in added + renamed}, existing)
 
         logging.debug('######## Done with roster update #######')
 
+    def update_roster_rooms(self, jid_names: Dict[str, str], existing: List[str]):
+        """
+        Create new rooms where none exist, update the names of existing rooms, and invite the
+         users specified in the config to the existing rooms.
+
+        :param jid_names: Map of JID -> name of the added and renamed JIDs
+        :param existing: Added JIDs which already had a room
+        """
+        self.provision_mapped_rooms(jid_names)
+
+        logging.debug('Sending invitations..')
+        # Rooms created now were created with their invitations
+        for jid in existing:
+            self.invite_missing_users(self.get_room_for_jid(jid))
+
 
 def main():
-    while True:
+    bot = None
+    while bot is None:
         try:
             bot = BridgeBot()
-            bot.matrix.listen_forever()
         except MatrixError as e:
-            logging.error('MatrixError: {}'.format(e))
-            pass
+            logging.error('MatrixError: %s', e)
+            time.sleep(MATRIX_RETRY_DELAY)
+    bot.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Set, Tuple
+from urllib.parse import unquote, urlsplit
+
+import requests
+from sleekxmpp.exceptions import IqError, IqTimeout
+from sleekxmpp.xmlstream import ET
+
+from mxpp.client_matrix import ClientMatrix
+from mxpp.client_xmpp import ClientXMPP
+
+HTTP_UPLOAD_NS = 'urn:xmpp:http:upload:0'
+OOB_NS = 'jabber:x:oob'
+CHUNK_SIZE = 64 * 1024
+# Headers of an upload slot which may be sent with the PUT request (XEP-0363)
+SLOT_HEADERS = ('Authorization', 'Cookie', 'Expires')
+MEDIA_MSGTYPES = ('m.image', 'm.file', 'm.video', 'm.audio')
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def oob_url(message) -> str or None:
+    """
+    :return: URL of a file attached to an XMPP message (XEP-0066), or None
+    """
+    return message.xml.findtext('{%s}x/{%s}url' % (OOB_NS, OOB_NS))
+
+
+def msgtype_for(content_type: str) -> str:
+    """
+    :return: Matrix msgtype for a MIME type
+    """
+    kind = content_type.split('/', 1)[0]
+    return {'image': 'm.image', 'video': 'm.video', 'audio': 'm.audio'}.get(kind, 'm.file')
+
+
+class MediaCache:
+    """
+    Remembers where media was uploaded to (the URL, or the content of the Matrix message), by
+     SHA-256 of the content and by source URL, so the same file (e.g. forwarded to several
+     contacts) is only uploaded once.
+
+    Entries are evicted least recently used first once the files they stand for add up to more
+     than max_bytes: old upload URLs may expire, and a file which was not sent for a while is
+     uploaded again. A file is counted once, under its hash; its source URLs are aliases, which
+     are evicted together with it.
+    """
+    max_bytes = 500 * 1024 * 1024   # type: int
+
+    def __init__(self, max_bytes: int=500 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()   # type: Dict[str, Tuple[Any, int]]
+        self._aliases = {}              # type: Dict[str, Tuple[str, Any]]
+        self._aliases_of = {}           # type: Dict[str, Set[str]]
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        """
+        :param key: Content hash or source URL, prefixed with the destination
+        :return: Value stored for key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+            alias = self._aliases.get(key)
+            if alias is None:
+                return None
+            self._entries.move_to_end(alias[0])
+            return alias[1]
+
+    def put(self, key: str, value: Any, size: int, alias: str=None):
+        """
+        :param key: Content hash, prefixed with the destination
+        :param value: Where the file was uploaded to
+        :param size: Size of the file in bytes
+        :param alias: (Optional) Source URL of the file, prefixed with the destination
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            if alias is not None:
+                old_alias = self._aliases.get(alias)
+                if old_alias is not None and old_alias[0] != key:
+                    self._aliases_of[old_alias[0]].discard(alias)
+                self._aliases[alias] = (key, value)
+                self._aliases_of.setdefault(key, set()).add(alias)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                evicted_key, (_value, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+                for evicted_alias in self._aliases_of.pop(evicted_key, ()):
+                    del self._aliases[evicted_alias]
+
+    def __len__(self) -> int:
+        """
+        :return: Number of files and aliases
+        """
+        with self._lock:
+            return len(self._entries) + len(self._aliases)
+
+
+class Download:
+    """
+    A file being transferred: streamed from a response into a SpooledTemporaryFile (in memory up
+     to spool_size bytes, then on disk), with its SHA-256 computed on the way.
+    """
+    def __init__(self, response: requests.Response, max_size: int, spool_size: int):
+        length = response.headers.get('Content-Length')
+        if length is not None and int(length) > max_size:
+            raise MediaTooLarge('{} bytes'.format(length))
+
+        self.content_type = response.headers.get('Content-Type', 'application/octet-stream').split(';')[0]
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.size = 0
+        sha256 = hashlib.sha256()
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                self.size += len(chunk)
+                if self.size > max_size:
+                    raise MediaTooLarge('more than {} bytes'.format(max_size))
+                sha256.update(chunk)
+                self.file.write(chunk)
+        except Exception:
+            self.file.close()
+            raise
+        finally:
+            response.close()
+        self.digest = sha256.hexdigest()
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+
+class MediaBridge:
+    """
+    Transfers attachments between Matrix (m.image, m.file, ... with mxc:// URLs) and XMPP (HTTP
+     upload, XEP-0363, announced as out of band data, XEP-0066).
+
+    Files are streamed in chunks of CHUNK_SIZE bytes and never held in memory as a whole; uploads
+     which were done before are found in the MediaCache instead of being repeated.
+    """
+    max_file_size = 50 * 1024 * 1024    # type: int
+    spool_size = 1024 * 1024            # type: int
+    timeout = 60.0                      # type: float
+
+    def __init__(self,
+                 matrix: ClientMatrix,
+                 xmpp: ClientXMPP,
+                 cache: MediaCache,
+                 upload_service: str=None,
+                 max_file_size: int=50 * 1024 * 1024,
+                 spool_size: int=1024 * 1024,
+                 timeout: float=60.0):
+        """
+        :param matrix: Matrix client, for the homeserver's media repository
+        :param xmpp: XMPP client
+        :param cache: Cache of earlier uploads
+        :param upload_service: (Optional) JID of the XMPP HTTP upload service; discovered on the
+                               server if not given
+        :param max_file_size: Files larger than this (in bytes) are not transferred, only linked
+        :param spool_size: Bytes of a file which are kept in memory; the rest is spooled to disk
+        :param timeout: Seconds to wait for an HTTP server or an upload slot
+        """
+        self.matrix = matrix
+        self.xmpp = xmpp
+        self.cache = cache
+        self.upload_service = upload_service
+        self.max_file_size = max_file_size
+        self.spool_size = spool_size
+        self.timeout = timeout
+        self.http = requests.Session()  # for the XMPP side; homeserver requests use the Matrix client's session
+        self._discovered = upload_service is not None
+
+    def to_matrix(self, url: str) -> Dict:
+        """
+        Copy a file from an XMPP (HTTP) URL to the homeserver's media repository.
+        :return: Content of the Matrix message for the file
+        """
+        content = self.cache.get('matrix ' + url)
+        if content is not None:
+            return content
+
+        name = unquote(os.path.basename(urlsplit(url).path)) or 'file'
+        response = self.http.get(url, stream=True, timeout=self.timeout)
+        response.raise_for_status()
+        download = Download(response, self.max_file_size, self.spool_size)
+        try:
+            content = self.cache.get('matrix ' + download.digest)
+            if content is None:
+                mxc_url = self.matrix.api.media_upload(download.file, download.content_type, name)['content_uri']
+                logging.debug('Uploaded %s (%d bytes) to %s', url, download.size, mxc_url)
+                content = {'msgtype': msgtype_for(download.content_type), 'body': name, 'url': mxc_url,
+                           'info': {'mimetype': download.content_type, 'size': download.size}}
+            else:
+                content = dict(content, body=name)
+            self.cache.put('matrix ' + download.digest, content, download.size, alias='matrix ' + url)
+        finally:
+            download.close()
+        return content
+
+    def to_xmpp(self, content: Dict) -> str or None:
+        """
+        Copy the file of a Matrix message to the XMPP server's HTTP upload service.
+        :param content: Content of an m.image, m.file, ... message
+        :return: URL to download the file from, or None if there is no upload service
+        """
+        mxc_url = content['url']
+        get_url = self.cache.get('xmpp ' + mxc_url)
+        if get_url is not None:
+            return get_url
+        service = self.find_upload_service()
+        if service is None:
+            return None
+
+        response = self.matrix.api.session.get(
+            self.matrix.api.get_download_url(mxc_url), stream=True, timeout=self.timeout,
+            headers={'Authorization': 'Bearer {}'.format(self.matrix.api.token)})
+        response.raise_for_status()
+        download = Download(response, self.max_file_size, self.spool_size)
+        try:
+            get_url = self.cache.get('xmpp ' + download.digest)
+            if get_url is None:
+                content_type = content.get('info', {}).get('mimetype', download.content_type)
+                get_url = self.http_upload(service, download, content.get('body') or 'file', content_type)
+            self.cache.put('xmpp ' + download.digest, get_url, download.size, alias='xmpp ' + mxc_url)
+        finally:
+            download.close()
+        return get_url
+
+    def download_url(self, content: Dict) -> str:
+        """
+        :return: The homeserver's HTTP URL for the file of a Matrix message
+        """
+        return self.matrix.api.get_download_url(content['url'])
+
+    def http_upload(self, service: str, download: Download, name: str, content_type: str) -> str:
+        """
+        Upload a file with XEP-0363: request a slot, and PUT the file to it.
+        :return: URL to download the file from
+        """
+        iq = self.xmpp.Iq()
+        iq['type'] = 'get'
+        iq['to'] = service
+        iq.append(ET.Element('{%s}request' % HTTP_UPLOAD_NS, {
+            'filename': name, 'size': str(download.size), 'content-type': content_type}))
+        slot = iq.send(timeout=self.timeout).xml.find('{%s}slot' % HTTP_UPLOAD_NS)
+        put = slot.find('{%s}put' % HTTP_UPLOAD_NS)
+        headers = {header.get('name'): header.text or '' for header in put.iterfind('{%s}header' % HTTP_UPLOAD_NS)
+                   if header.get('name') in SLOT_HEADERS}
+        headers.update({'Content-Type': content_type, 'Content-Length': str(download.size)})
+
+        response = self.http.put(put.get('url'), data=download.file, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        get_url = slot.find('{%s}get' % HTTP_UPLOAD_NS).get('url')
+        logging.debug('Uploaded %s (%d bytes) to %s', name, download.size, get_url)
+        return get_url
+
+    def find_upload_service(self) -> str or None:
+        """
+        :return: JID of the HTTP upload service (looked up once among the server's disco items), or None
+        """
+        if self._discovered:
+            return self.upload_service
+        disco = self.xmpp.plugin['xep_0030']
+        domain = self.xmpp.boundjid.domain
+        try:
+            candidates = [domain] + [item[0] for item in disco.get_items(jid=domain)['disco_items']['items']]
+            for jid in candidates:
+                if HTTP_UPLOAD_NS in disco.get_info(jid=jid)['disco_info']['features']:
+                    self.upload_service = jid
+                    break
+        except (IqError, IqTimeout) as e:
+            logging.warning('Looking for an HTTP upload service failed: %s', e)
+            return None
+        self._discovered = True
+        logging.info('HTTP upload service: %s', self.upload_service)
+        return self.upload_service
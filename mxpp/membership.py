@@ -0,0 +1,100 @@
+import threading
+from typing import Dict, Iterable, Set
+
+
+class MembershipIndex:
+    """
+    Joined and invited members of every room, kept up to date from m.room.member events.
+
+    A room is complete once its full member list was loaded (see set_members); before that, the
+     index only knows the members which showed up in member events (e.g. with lazy-loaded members),
+     and the number of joined members only if the sync sent it in the room summary.
+    """
+
+    def __init__(self):
+        self._joined = {}           # type: Dict[str, Set[str]]
+        self._invited = {}          # type: Dict[str, Set[str]]
+        self._complete = set()      # type: Set[str]
+        self._counts = {}           # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def process_event(self, event: Dict):
+        """
+        Update the index from an m.room.member state event.
+        :param event: The event, with its room_id filled in
+        """
+        room_id = event['room_id']
+        user_id = event['state_key']
+        membership = event['content'].get('membership')
+
+        with self._lock:
+            joined = self._joined.setdefault(room_id, set())
+            invited = self._invited.setdefault(room_id, set())
+            joined.discard(user_id)
+            invited.discard(user_id)
+            if membership == 'join':
+                joined.add(user_id)
+            elif membership == 'invite':
+                invited.add(user_id)
+
+    def set_members(self, room_id: str, joined: Iterable[str], invited: Iterable[str]):
+        """
+        Replace the members of a room with its full member list, and mark it as complete.
+        """
+        with self._lock:
+            self._joined[room_id] = set(joined)
+            self._invited[room_id] = set(invited)
+            self._complete.add(room_id)
+            self._counts.pop(room_id, None)
+
+    def set_joined_count(self, room_id: str, count: int):
+        """
+        Set the number of joined members of a room whose member list is not complete, e.g. from
+         the m.joined_member_count of a room summary. Ignored for complete rooms, which count their members.
+        """
+        with self._lock:
+            if room_id not in self._complete:
+                self._counts[room_id] = count
+
+    def forget(self, room_id: str):
+        """
+        Drop everything known about a room (e.g. after leaving it).
+        """
+        with self._lock:
+            self._joined.pop(room_id, None)
+            self._invited.pop(room_id, None)
+            self._complete.discard(room_id)
+            self._counts.pop(room_id, None)
+
+    def is_complete(self, room_id: str) -> bool:
+        return room_id in self._complete
+
+    def joined(self, room_id: str) -> Set[str]:
+        """
+        :return: Ids of the users which joined the room
+        """
+        with self._lock:
+            return set(self._joined.get(room_id, ()))
+
+    def invited(self, room_id: str) -> Set[str]:
+        """
+        :return: Ids of the users which were invited to the room
+        """
+        with self._lock:
+            return set(self._invited.get(room_id, ()))
+
+    def joined_count(self, room_id: str) -> int or None:
+        """
+        :return: Number of users which joined the room, or None if it is not known
+        """
+        with self._lock:
+            if room_id in self._complete:
+                return len(self._joined.get(room_id, ()))
+            return self._counts.get(room_id)
+
+    def is_member(self, room_id: str, user_id: str) -> bool:
+        """
+        :return: True if the user joined or was invited to the room
+        """
+        with self._lock:
+            return user_id in self._joined.get(room_id, ()) or user_id in self._invited.get(room_id, ())
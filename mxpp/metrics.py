@@ -0,0 +1,183 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import unquote
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def endpoint_label(path: str) -> str:
+    """
+    Turn a Matrix API path into a label with the ids left out, so all requests to the same
+     endpoint share one time series, e.g.
+     /_matrix/client/r0/rooms/%21abc%3Ahs/send/m.room.message/12 -> /rooms/{id}/send/m.room.message/{txn}
+
+    :param path: Path of the request url
+    """
+    parts = path.split('/')
+    if len(parts) > 3 and parts[1] == '_matrix':
+        parts = [''] + parts[4:]  # drop /_matrix/client/<version>
+    for i, part in enumerate(parts):
+        if unquote(part)[:1] in ('!', '@', '#', '$'):
+            parts[i] = '{id}'
+        elif i >= 2 and parts[i - 2] == 'send':
+            parts[i] = '{txn}'
+    return '/'.join(parts)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of the bridge, rendered in the Prometheus text format.
+
+    Counters and histograms are updated by the code that does the work (inc, observe);
+     gauges are functions which are called when the metrics are rendered.
+    """
+    prefix = 'mxpp_'            # type: str
+
+    def __init__(self):
+        self._counters = {}     # type: Dict[str, Dict[Labels, float]]
+        self._histograms = {}   # type: Dict[str, Dict[Labels, Histogram]]
+        self._gauges = {}       # type: Dict[str, Callable[[], float]]
+        self._help = {}         # type: Dict[str, str]
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, text: str):
+        """
+        Set the HELP text of a metric.
+        """
+        self._help[name] = text
+
+    def inc(self, name: str, amount: float=1, **labels):
+        """
+        Add to a counter.
+        :param name: Metric name, without prefix and without the _total suffix
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Add a value (usually a duration in seconds) to a histogram.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(LATENCY_BUCKETS)
+            series[key].observe(value)
+
+    def gauge(self, name: str, func: Callable[[], float]):
+        """
+        Register a gauge; func is called for its current value every time the metrics are read.
+        """
+        self._gauges[name] = func
+
+    def render(self) -> str:
+        """
+        :return: All metrics in the Prometheus text exposition format
+        """
+        lines = []  # type: List[str]
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                self._header(lines, name + '_total', 'counter')
+                for labels, value in sorted(series.items()):
+                    lines.append('{}{}_total{} {}'.format(self.prefix, name, self._labels(labels), value))
+
+            for name, series in sorted(self._histograms.items()):
+                self._header(lines, name, 'histogram')
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('{}{}_bucket{} {}'.format(
+                            self.prefix, name, self._labels(labels + (('le', le),)), cumulative))
+                    lines.append('{}{}_sum{} {}'.format(self.prefix, name, self._labels(labels), histogram.total))
+                    lines.append('{}{}_count{} {}'.format(self.prefix, name, self._labels(labels), cumulative))
+
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                logging.exception('Reading gauge %s failed', name)
+                continue
+            self._header(lines, name, 'gauge')
+            lines.append('{}{} {}'.format(self.prefix, name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines: List[str], name: str, metric_type: str):
+        base = name[:-len('_total')] if name.endswith('_total') else name
+        if base in self._help:
+            lines.append('# HELP {}{} {}'.format(self.prefix, name, self._help[base]))
+        lines.append('# TYPE {}{} {}'.format(self.prefix, name, metric_type))
+
+    @staticmethod
+    def _labels(labels: Labels) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for key, value in labels) + '}'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server which answers each request in its own daemon thread (http.server has one only
+     from Python 3.7 on). Also used for the appservice and the runner's health report.
+    """
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None              # type: Metrics
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer:
+    """
+    Serves the metrics on http://host:port/metrics in a background thread.
+    """
+    def __init__(self, metrics: Metrics, host: str='127.0.0.1', port: int=9105):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'metrics': metrics})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logging.info('Serving metrics on http://%s:%d/metrics', *self.httpd.server_address[:2])
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,208 @@
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Set
+
+from sleekxmpp.xmlstream import ET
+
+from mxpp.client_xmpp import ClientXMPP
+from mxpp.store import RoomStore
+
+MUC_NS = 'http://jabber.org/protocol/muc'
+MUC_USER_NS = 'http://jabber.org/protocol/muc#user'
+DELAY_NS = 'urn:xmpp:delay'
+LAST_SEEN_KEY = 'muc_last_seen:'    # room store key prefix for the time of the last bridged message
+
+
+class MucJoinError(Exception):
+    pass
+
+
+class MucJoiner:
+    """
+    Joins group chats with at most max_concurrent joins in flight, each waiting for the group
+     chat to confirm it (our own occupant presence) or refuse it.
+
+    A join only asks for the history since the last message which was bridged from that group
+     chat, and at most max_history messages of it; group chats from which nothing was bridged yet
+     send no history. History which was bridged before is recognized with is_new().
+    The time of the last bridged message is kept in the room store, written at most every
+     save_interval seconds per group chat, and when the joiner is stopped.
+    """
+    max_concurrent = 4          # type: int
+    timeout = 30.0              # type: float
+    max_history = 50            # type: int
+    save_interval = 10.0        # type: float
+
+    def __init__(self,
+                 xmpp: ClientXMPP,
+                 store: RoomStore,
+                 nick: str,
+                 max_concurrent: int=4,
+                 timeout: float=30.0,
+                 max_history: int=50,
+                 save_interval: float=10.0):
+        """
+        :param xmpp: XMPP client, with the xep_0045 plugin
+        :param store: Room store for the time of the last bridged message
+        :param nick: Nick to join the group chats with
+        :param max_concurrent: Number of joins in flight at the same time
+        :param timeout: Seconds to wait for a group chat to answer a join
+        :param max_history: Maximum number of history messages to request
+        :param save_interval: Minimum seconds between two writes of the last bridged time of a group chat
+        """
+        self.xmpp = xmpp
+        self.store = store
+        self.nick = nick
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.max_history = max_history
+        self.save_interval = save_interval
+
+        self._last_seen = {}        # type: Dict[str, float]
+        self._saved_at = {}         # type: Dict[str, float]
+        self._unsaved = set()       # type: Set[str]
+        self._waiting = {}          # type: Dict[str, threading.Event]
+        self._errors = {}           # type: Dict[str, str]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='muc-join')
+
+        xmpp.add_event_handler('groupchat_presence', self._presence)
+        xmpp.add_event_handler('presence_error', self._presence)
+
+    def join(self, room_jids: Iterable[str], without_history: Set[str]=frozenset()) -> Dict[Future, str]:
+        """
+        Queue joins of group chats.
+        :param without_history: Group chats whose history is not requested (e.g. because it is backfilled)
+        :return: Map of future -> room JID; a future's result() raises MucJoinError if the join failed
+        """
+        return {self._executor.submit(self._join, room_jid, room_jid not in without_history): room_jid
+                for room_jid in room_jids}
+
+    def stop(self):
+        """
+        Drop the joins which did not start yet, and save the times of the last bridged messages
+         which were not written yet.
+        """
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            unsaved = [(room_jid, self._last_seen[room_jid]) for room_jid in self._unsaved]
+            self._unsaved.clear()
+        for room_jid, timestamp in unsaved:
+            self.store.set_value(LAST_SEEN_KEY + room_jid, repr(timestamp))
+
+    def last_seen(self, room_jid: str) -> float or None:
+        """
+        :return: Time (seconds since the epoch) of the last message bridged from a group chat, or None
+        """
+        with self._lock:
+            if room_jid not in self._last_seen:
+                value = self.store.get_value(LAST_SEEN_KEY + room_jid)
+                if value is None:
+                    return None
+                self._last_seen[room_jid] = float(value)
+            return self._last_seen[room_jid]
+
+    def is_new(self, room_jid: str, message) -> bool:
+        """
+        :param message: Groupchat message
+        :return: False for history resent by the group chat which is not newer than the last bridged message
+        """
+        if message.xml.find('{%s}delay' % DELAY_NS) is None:
+            return True
+        last_seen = self.last_seen(room_jid)
+        return last_seen is None or message['delay']['stamp'].timestamp() > last_seen
+
+    def seen(self, room_jid: str, message):
+        """
+        Remember that a groupchat message was bridged.
+        """
+        if message.xml.find('{%s}delay' % DELAY_NS) is not None:
+            timestamp = message['delay']['stamp'].timestamp()
+        else:
+            timestamp = time.time()
+        now = time.monotonic()
+        with self._lock:
+            timestamp = max(timestamp, self._last_seen.get(room_jid, 0.0))
+            self._last_seen[room_jid] = timestamp
+            if now - self._saved_at.get(room_jid, float('-inf')) < self.save_interval:
+                self._unsaved.add(room_jid)
+                return
+            self._saved_at[room_jid] = now
+            self._unsaved.discard(room_jid)
+        self.store.set_value(LAST_SEEN_KEY + room_jid, repr(timestamp))
+
+    def forget(self, room_jid: str):
+        """
+        Forget the last bridged message of a group chat which was left.
+        """
+        with self._lock:
+            self._last_seen.pop(room_jid, None)
+            self._saved_at.pop(room_jid, None)
+            self._unsaved.discard(room_jid)
+        self.store.set_value(LAST_SEEN_KEY + room_jid, None)
+
+    def join_presence(self, room_jid: str, history: bool=True):
+        """
+        :param history: Request the history since the last bridged message
+        :return: Presence which joins a group chat, with the history limits
+        """
+        presence = self.xmpp.make_presence(pto='{}/{}'.format(room_jid, self.nick))
+        x = ET.Element('{%s}x' % MUC_NS)
+        history_el = ET.SubElement(x, '{%s}history' % MUC_NS)
+        last_seen = self.last_seen(room_jid) if history else None
+        if last_seen is None:
+            history_el.attrib['maxchars'] = '0'
+        else:
+            history_el.attrib['maxstanzas'] = str(self.max_history)
+            history_el.attrib['since'] = datetime.datetime.fromtimestamp(
+                last_seen, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        presence.append(x)
+        return presence
+
+    # Internals
+
+    def _join(self, room_jid: str, history: bool):
+        answered = threading.Event()
+        with self._lock:
+            self._waiting[room_jid] = answered
+            self._errors.pop(room_jid, None)
+
+        # Same bookkeeping as xep_0045.joinMUC, so the plugin tracks the occupants and leaveMUC works
+        muc = self.xmpp.plugin['xep_0045']
+        muc.rooms[room_jid] = {}
+        muc.ourNicks[room_jid] = self.nick
+        started = time.monotonic()
+        self.xmpp.send(self.join_presence(room_jid, history))
+
+        answered.wait(self.timeout)
+        with self._lock:
+            del self._waiting[room_jid]
+            error = self._errors.pop(room_jid, None)
+        if error is None and not answered.is_set():
+            error = 'no answer within {}s'.format(self.timeout)
+        if error is not None:
+            muc.rooms.pop(room_jid, None)
+            muc.ourNicks.pop(room_jid, None)
+            raise MucJoinError(error)
+        logging.debug('Joined group chat %s in %.2fs', room_jid, time.monotonic() - started)
+
+    def _presence(self, presence):
+        room_jid = presence['from'].bare
+        with self._lock:
+            answered = self._waiting.get(room_jid)
+            if answered is None:
+                return
+            if presence['type'] == 'error':
+                self._errors[room_jid] = presence['error']['condition'] or 'error'
+            elif presence['from'].resource != self.nick and not self._is_self_presence(presence):
+                return
+            answered.set()
+
+    @staticmethod
+    def _is_self_presence(presence) -> bool:
+        # Status 110: the presence is about us, e.g. if the group chat changed our nick
+        return any(status.get('code') == '110'
+                   for status in presence.xml.iterfind('{%s}x/{%s}status' % (MUC_USER_NS, MUC_USER_NS)))
@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, List
+
+TO_MATRIX = 'to_matrix'
+TO_XMPP = 'to_xmpp'
+
+
+class Outbox:
+    """
+    Append-only journal of bridged messages, so a message which was received but not delivered
+     yet survives a crash or restart and is sent again on the next start.
+
+    Every message gets an id which is also used as the Matrix transaction id or XMPP stanza id,
+     so sending it again does not create a duplicate. add() only returns once the message is on
+     disk; concurrent add() calls share one write and fsync (group commit). Delivered messages are
+     marked with done() without waiting for the disk.
+
+    The file holds one JSON record per line: {"op": "add", "id": ..., ...}, {"op": "done", "id": ...}
+     or {"op": "merge", "merged": [ids], "id": ..., ...}.
+     It is rewritten with only the undelivered messages on startup and whenever it grew by
+     compact_after records.
+    """
+    compact_after = 10000       # type: int
+    remember_done = 1000        # type: int
+
+    def __init__(self, path: str, compact_after: int=10000):
+        """
+        :param path: Journal file, created if it does not exist
+        :param compact_after: Number of records written before the file is compacted
+        """
+        self.path = path
+        self.compact_after = compact_after
+
+        self._pending = OrderedDict()       # type: Dict[str, Dict]
+        self._done = OrderedDict()          # type: Dict[str, None]
+        self._buffer = []                   # type: List[str]
+        self._queued = 0                    # sequence number of the last record handed to the writer
+        self._synced = 0                    # sequence number of the last record on disk
+        self._written = 0                   # records written since the last compaction
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._load()
+        self._compact()
+        self._thread = threading.Thread(target=self._write, name='outbox', daemon=True)
+        self._thread.start()
+
+    def add(self, direction: str, entry_id: str=None, wait: bool=True, **fields) -> Dict or None:
+        """
+        Record a message before it is sent. Blocks until the record was written to disk.
+
+        :param direction: TO_MATRIX or TO_XMPP
+        :param entry_id: (Optional) Id of the message, e.g. the id of the Matrix event it was received
+                         as; a random one is used if not given
+        :param wait: Wait for the disk; if False, call flush() before relying on the record
+        :param fields: Whatever is needed to send the message (room_id, body, ...)
+        :return: The entry with its id, or None if a message with this id was recorded before
+        """
+        entry = dict(fields, id=entry_id or uuid.uuid4().hex, direction=direction)
+        with self._cond:
+            if entry['id'] in self._pending or entry['id'] in self._done:
+                return None
+            self._pending[entry['id']] = entry
+            seq = self._append(dict(entry, op='add'))
+            if wait:
+                self._cond.wait_for(lambda: self._synced >= seq)
+        return entry
+
+    def done(self, entry_id: str):
+        """
+        Mark a message as delivered.
+        """
+        with self._cond:
+            if self._pending.pop(entry_id, None) is None:
+                return
+            self._remember_done(entry_id)
+            self._append({'op': 'done', 'id': entry_id})
+
+    def merge(self, entry_ids: List[str], direction: str, **fields) -> Dict:
+        """
+        Replace undelivered messages by one message (e.g. several messages sent as one event).
+         Blocks until the record was written to disk. The replacement is a single record, so after a
+         crash either the messages or the one which replaced them are sent again, never both.
+
+        :param entry_ids: Ids of the messages which are replaced
+        :param direction: TO_MATRIX or TO_XMPP
+        :param fields: Whatever is needed to send the new message
+        :return: The new entry with its id
+        """
+        entry = dict(fields, id=uuid.uuid4().hex, direction=direction)
+        with self._cond:
+            for entry_id in entry_ids:
+                if self._pending.pop(entry_id, None) is not None:
+                    self._remember_done(entry_id)
+            self._pending[entry['id']] = entry
+            seq = self._append(dict(entry, op='merge', merged=list(entry_ids)))
+            self._cond.wait_for(lambda: self._synced >= seq)
+        return entry
+
+    def pending(self, direction: str=None) -> List[Dict]:
+        """
+        :param direction: (Optional) Only return messages in this direction
+        :return: Messages which were recorded but not delivered, oldest first
+        """
+        with self._cond:
+            return [entry for entry in self._pending.values()
+                    if direction is None or entry['direction'] == direction]
+
+    def is_pending(self, entry_id: str) -> bool:
+        """
+        :return: True if the message was recorded but not delivered
+        """
+        with self._cond:
+            return entry_id in self._pending
+
+    def flush(self):
+        """
+        Wait until everything recorded so far is on disk.
+        """
+        with self._cond:
+            seq = self._queued
+            self._cond.wait_for(lambda: self._synced >= seq)
+
+    def close(self):
+        """
+        Write what was recorded so far, and stop the writer thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    # Internals
+
+    def _append(self, record: Dict) -> int:
+        # called with self._cond held
+        self._buffer.append(json.dumps(record) + '\n')
+        self._queued += 1
+        self._cond.notify_all()
+        return self._queued
+
+    def _remember_done(self, entry_id: str):
+        self._done[entry_id] = None
+        if len(self._done) > self.remember_done:
+            self._done.popitem(last=False)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn write at the end of the file: that message was never acknowledged
+                    logging.warning('Ignoring damaged outbox record in %s', self.path)
+                    continue
+                op = record.pop('op')
+                if op == 'add':
+                    self._pending[record['id']] = record
+                elif op == 'merge':
+                    for entry_id in record.pop('merged'):
+                        if self._pending.pop(entry_id, None) is not None:
+                            self._remember_done(entry_id)
+                    self._pending[record['id']] = record
+                elif op == 'done' and self._pending.pop(record['id'], None) is not None:
+                    self._remember_done(record['id'])
+        if self._pending:
+            logging.info('Outbox has %d undelivered messages', len(self._pending))
+
+    def _compact(self):
+        """
+        Rewrite the journal with only the undelivered messages (and the ids of recently delivered
+         ones, so they are still recognized as duplicates). Called with self._cond held or before
+         the writer thread started.
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as journal:
+            for entry_id in self._done:
+                journal.write(json.dumps({'op': 'add', 'id': entry_id, 'direction': None}) + '\n')
+                journal.write(json.dumps({'op': 'done', 'id': entry_id}) + '\n')
+            for entry in self._pending.values():
+                journal.write(json.dumps(dict(entry, op='add')) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a')
+        self._written = 0
+
+    def _write(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buffer) > 0 or self._closed)
+                if not self._buffer:
+                    self._file.close()
+                    return
+                lines, self._buffer = self._buffer, []
+                seq = self._queued
+
+            self._file.write(''.join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+            with self._cond:
+                self._synced = seq
+                self._written += len(lines)
+                if self._written >= self.compact_after and not self._buffer:
+                    self._file.close()
+                    self._compact()
+                self._cond.notify_all()
@@ -0,0 +1,77 @@
+import threading
+from typing import Callable, Dict, Tuple
+
+
+class PresenceDigest:
+    """
+    Collects presence changes for a short window, and reports them all at once.
+
+    Only the last state of each JID within the window counts, and a JID which ends the window in
+     the state it was in before (e.g. a quick reconnect) is not reported at all.
+    """
+    window = 5.0                # type: float
+    live_table = False          # type: bool
+
+    def __init__(self, publish: Callable[[str], None], window: float=5.0, live_table: bool=False):
+        """
+        :param publish: Called with the text to show after every window with changes
+        :param window: Seconds to collect presence changes before publishing them
+        :param live_table: Publish a table of all known JIDs instead of only the changes
+        """
+        self.publish = publish
+        self.window = window
+        self.live_table = live_table
+
+        self._pending = {}          # type: Dict[str, Tuple[str, bool]]
+        self._states = {}           # type: Dict[str, Tuple[str, bool]]
+        self._timer = None          # type: threading.Timer
+        self._lock = threading.Lock()
+
+    def update(self, jid: str, name: str, available: bool):
+        """
+        Record a presence change. Publishing happens at the end of the window.
+        :param jid: Bare JID
+        :param name: Name of the contact
+        :param available: True for "available", False for "unavailable"
+        """
+        with self._lock:
+            self._pending[jid] = (name, available)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Publish the changes collected so far.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._timer = None
+
+            changes = {jid: state for jid, state in pending.items()
+                       if jid not in self._states or self._states[jid][1] != state[1]}
+            self._states.update(pending)
+            if not changes:
+                return
+
+            if self.live_table:
+                text = self.format(self._states)
+            else:
+                text = self.format(changes)
+
+        self.publish(text)
+
+    @staticmethod
+    def format(states: Dict[str, Tuple[str, bool]]) -> str:
+        """
+        :param states: Map of JID -> (name, available)
+        :return: Lines of available, then unavailable contacts
+        """
+        lines = []
+        for label, available in (('available', True), ('unavailable', False)):
+            entries = sorted('{} ({})'.format(name, jid) for jid, (name, state) in states.items()
+                             if state == available)
+            if entries:
+                lines.append('{} {}: {}'.format(len(entries), label, ', '.join(entries)))
+        return '\n'.join(lines)
@@ -0,0 +1,157 @@
+import json
+import logging
+import threading
+import time
+from typing import Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from mxpp.metrics import Metrics, endpoint_label
+
+DEFAULT_RETRY_AFTER = 5.0
+
+
+class TokenBucket:
+    """
+    Token bucket shared by everything that talks to one homeserver.
+
+    Holds up to `burst` tokens, refilled at `rate` tokens per second. A rate of 0 disables
+     the limit, but pause() still works.
+    """
+    rate = 0.0              # type: float
+    burst = 1               # type: int
+
+    def __init__(self, rate: float=0, burst: int=1):
+        """
+        :param rate: Requests per second
+        :param burst: Number of requests which may be sent at once after an idle period
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, waiting until one is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate > 0:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if now >= self._paused_until:
+                    if self.rate <= 0:
+                        return
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Stop handing out tokens for the given time, e.g. after the server asked us to slow down.
+        :param seconds: Time to wait before the next request
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+def retry_after(response: requests.Response) -> float:
+    """
+    Read the requested wait time from an M_LIMIT_EXCEEDED (HTTP 429) response.
+
+    :param response: Response with status code 429
+    :return: Time to wait in seconds
+    """
+    try:
+        content = response.json()
+        if 'retry_after_ms' not in content and 'error' in content:
+            # Some homeservers wrap the real error as a JSON string
+            content = json.loads(content['error'])
+        return content['retry_after_ms'] / 1000
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class RateLimitedSession(requests.Session):
+    """
+    requests Session which paces requests through a TokenBucket and retries
+     requests which were rejected with HTTP 429.
+
+    Long-polling endpoints (/sync) are not counted against the bucket, but do honour 429 pauses.
+    If metrics are given, every attempt is counted and timed per endpoint.
+
+    Connections are kept alive and pooled; the pool should hold a connection for every thread
+     that talks to the homeserver at the same time, otherwise connections are closed after use and
+     every request pays for a new TCP (and TLS) handshake.
+    """
+    bucket = None               # type: TokenBucket
+    metrics = None              # type: Metrics
+    unlimited_paths = ('/sync',)  # type: Tuple[str, ...]
+
+    def __init__(self, bucket: TokenBucket, metrics: Metrics=None, pool_size: int=10, adapter: HTTPAdapter=None):
+        """
+        :param bucket: Token bucket to take a token from for every request
+        :param metrics: (Optional) Metrics in which every request is counted and timed
+        :param pool_size: Number of connections kept open to the homeserver
+        :param adapter: (Optional) Adapter whose connection pool is shared with other sessions to the
+                        same homeserver (e.g. other accounts in mxpp.runner); pool_size is ignored then
+        """
+        super().__init__()
+        self.bucket = bucket
+        self.metrics = metrics
+        if adapter is None:
+            adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        path = urlsplit(url).path
+        limited = not path.endswith(self.unlimited_paths)
+        while True:
+            if limited:
+                self.bucket.acquire()
+
+            response = self._timed_request(method, url, path, *args, **kwargs)
+            if response.status_code != 429:
+                return response
+
+            wait = retry_after(response)
+            logging.warning('Rate limited on %s %s, waiting %.1fs', method, path, wait)
+            self.bucket.pause(wait)
+            if not limited:
+                time.sleep(wait)
+            if hasattr(kwargs.get('data'), 'seek'):
+                kwargs['data'].seek(0)  # a streamed upload is sent again from the start
+
+    def _timed_request(self, method, url, path, *args, **kwargs) -> requests.Response:
+        if self.metrics is None:
+            return super().request(method, url, *args, **kwargs)
+
+        endpoint = endpoint_label(path)
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            self.metrics.inc('matrix_requests', method=method, endpoint=endpoint, status='error')
+            raise
+        self.metrics.observe('matrix_request_seconds', time.monotonic() - start, method=method, endpoint=endpoint)
+        self.metrics.inc('matrix_requests', method=method, endpoint=endpoint, status=str(response.status_code))
+        return response
@@ -0,0 +1,113 @@
+import threading
+from typing import Dict, List, Set
+
+from matrix_client.room import Room as MatrixRoom
+
+
+class RoomRegistry:
+    """
+    Indexes of the rooms the bridge uses, so the message handlers only need dict and set lookups.
+
+    Mapped rooms are indexed by topic (a contact's JID, or groupchat_flag + a MUC's JID) and by
+     room id. The JIDs of groupchats and the special rooms (control, all-chat) are kept separately.
+    Rooms are always stored as MatrixRoom objects.
+    """
+    groupchat_flag = None           # type: str
+
+    def __init__(self, groupchat_flag: str, special_topics: List[str]):
+        """
+        :param groupchat_flag: Prefix of the topic of groupchat rooms
+        :param special_topics: Topics of the special rooms
+        """
+        self.groupchat_flag = groupchat_flag
+
+        self._rooms = {}                # type: Dict[str, MatrixRoom]
+        self._topics = {}               # type: Dict[str, str]
+        self._groupchat_jids = set()    # type: Set[str]
+        self._special_rooms = {topic: None for topic in special_topics}  # type: Dict[str, MatrixRoom]
+        self._special_room_ids = set()  # type: Set[str]
+        self._lock = threading.Lock()
+
+    def add(self, topic: str, room: MatrixRoom):
+        """
+        Map a topic to a room. Replaces an older room with the same topic.
+        """
+        with self._lock:
+            old_room = self._rooms.get(topic)
+            if old_room is not None:
+                del self._topics[old_room.room_id]
+            self._rooms[topic] = room
+            self._topics[room.room_id] = topic
+            if topic.startswith(self.groupchat_flag):
+                self._groupchat_jids.add(topic[len(self.groupchat_flag):])
+
+    def remove(self, room_id: str):
+        """
+        Remove a mapped room (e.g. after leaving it). Does nothing for unknown rooms.
+        """
+        with self._lock:
+            topic = self._topics.pop(room_id, None)
+            if topic is None:
+                return
+            del self._rooms[topic]
+            if topic.startswith(self.groupchat_flag):
+                self._groupchat_jids.discard(topic[len(self.groupchat_flag):])
+
+    def get(self, topic: str) -> MatrixRoom or None:
+        """
+        :return: The room mapped to the topic, or None
+        """
+        return self._rooms.get(topic)
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self._rooms
+
+    def topics(self) -> List[str]:
+        """
+        :return: Topics of all mapped rooms
+        """
+        return list(self._rooms.keys())
+
+    def topic_for(self, room_id: str) -> str or None:
+        """
+        :return: The topic the room is mapped to, or None for unmapped rooms
+        """
+        return self._topics.get(room_id)
+
+    def add_groupchat(self, room_jid: str):
+        """
+        Remember a groupchat JID, even if it has no room (yet).
+        """
+        self._groupchat_jids.add(room_jid)
+
+    def is_groupchat(self, jid: str) -> bool:
+        return jid in self._groupchat_jids
+
+    def groupchat_jids(self) -> List[str]:
+        return list(self._groupchat_jids)
+
+    def special_topics(self) -> List[str]:
+        return list(self._special_rooms.keys())
+
+    def special_room(self, topic: str) -> MatrixRoom or None:
+        """
+        :return: The special room with this topic, or None if it was not set up (yet)
+        """
+        return self._special_rooms.get(topic)
+
+    def set_special_room(self, topic: str, room: MatrixRoom):
+        with self._lock:
+            old_room = self._special_rooms.get(topic)
+            if old_room is not None:
+                self._special_room_ids.discard(old_room.room_id)
+            self._special_rooms[topic] = room
+            self._special_room_ids.add(room.room_id)
+
+    def is_special(self, room_id: str) -> bool:
+        return room_id in self._special_room_ids
+
+    def is_known(self, room_id: str) -> bool:
+        """
+        :return: True if the room is mapped or special
+        """
+        return room_id in self._topics or room_id in self._special_room_ids
@@ -0,0 +1,315 @@
+"""
+Runs the bridges of several accounts (tenants) in one supervised pool of processes.
+
+    python3 -m mxpp.runner [tenants.yaml]
+
+Every account keeps its own config file, as for mxpp.main; the runner's config lists them:
+
+    processes: 2            # worker processes the accounts are spread across
+    pool_size: 32           # connections kept open to each homeserver, per process
+    restart_delay: 10       # seconds before a failed account is started again (doubled up to max_restart_delay)
+    max_restart_delay: 300
+    report_interval: 10     # seconds between health reports of the worker processes
+    health:                 # (Optional) serves the health of every account as JSON on http://host:port/health
+      host: 127.0.0.1
+      port: 9106
+    tenants:
+      - name: alice
+        config: alice/config.yaml
+      - name: bob
+        config: bob/config.yaml
+
+Within a worker process, each account is a BridgeBot running in its own thread, so the accounts
+ share the interpreter, the imported modules and, per homeserver, one pool of HTTP connections.
+An account which fails is stopped and started again on its own; a worker process which dies is
+ started again with its accounts.
+"""
+import json
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, List, Tuple
+
+from requests.adapters import HTTPAdapter
+
+from mxpp.main import BridgeBot, read_config
+from mxpp.metrics import ThreadingHTTPServer
+
+TENANTS_FILE = 'tenants.yaml'
+
+
+class Tenant:
+    """
+    One account, supervised in its own thread: its BridgeBot is started, and after it failed,
+     stopped and started again restart_delay seconds later. The delay doubles with every failure
+     in a row, up to max_restart_delay, and is reset once the bot ran for max_restart_delay seconds.
+    """
+    restart_delay = 10.0        # type: float
+    max_restart_delay = 300.0   # type: float
+
+    def __init__(self,
+                 name: str,
+                 config: Dict,
+                 adapter: HTTPAdapter=None,
+                 restart_delay: float=10.0,
+                 max_restart_delay: float=300.0):
+        """
+        :param name: Name of the account in logs and health reports
+        :param config: Parsed config of the account's BridgeBot
+        :param adapter: (Optional) HTTP adapter shared with the other accounts on the same homeserver
+        :param restart_delay: Seconds to wait before the first restart
+        :param max_restart_delay: Maximum seconds to wait before a restart
+        """
+        self.name = name
+        self.config = config
+        self.adapter = adapter
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        self.bot = None             # type: BridgeBot
+        self.state = 'new'
+        self.restarts = 0
+        self.last_error = None      # type: str
+        self.started_at = None      # type: float
+        self._thread = threading.Thread(target=self._supervise, name='tenant-' + name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def health(self) -> Dict:
+        """
+        :return: State of the account: new, starting, running or restarting, with the bot's own health while it runs
+        """
+        health = {'state': self.state, 'restarts': self.restarts, 'last_error': self.last_error,
+                  'started_at': self.started_at}
+        bot = self.bot
+        if self.state == 'running' and bot is not None:
+            try:
+                health.update(bot.health())
+            except Exception as e:
+                health['health_error'] = repr(e)
+        return health
+
+    def _supervise(self):
+        delay = self.restart_delay
+        while True:
+            self.state = 'starting'
+            started = time.monotonic()
+            try:
+                # A bot which fails during setup stops itself, so nothing is left to clean up here
+                self.bot = BridgeBot(config=self.config, http_adapter=self.adapter)
+                self.state = 'running'
+                self.started_at = time.time()
+                self.bot.run()
+                self.last_error = 'stopped'
+            except Exception as e:
+                logging.exception('Account %s failed', self.name)
+                self.last_error = repr(e)
+
+            if self.bot is not None:
+                try:
+                    self.bot.stop()
+                except Exception:
+                    logging.exception('Stopping account %s failed', self.name)
+                self.bot = None
+            if time.monotonic() - started >= self.max_restart_delay:
+                delay = self.restart_delay
+            self.state = 'restarting'
+            self.restarts += 1
+            logging.info('Restarting account %s in %ss', self.name, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_restart_delay)
+
+
+def run_worker(tenants: List[Dict], options: Dict, reports: multiprocessing.Queue):
+    """
+    Entry point of a worker process: run the accounts as Tenant threads, and put a health
+     report {name: health} into reports every report_interval seconds.
+    :param tenants: List of {'name', 'config'} with the parsed config of each account
+    :param options: The runner's options (pool_size, restart_delay, max_restart_delay, report_interval)
+    """
+    # One connection pool per homeserver, shared by all accounts on it
+    adapters = {}   # type: Dict[str, HTTPAdapter]
+    running = []    # type: List[Tenant]
+    for tenant in tenants:
+        base_url = tenant['config']['matrix']['server']['base_url']
+        if base_url not in adapters:
+            adapters[base_url] = HTTPAdapter(pool_maxsize=options['pool_size'])
+        running.append(Tenant(tenant['name'], tenant['config'], adapters[base_url],
+                              options['restart_delay'], options['max_restart_delay']))
+    for tenant in running:
+        tenant.start()
+
+    while True:
+        reports.put({tenant.name: tenant.health() for tenant in running})
+        time.sleep(options['report_interval'])
+
+
+class Runner:
+    """
+    Spreads the accounts across a pool of worker processes, restarts worker processes which
+     died, and collects the health reports of all accounts.
+
+    Accounts on the same homeserver are put into the same process where the split allows it, so
+     they share its connection pool.
+    """
+    def __init__(self,
+                 tenants: List[Dict],
+                 processes: int=2,
+                 pool_size: int=32,
+                 restart_delay: float=10.0,
+                 max_restart_delay: float=300.0,
+                 report_interval: float=10.0):
+        """
+        :param tenants: List of {'name', 'config'} with the parsed config of each account
+        :param processes: Number of worker processes
+        :param pool_size: Connections kept open to each homeserver, per process
+        :param restart_delay: Seconds before a failed account is started again
+        :param max_restart_delay: Maximum seconds before a failed account is started again
+        :param report_interval: Seconds between the health reports of the worker processes
+        """
+        check_tenants(tenants)
+        self.options = {'pool_size': pool_size, 'restart_delay': restart_delay,
+                        'max_restart_delay': max_restart_delay, 'report_interval': report_interval}
+        self.shards = shard(tenants, processes)
+        self.health = {tenant['name']: {'state': 'new'} for tenant in tenants}   # type: Dict[str, Dict]
+        self.reported_at = {}       # type: Dict[str, float]
+
+        # Worker processes don't inherit the runner's threads (health server) or locks
+        self._context = multiprocessing.get_context('spawn')
+        self._reports = self._context.Queue()
+        self._processes = [None] * len(self.shards)     # type: List[multiprocessing.Process]
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(len(self.shards)):
+            self._start_process(i)
+
+    def serve_forever(self):
+        """
+        Collect health reports, and start worker processes again which died.
+        """
+        while True:
+            try:
+                report = self._reports.get(timeout=self.options['report_interval'])
+            except queue.Empty:
+                report = {}
+            now = time.time()
+            with self._lock:
+                for name, health in report.items():
+                    self.health[name] = health
+                    self.reported_at[name] = now
+
+            for i, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logging.error('Worker process %s exited with %s, starting it again', process.pid, process.exitcode)
+                    self._start_process(i)
+
+    def health_report(self) -> Dict:
+        """
+        :return: Map of account name -> health, with the age of the last report in seconds
+        """
+        now = time.time()
+        with self._lock:
+            return {name: dict(health, report_age=now - self.reported_at[name] if name in self.reported_at else None)
+                    for name, health in self.health.items()}
+
+    def healthy(self) -> bool:
+        """
+        :return: True if every account is running and reported recently
+        """
+        return all(health['state'] == 'running' and health['report_age'] is not None
+                   and health['report_age'] < 3 * self.options['report_interval']
+                   for health in self.health_report().values())
+
+    def _start_process(self, i: int):
+        process = self._context.Process(target=run_worker, args=(self.shards[i], self.options, self._reports),
+                                        name='mxpp-worker-{}'.format(i), daemon=True)
+        process.start()
+        self._processes[i] = process
+        logging.info('Worker process %s runs %s',
+                     process.pid, ', '.join(tenant['name'] for tenant in self.shards[i]))
+
+
+def shard(tenants: List[Dict], processes: int) -> List[List[Dict]]:
+    """
+    Split the accounts into at most `processes` shards of nearly equal size, keeping accounts on
+     the same homeserver next to each other.
+    """
+    ordered = sorted(tenants, key=lambda tenant: tenant['config']['matrix']['server']['base_url'])
+    processes = max(1, min(processes, len(ordered)))
+    size, extra = divmod(len(ordered), processes)
+    shards = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        shards.append(ordered[start:end])
+        start = end
+    return shards
+
+
+def check_tenants(tenants: List[Dict]):
+    """
+    :raises ValueError: if accounts share a name, or a file or port which each bot needs for itself
+    """
+    used = {}   # type: Dict[Tuple[str, str], str]
+    for tenant in tenants:
+        config = tenant['config']
+        keys = [('name', tenant['name']),
+                ('store_file', config.get('store_file', BridgeBot.store_file)),
+                ('outbox_file', config.get('outbox_file', BridgeBot.outbox_file))]
+        # Listening ports, which a restarted account could never bind again
+        metrics = config.get('metrics', {})
+        if metrics.get('enabled', False):
+            keys.append(('port', metrics.get('port', 9105)))
+        appservice = config.get('appservice', {})
+        if appservice.get('enabled', False):
+            keys.append(('port', appservice.get('port', 8090)))
+        for key, value in keys:
+            if (key, value) in used:
+                raise ValueError('Accounts {} and {} have the same {}: {}'.format(
+                    used[key, value], tenant['name'], key, value))
+            used[key, value] = tenant['name']
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    runner = None               # type: Runner
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/health':
+            self.send_error(404)
+            return
+        body = json.dumps(self.runner.health_report(), indent=2, sort_keys=True).encode()
+        self.send_response(200 if self.runner.healthy() else 503)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    config = read_config(sys.argv[1] if len(sys.argv) > 1 else TENANTS_FILE)
+    tenants = [{'name': tenant['name'], 'config': read_config(tenant['config'])} for tenant in config['tenants']]
+    runner = Runner(tenants, **{key: value for key, value in config.items()
+                                if key in ('processes', 'pool_size', 'restart_delay', 'max_restart_delay',
+                                           'report_interval')})
+    runner.start()
+
+    if 'health' in config:
+        handler = type('HealthHandler', (_HealthHandler,), {'runner': runner})
+        httpd = ThreadingHTTPServer((config['health'].get('host', '127.0.0.1'), config['health']['port']), handler)
+        threading.Thread(target=httpd.serve_forever, name='health', daemon=True).start()
+        logging.info('Serving health on http://%s:%d/health', *httpd.server_address[:2])
+
+    runner.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List
+
+
+class SendQueue:
+    """
+    Bounded queue of outbound calls, processed by a pool of worker threads.
+
+    Calls are grouped by key (usually a Matrix room id). Calls with the same key are run one at a
+     time, in the order they were queued; calls with different keys are run in parallel.
+    """
+    maxsize = 1000              # type: int
+    num_workers = 4             # type: int
+
+    sent_count = 0              # type: int
+    failed_count = 0            # type: int
+    coalesced_count = 0         # type: int
+
+    def __init__(self, num_workers: int=4, maxsize: int=1000, name: str='send-queue'):
+        """
+        :param num_workers: Number of worker threads
+        :param maxsize: Maximum number of queued calls; put() blocks while the queue is full
+        :param name: Prefix for the worker thread names
+        """
+        self.num_workers = num_workers
+        self.maxsize = maxsize
+        self.name = name
+
+        self._pending = {}                  # type: Dict[str, Deque[List]]
+        self._ready = deque()               # type: Deque[str]
+        # Keys with a running call -> time that call was queued
+        self._active = {}                   # type: Dict[str, float]
+        self._size = 0
+        self._cond = threading.Condition()
+        self._latencies = deque(maxlen=1000)  # type: Deque[float]
+        self._workers = []                  # type: List[threading.Thread]
+        self._stopped = False
+
+    @property
+    def depth(self) -> int:
+        """
+        :return: Number of calls which are queued or running
+        """
+        return self._size
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name='{}-{}'.format(self.name, i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """
+        Let the worker threads exit once their current call is done. Calls which are still queued are dropped.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def put(self, key: str, func: Callable, *args, timeout: float=None, coalesce: str=None, **kwargs):
+        """
+        Queue a call to func(*args, **kwargs).
+
+        Blocks while the queue is full.
+        :param key: Calls with the same key are run in order, one at a time
+        :param func: Function to call
+        :param timeout: Maximum time to wait for free space, None waits forever
+        :param coalesce: (Optional) If a call with the same key and coalesce value is still waiting,
+                         it is replaced by this one instead of queueing another call
+                         (e.g. two room name changes only send the last name).
+        :raises queue.Full: if no space became free within the timeout
+        """
+        with self._cond:
+            if coalesce is not None:
+                for call in self._pending.get(key, ()):
+                    if call[4] == coalesce:
+                        call[0:3] = func, args, kwargs
+                        self.coalesced_count += 1
+                        return
+
+            if not self._cond.wait_for(lambda: self._size < self.maxsize, timeout):
+                raise queue.Full('{} is full ({} calls)'.format(self.name, self._size))
+
+            if key not in self._pending:
+                self._pending[key] = deque()
+                if key not in self._active:
+                    self._ready.append(key)
+            self._pending[key].append([func, args, kwargs, time.monotonic(), coalesce])
+            self._size += 1
+            self._cond.notify_all()
+
+    def oldest_age(self) -> float:
+        """
+        :return: Seconds since the oldest call which is queued or running was queued, 0 if there is none
+        """
+        with self._cond:
+            queued = [calls[0][3] for calls in self._pending.values()] + list(self._active.values())
+        return time.monotonic() - min(queued) if queued else 0.0
+
+    def latency(self, percentile: float=50) -> float or None:
+        """
+        Time between queueing and completion of recent calls.
+
+        :param percentile: Percentile to return, between 0 and 100
+        :return: Latency in seconds, or None if nothing was sent yet
+        """
+        with self._cond:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+    def join(self, timeout: float=None) -> bool:
+        """
+        Wait until all queued calls are done.
+
+        :param timeout: Maximum time to wait, None waits forever
+        :return: True if the queue is empty
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._size == 0, timeout)
+
+    def wait_for_depth(self, max_depth: int, timeout: float=None) -> bool:
+        """
+        Wait until at most max_depth calls are queued or running, e.g. to let other callers go first.
+         Returns early if the queue was stopped.
+
+        :param timeout: Maximum time to wait, None waits forever
+        :return: True if the depth is at most max_depth
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._size <= max_depth or self._stopped, timeout)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._ready) > 0 or self._stopped)
+                if self._stopped:
+                    return
+                key = self._ready.popleft()
+                calls = self._pending[key]
+                func, args, kwargs, queued_at, _coalesce = calls.popleft()
+                if not calls:
+                    del self._pending[key]
+                self._active[key] = queued_at
+
+            try:
+                func(*args, **kwargs)
+                failed = False
+            except Exception:
+                failed = True
+                logging.exception('%s: call to %s failed', self.name, getattr(func, '__name__', func))
+
+            with self._cond:
+                if failed:
+                    self.failed_count += 1
+                else:
+                    self.sent_count += 1
+                self._latencies.append(time.monotonic() - queued_at)
+                del self._active[key]
+                if key in self._pending:
+                    self._ready.append(key)
+                self._size -= 1
+                self._cond.notify_all()
@@ -0,0 +1,102 @@
+import sqlite3
+import threading
+from typing import Dict, Iterable, Tuple
+
+
+class RoomStore:
+    """
+    Local SQLite copy of the topic and name of every joined room, from which the
+     topic -> room map, the special rooms and the groupchat JIDs are rebuilt on startup,
+     the number of joined members of every room (as far as the sync told it),
+     plus a key -> value table for other state which should survive a restart
+     (e.g. the Matrix access token and sync position).
+    """
+    path = None                 # type: str
+
+    def __init__(self, path: str):
+        """
+        :param path: SQLite database file, created if it does not exist
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS rooms ('
+                             ' room_id TEXT PRIMARY KEY,'
+                             ' topic TEXT,'
+                             ' name TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS member_counts ('
+                             ' room_id TEXT PRIMARY KEY,'
+                             ' joined INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS state ('
+                             ' key TEXT PRIMARY KEY,'
+                             ' value TEXT)')
+
+    def rooms(self) -> Dict[str, Tuple[str, str]]:
+        """
+        :return: Map of room_id -> (topic, name) for all stored rooms
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT room_id, topic, name FROM rooms').fetchall()
+        return {room_id: (topic, name) for room_id, topic, name in rows}
+
+    def set_room(self, room_id: str, topic: str, name: str):
+        """
+        Store (or replace) the topic and name of a room.
+        """
+        self.set_rooms([(room_id, topic, name)])
+
+    def set_rooms(self, rooms: Iterable[Tuple[str, str, str]]):
+        """
+        Store (or replace) several rooms in one transaction.
+        :param rooms: Iterable of (room_id, topic, name)
+        """
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO rooms (room_id, topic, name) VALUES (?, ?, ?)', rooms)
+
+    def remove_rooms(self, room_ids: Iterable[str]):
+        """
+        Forget the given rooms.
+        """
+        with self._lock, self._db:
+            room_ids = [(room_id,) for room_id in room_ids]
+            self._db.executemany('DELETE FROM rooms WHERE room_id = ?', room_ids)
+            self._db.executemany('DELETE FROM member_counts WHERE room_id = ?', room_ids)
+
+    def member_counts(self) -> Dict[str, int]:
+        """
+        :return: Map of room_id -> number of joined members
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT room_id, joined FROM member_counts').fetchall()
+        return dict(rows)
+
+    def set_member_counts(self, counts: Iterable[Tuple[str, int]]):
+        """
+        Store (or replace) the number of joined members of several rooms in one transaction.
+        :param counts: Iterable of (room_id, joined)
+        """
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO member_counts (room_id, joined) VALUES (?, ?)', counts)
+
+    def get_value(self, key: str, default: str=None) -> str or None:
+        """
+        :return: The stored value for key, or default if there is none
+        """
+        with self._lock:
+            row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_value(self, key: str, value: str or None):
+        """
+        Store a value; None removes the key.
+        """
+        with self._lock, self._db:
+            if value is None:
+                self._db.execute('DELETE FROM state WHERE key = ?', (key,))
+            else:
+                self._db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from sleekxmpp.xmlstream import ET
+
+from mxpp.backfill import ArchivedMessage, Backfill, STANZA_ID_NS
+from mxpp.store import RoomStore
+
+JID = 'alice@example.com'
+OWN_JID = 'bridge@example.com'
+
+
+def live_message(archive_id: str) -> SimpleNamespace:
+    xml = ET.fromstring('<message xmlns="jabber:client"><body>hi</body>'
+                        '<stanza-id xmlns="{}" id="{}" by="{}"/></message>'.format(STANZA_ID_NS, archive_id, OWN_JID))
+    return SimpleNamespace(xml=xml)
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = RoomStore(os.path.join(self.dir, 'store.sqlite'))
+        send_queue = SimpleNamespace(wait_for_depth=lambda *args: True)
+        self.backfill = Backfill(None, self.store, send_queue, self.write)
+        self.page = ([ArchivedMessage('a1', 0.0, JID, 'hello')], 'a1', True)
+        self.backfill._fetch_page = lambda *args: self.page
+
+    def tearDown(self):
+        self.backfill.stop()
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, jid, messages, last):
+        raise ConnectionError('homeserver unreachable')
+
+    def test_failed_write_releases_the_jid(self):
+        with self.assertRaises(ConnectionError):
+            self.backfill._backfill(JID, False)
+        self.assertIsNone(self.backfill.checkpoint(JID))
+
+        # Live messages move the checkpoint again, as no backfill of the JID is running
+        self.backfill.live(JID, live_message('b1'), OWN_JID)
+        self.assertEqual(self.backfill.checkpoint(JID), 'b1')
+
+    def test_page_written_moves_the_checkpoint(self):
+        self.write = lambda jid, messages, last: self.backfill.page_written(jid, last)
+        self.backfill.write = self.write
+        self.backfill._backfill(JID, False)
+        self.assertEqual(self.backfill.checkpoint(JID), 'a1')
+
+
+if __name__ == '__main__':
+    unittest.main()
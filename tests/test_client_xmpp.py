@@ -0,0 +1,66 @@
+import unittest
+
+from sleekxmpp.plugins.xep_0198 import Enabled, Resumed
+from sleekxmpp.stanza import Message, Presence
+
+from mxpp.client_xmpp import ClientXMPP
+
+
+class StreamManagementTest(unittest.TestCase):
+    def setUp(self):
+        self.xmpp = ClientXMPP('bridge@example.com', 'secret')
+        self.sm = self.xmpp.plugin['xep_0198']
+        self.sm.enabled.set()
+        self.receive(Enabled(self.xmpp))
+
+    def receive(self, stanza):
+        self.xmpp._count_incoming(stanza)
+
+    def message(self, body: str='hi') -> Message:
+        message = Message(self.xmpp)
+        message['body'] = body
+        return message
+
+    def test_messages_count_once_handled(self):
+        self.receive(Presence(self.xmpp))
+        self.assertEqual(self.sm.handled, 1)
+
+        self.receive(self.message())
+        self.receive(Presence(self.xmpp))
+        self.receive(self.message())
+        # Stanzas after an unhandled message wait for it
+        self.assertEqual(self.sm.handled, 1)
+
+        self.xmpp.message_handled()
+        self.assertEqual(self.sm.handled, 3)
+        self.xmpp.message_handled()
+        self.assertEqual(self.sm.handled, 4)
+
+        # Messages without a body don't raise 'message' events
+        self.receive(Message(self.xmpp))
+        self.assertEqual(self.sm.handled, 5)
+
+    def test_resumed_stream(self):
+        self.receive(self.message())
+        self.sm.handled = 7
+        self.receive(Resumed(self.xmpp))
+        self.receive(self.message())
+
+        # The first message is resent by the server, and not counted
+        self.assertTrue(self.xmpp.message_resent())
+        self.xmpp.message_handled()
+        self.assertEqual(self.sm.handled, 7)
+        self.assertFalse(self.xmpp.message_resent())
+        self.xmpp.message_handled()
+        self.assertEqual(self.sm.handled, 8)
+
+    def test_without_stream_management(self):
+        self.sm.enabled.clear()
+        self.receive(self.message())
+        self.assertFalse(self.xmpp.message_resent())
+        self.xmpp.message_handled()
+        self.assertEqual(self.sm.handled, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
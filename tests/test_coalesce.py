@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+from mxpp.coalesce import BurstCoalescer
+
+
+class BurstCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.flushed = []
+        # Two messages per window are sent on their own
+        self.coalescer = BurstCoalescer(lambda key, items: self.flushed.append((key, items)),
+                                        threshold=10, window=0.2)
+
+    def test_burst_and_back(self):
+        self.assertFalse(self.coalescer.add('!a', 1))
+        self.assertFalse(self.coalescer.add('!a', 2))
+        self.assertFalse(self.coalescer.is_collecting('!a'))
+
+        # Above the threshold, messages are collected
+        self.assertTrue(self.coalescer.add('!a', 3))
+        self.assertTrue(self.coalescer.add('!a', 4))
+        self.assertTrue(self.coalescer.is_collecting('!a'))
+        # Other rooms are counted on their own
+        self.assertFalse(self.coalescer.add('!b', 1))
+
+        self.coalescer.flush('!a')
+        self.assertEqual(self.flushed, [('!a', [3, 4])])
+        self.assertFalse(self.coalescer.is_collecting('!a'))
+
+        # Once the rate dropped, messages are sent on their own again
+        time.sleep(0.3)
+        self.assertFalse(self.coalescer.add('!a', 5))
+        self.assertEqual(len(self.flushed), 1)
+
+    def test_window_ends_by_itself(self):
+        for i in range(3):
+            self.coalescer.add('!a', i)
+        time.sleep(0.5)
+        self.assertEqual(self.flushed, [('!a', [2])])
+
+    def test_flush_callback_runs_without_the_lock(self):
+        collecting = []
+
+        def flush(key, items):
+            # e.g. a send queue which is full, and waits for a message which is being added
+            self.flushed.append((key, items))
+            collecting.append(coalescer.is_collecting(key))
+            coalescer.add('!b', 'other')
+
+        coalescer = BurstCoalescer(flush, threshold=2, window=1)
+        for i in range(3):
+            coalescer.add('!a', i)
+        thread = threading.Thread(target=coalescer.flush, args=('!a',), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.flushed, [('!a', [2])])
+        # Messages sent on their own wait until the burst was handed over
+        self.assertEqual(collecting, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
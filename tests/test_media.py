@@ -0,0 +1,43 @@
+import unittest
+
+from mxpp.media import MediaCache
+
+
+class MediaCacheTest(unittest.TestCase):
+    def test_alias_is_found_like_its_file(self):
+        cache = MediaCache(max_bytes=100)
+        cache.put('xmpp hash1', 'https://upload/1', 10, alias='xmpp mxc://a')
+        self.assertEqual(cache.get('xmpp mxc://a'), 'https://upload/1')
+        self.assertEqual(cache.get('xmpp hash1'), 'https://upload/1')
+        # Aliases are not counted
+        self.assertEqual(cache.size, 10)
+
+    def test_aliases_are_evicted_with_their_file(self):
+        cache = MediaCache(max_bytes=100)
+        for i in range(50):
+            cache.put('xmpp hash{}'.format(i), 'https://upload/{}'.format(i), 60, alias='xmpp mxc://{}'.format(i))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('xmpp mxc://0'))
+        self.assertEqual(cache.get('xmpp mxc://49'), 'https://upload/49')
+
+    def test_alias_keeps_its_file_in_use(self):
+        cache = MediaCache(max_bytes=100)
+        cache.put('xmpp hash1', 'https://upload/1', 40, alias='xmpp mxc://a')
+        cache.put('xmpp hash2', 'https://upload/2', 40, alias='xmpp mxc://b')
+        cache.get('xmpp mxc://a')
+        cache.put('xmpp hash3', 'https://upload/3', 40)
+        self.assertIsNone(cache.get('xmpp mxc://b'))
+        self.assertEqual(cache.get('xmpp mxc://a'), 'https://upload/1')
+
+    def test_alias_of_another_file(self):
+        cache = MediaCache(max_bytes=100)
+        cache.put('xmpp hash1', 'https://upload/1', 60, alias='xmpp mxc://a')
+        cache.put('xmpp hash2', 'https://upload/2', 30, alias='xmpp mxc://a')
+        cache.put('xmpp hash3', 'https://upload/3', 30)
+        # hash1 was evicted, which must not drop the alias which now points to hash2
+        self.assertIsNone(cache.get('xmpp hash1'))
+        self.assertEqual(cache.get('xmpp mxc://a'), 'https://upload/2')
+
+
+if __name__ == '__main__':
+    unittest.main()
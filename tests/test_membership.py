@@ -0,0 +1,54 @@
+import unittest
+
+from mxpp.membership import MembershipIndex
+
+
+def member_event(user_id: str, membership: str) -> dict:
+    return {'room_id': '!a', 'state_key': user_id, 'content': {'membership': membership}}
+
+
+class MembershipIndexTest(unittest.TestCase):
+    def test_invite_join_leave(self):
+        members = MembershipIndex()
+        members.set_members('!a', ['@bot:x'], [])
+
+        members.process_event(member_event('@alice:x', 'invite'))
+        self.assertTrue(members.is_member('!a', '@alice:x'))
+        self.assertEqual(members.invited('!a'), {'@alice:x'})
+        self.assertEqual(members.joined_count('!a'), 1)
+
+        members.process_event(member_event('@alice:x', 'join'))
+        self.assertEqual(members.joined('!a'), {'@bot:x', '@alice:x'})
+        self.assertEqual(members.invited('!a'), set())
+        self.assertEqual(members.joined_count('!a'), 2)
+
+        members.process_event(member_event('@alice:x', 'leave'))
+        self.assertFalse(members.is_member('!a', '@alice:x'))
+        self.assertEqual(members.joined_count('!a'), 1)
+
+    def test_count_of_incomplete_room(self):
+        members = MembershipIndex()
+        self.assertIsNone(members.joined_count('!a'))
+
+        # With lazy-loaded members, only the summary knows how many joined
+        members.process_event(member_event('@alice:x', 'join'))
+        members.set_joined_count('!a', 3)
+        self.assertFalse(members.is_complete('!a'))
+        self.assertEqual(members.joined_count('!a'), 3)
+
+        # The full member list replaces the count
+        members.set_members('!a', ['@bot:x'], [])
+        members.set_joined_count('!a', 5)
+        self.assertEqual(members.joined_count('!a'), 1)
+
+    def test_forget(self):
+        members = MembershipIndex()
+        members.set_members('!a', ['@bot:x'], ['@alice:x'])
+        members.forget('!a')
+        self.assertFalse(members.is_complete('!a'))
+        self.assertFalse(members.is_member('!a', '@alice:x'))
+        self.assertIsNone(members.joined_count('!a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from sleekxmpp.xmlstream import ET
+
+from mxpp.muc import LAST_SEEN_KEY, MucJoiner
+from mxpp.store import RoomStore
+
+
+def live_message() -> SimpleNamespace:
+    return SimpleNamespace(xml=ET.Element('{jabber:client}message'))
+
+
+class MucJoinerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = RoomStore(os.path.join(self.dir, 'store.sqlite'))
+        xmpp = SimpleNamespace(add_event_handler=lambda *args: None)
+        self.joiner = MucJoiner(xmpp, self.store, 'bridge', save_interval=3600)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def saved(self, room_jid: str) -> float or None:
+        value = self.store.get_value(LAST_SEEN_KEY + room_jid)
+        return None if value is None else float(value)
+
+    def test_last_seen_is_saved_on_stop(self):
+        self.joiner.seen('muc@conf', live_message())
+        first = self.saved('muc@conf')
+        self.assertIsNotNone(first)
+
+        # Within save_interval, only kept in memory
+        self.joiner.seen('muc@conf', live_message())
+        last = self.joiner.last_seen('muc@conf')
+        self.assertEqual(self.saved('muc@conf'), first)
+
+        self.joiner.stop()
+        self.assertEqual(self.saved('muc@conf'), last)
+
+    def test_forgotten_group_chat_is_not_saved_on_stop(self):
+        self.joiner.seen('muc@conf', live_message())
+        self.joiner.seen('muc@conf', live_message())
+        self.joiner.forget('muc@conf')
+        self.joiner.stop()
+        self.assertIsNone(self.saved('muc@conf'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mxpp.outbox import Outbox, TO_MATRIX, TO_XMPP
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'outbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_undelivered_messages_are_replayed(self):
+        outbox = Outbox(self.path)
+        first = outbox.add(TO_MATRIX, room_id='!a', body='one')
+        second = outbox.add(TO_XMPP, 'event1', to='a@b', body='two')
+        outbox.done(first['id'])
+        outbox.close()
+
+        outbox = Outbox(self.path)
+        self.assertEqual([entry['id'] for entry in outbox.pending()], ['event1'])
+        self.assertEqual(outbox.pending(TO_XMPP)[0]['body'], 'two')
+        self.assertEqual(outbox.pending(TO_MATRIX), [])
+        self.assertEqual(second['direction'], TO_XMPP)
+        outbox.close()
+
+    def test_same_id_is_only_added_once(self):
+        outbox = Outbox(self.path)
+        self.assertIsNotNone(outbox.add(TO_XMPP, 'event1', body='x'))
+        self.assertIsNone(outbox.add(TO_XMPP, 'event1', body='x'))
+        self.assertTrue(outbox.is_pending('event1'))
+        outbox.done('event1')
+        self.assertFalse(outbox.is_pending('event1'))
+        # Delivered ids are remembered, also across a restart
+        self.assertIsNone(outbox.add(TO_XMPP, 'event1', body='x'))
+        outbox.close()
+
+        outbox = Outbox(self.path)
+        self.assertIsNone(outbox.add(TO_XMPP, 'event1', body='x'))
+        self.assertEqual(outbox.pending(), [])
+        outbox.close()
+
+    def test_merged_messages_are_replayed_as_one(self):
+        outbox = Outbox(self.path)
+        for i in range(3):
+            outbox.add(TO_MATRIX, str(i), room_id='!a', body=str(i))
+        merged = outbox.merge(['0', '1', '2'], TO_MATRIX, room_id='!a', body='0\n1\n2')
+        self.assertEqual(outbox.pending(), [merged])
+        outbox.close()
+
+        outbox = Outbox(self.path)
+        pending = outbox.pending()
+        self.assertEqual([entry['id'] for entry in pending], [merged['id']])
+        self.assertEqual(pending[0]['body'], '0\n1\n2')
+        self.assertIsNone(outbox.add(TO_MATRIX, '1', body='1'))
+        outbox.close()
+
+    def test_damaged_last_record_is_ignored(self):
+        outbox = Outbox(self.path)
+        outbox.add(TO_MATRIX, 'kept', body='x')
+        outbox.close()
+        with open(self.path, 'a') as journal:
+            journal.write('{"op": "add", "id": "torn"')
+
+        outbox = Outbox(self.path)
+        self.assertEqual([entry['id'] for entry in outbox.pending()], ['kept'])
+        outbox.close()
+
+    def test_compaction_keeps_pending_messages(self):
+        outbox = Outbox(self.path, compact_after=10)
+        for i in range(30):
+            outbox.add(TO_MATRIX, str(i), body='x')
+            if i % 2:
+                outbox.done(str(i))
+        outbox.flush()
+        outbox.close()
+
+        outbox = Outbox(self.path)
+        self.assertEqual([entry['id'] for entry in outbox.pending()], [str(i) for i in range(0, 30, 2)])
+        outbox.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
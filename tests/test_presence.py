@@ -0,0 +1,46 @@
+import threading
+import unittest
+
+from mxpp.presence import PresenceDigest
+
+
+class PresenceDigestTest(unittest.TestCase):
+    def setUp(self):
+        self.published = []
+        # The window never ends by itself here; the tests end it with flush()
+        self.digest = PresenceDigest(self.published.append, window=3600)
+
+    def test_flap_within_window_is_not_published(self):
+        self.digest.update('a@b', 'A', True)
+        self.digest.flush()
+        self.assertEqual(self.published, ['1 available: A (a@b)'])
+
+        self.digest.update('a@b', 'A', False)
+        self.digest.update('a@b', 'A', True)
+        self.digest.flush()
+        self.assertEqual(len(self.published), 1)
+
+    def test_last_state_counts(self):
+        self.digest.update('a@b', 'A', True)
+        self.digest.update('c@d', 'C', True)
+        self.digest.update('a@b', 'A', False)
+        self.digest.flush()
+        self.assertEqual(self.published, ['1 available: C (c@d)\n1 unavailable: A (a@b)'])
+
+    def test_live_table(self):
+        self.digest.live_table = True
+        self.digest.update('a@b', 'A', True)
+        self.digest.flush()
+        self.digest.update('c@d', 'C', False)
+        self.digest.flush()
+        self.assertEqual(self.published[-1], '1 available: A (a@b)\n1 unavailable: C (c@d)')
+
+    def test_window_ends_by_itself(self):
+        done = threading.Event()
+        digest = PresenceDigest(lambda text: done.set(), window=0.01)
+        digest.update('a@b', 'A', True)
+        self.assertTrue(done.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import time
+import unittest
+
+from mxpp.ratelimit import TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_is_available_at_once(self):
+        bucket = TokenBucket(rate=1, burst=5)
+        started = time.monotonic()
+        for _ in range(5):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    def test_tokens_are_refilled_at_rate(self):
+        bucket = TokenBucket(rate=20, burst=1)
+        bucket.acquire()
+        started = time.monotonic()
+        for _ in range(4):
+            bucket.acquire()
+        # 4 tokens at 20 per second
+        self.assertAlmostEqual(time.monotonic() - started, 0.2, delta=0.1)
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = TokenBucket(rate=100, burst=2)
+        time.sleep(0.1)     # would be 10 tokens without the cap
+        started = time.monotonic()
+        for _ in range(4):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.015)
+
+    def test_pause_holds_back_tokens(self):
+        bucket = TokenBucket()
+        bucket.pause(0.1)
+        started = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+
+if __name__ == '__main__':
+    unittest.main()
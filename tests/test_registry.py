@@ -0,0 +1,58 @@
+import unittest
+from types import SimpleNamespace
+
+from mxpp.registry import RoomRegistry
+
+FLAG = '<groupchat>'
+
+
+def room(room_id: str) -> SimpleNamespace:
+    return SimpleNamespace(room_id=room_id)
+
+
+class RoomRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = RoomRegistry(FLAG, ['control', 'all_chat'])
+
+    def test_remove(self):
+        self.registry.add('a@b', room('!a'))
+        self.registry.remove('!a')
+        self.assertNotIn('a@b', self.registry)
+        self.assertIsNone(self.registry.get('a@b'))
+        self.assertIsNone(self.registry.topic_for('!a'))
+        self.assertFalse(self.registry.is_known('!a'))
+        self.assertEqual(self.registry.topics(), [])
+        # Unknown rooms are ignored
+        self.registry.remove('!a')
+
+    def test_replaced_room(self):
+        self.registry.add('a@b', room('!old'))
+        self.registry.add('a@b', room('!new'))
+        self.assertEqual(self.registry.get('a@b').room_id, '!new')
+        self.assertIsNone(self.registry.topic_for('!old'))
+        # Removing the replaced room keeps the new one
+        self.registry.remove('!old')
+        self.assertEqual(self.registry.topic_for('!new'), 'a@b')
+
+    def test_groupchat_add_remove(self):
+        self.registry.add(FLAG + 'muc@conf', room('!m'))
+        self.assertTrue(self.registry.is_groupchat('muc@conf'))
+        self.assertEqual(self.registry.groupchat_jids(), ['muc@conf'])
+        self.assertEqual(self.registry.topic_for('!m'), FLAG + 'muc@conf')
+
+        self.registry.remove('!m')
+        self.assertFalse(self.registry.is_groupchat('muc@conf'))
+        self.assertNotIn(FLAG + 'muc@conf', self.registry)
+
+    def test_special_rooms(self):
+        self.assertIsNone(self.registry.special_room('control'))
+        self.registry.set_special_room('control', room('!c1'))
+        self.registry.set_special_room('control', room('!c2'))
+        self.assertTrue(self.registry.is_known('!c2'))
+        self.assertFalse(self.registry.is_special('!c1'))
+        self.assertIsNone(self.registry.topic_for('!c2'))
+        self.assertEqual(sorted(self.registry.special_topics()), ['all_chat', 'control'])
+
+
+if __name__ == '__main__':
+    unittest.main()
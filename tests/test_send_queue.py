@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+
+from mxpp.send_queue import SendQueue
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = SendQueue(num_workers=4, name='test')
+        self.queue.start()
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def test_calls_with_the_same_key_run_in_order(self):
+        done = {'a': [], 'b': []}
+
+        def call(key, i):
+            time.sleep(0.001 * (i % 3))
+            done[key].append(i)
+
+        for i in range(50):
+            self.queue.put('a', call, 'a', i)
+            self.queue.put('b', call, 'b', i)
+        self.assertTrue(self.queue.join(timeout=10))
+        self.assertEqual(done['a'], list(range(50)))
+        self.assertEqual(done['b'], list(range(50)))
+        self.assertEqual(self.queue.sent_count, 100)
+
+    def test_calls_with_different_keys_run_in_parallel(self):
+        barrier = threading.Barrier(2, timeout=5)
+        self.queue.put('a', barrier.wait)
+        self.queue.put('b', barrier.wait)
+        self.assertTrue(self.queue.join(timeout=10))
+        self.assertEqual(self.queue.failed_count, 0)
+
+    def test_waiting_call_is_coalesced(self):
+        release = threading.Event()
+        names = []
+        self.queue.put('a', release.wait, 5)
+        self.queue.put('a', names.append, 'first', coalesce='name')
+        self.queue.put('a', names.append, 'second', coalesce='name')
+        release.set()
+        self.assertTrue(self.queue.join(timeout=10))
+        self.assertEqual(names, ['second'])
+        self.assertEqual(self.queue.coalesced_count, 1)
+
+    def test_failed_call_does_not_stop_the_key(self):
+        done = []
+        self.queue.put('a', lambda: 1 / 0)
+        self.queue.put('a', done.append, 1)
+        self.assertTrue(self.queue.join(timeout=10))
+        self.assertEqual(done, [1])
+        self.assertEqual(self.queue.failed_count, 1)
+
+    def test_latency_and_oldest_age(self):
+        self.assertIsNone(self.queue.latency())
+        release = threading.Event()
+        self.queue.put('a', release.wait, 5)
+        time.sleep(0.05)
+        self.assertGreaterEqual(self.queue.oldest_age(), 0.05)
+        release.set()
+        self.assertTrue(self.queue.join(timeout=10))
+        self.assertEqual(self.queue.oldest_age(), 0.0)
+        self.assertGreaterEqual(self.queue.latency(50), 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()